@@ -0,0 +1,204 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qsl
+from urllib.request import Request, urlopen
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench_bot", "username": "bench_bot"}
+
+
+# Ответы Bot API по умолчанию: минимальные объекты, которые
+# python-telegram-bot умеет разобрать
+def default_result(method: str, params: dict, counter: int):
+    now = int(time.time())
+    chat_id = params.get("chat_id", 0)
+    if method in {"sendMessage", "sendDocument", "copyMessage", "forwardMessage"}:
+        return {
+            "message_id": counter,
+            "date": now,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+    if method in {"copyMessages", "forwardMessages"}:
+        return [
+            {"message_id": counter * 10 + index}
+            for index, _ in enumerate(params.get("message_ids") or [])
+        ]
+    if method in {"createChatInviteLink", "revokeChatInviteLink"}:
+        return {
+            "invite_link": params.get("invite_link")
+            or f"https://t.me/+bench{counter:012d}",
+            "creator": BOT_USER,
+            "creates_join_request": False,
+            "is_primary": False,
+            "is_revoked": method == "revokeChatInviteLink",
+            "member_limit": params.get("member_limit"),
+        }
+    if method == "getChatMember":
+        return {
+            "user": {
+                "id": params.get("user_id", 0),
+                "is_bot": False,
+                "first_name": "u",
+            },
+            "status": "member",
+        }
+    if method == "getMe":
+        return BOT_USER
+    return True
+
+
+# Локальная замена Telegram Bot API с настраиваемой задержкой
+# и ответами flood control (429 Too Many Requests)
+class FakeTelegramServer:
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        rate_limit: int = 30,
+        retry_after: int = 1,
+        recorded: Optional[dict] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        # Максимум запросов в секунду, после которого отвечаем 429
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        # Записанные ответы по методам: {"sendMessage": {...}}
+        self.recorded = recorded or {}
+        self.calls = Counter()
+        self.flood_responses = 0
+        self._counter = 0
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> "FakeTelegramServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        return None
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.flood_responses = 0
+        return None
+
+    # Считаем запросы в текущей секунде и решаем, нужно ли ответить 429
+    def _register_call(self, method: str) -> tuple:
+        with self._lock:
+            self._counter += 1
+            second = int(time.monotonic())
+            window_second, count = self._window
+            count = count + 1 if window_second == second else 1
+            self._window = (second, count)
+            if self.rate_limit and count > self.rate_limit:
+                self.flood_responses += 1
+                return self._counter, True
+            self.calls[method] += 1
+            return self._counter, False
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if "json" in content_type:
+                    params = json.loads(body or b"{}")
+                elif "x-www-form-urlencoded" in content_type:
+                    params = dict(parse_qsl(body.decode()))
+                else:
+                    # multipart (sendDocument) нам разбирать не нужно
+                    params = {}
+                time.sleep(max(0.0, server.latency + random.uniform(0, server.jitter)))
+                counter, flooded = server._register_call(method)
+                if flooded:
+                    status, payload = 429, {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {server.retry_after}",
+                        "parameters": {"retry_after": server.retry_after},
+                    }
+                else:
+                    result = server.recorded.get(method)
+                    if result is None:
+                        result = default_result(method, params, counter)
+                    status, payload = 200, {"ok": True, "result": result}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args) -> None:
+                return None
+
+        return Handler
+
+
+# Формируем тело уведомления об оплате так, как его присылает Tilda
+def tilda_payment_body(phone_number: str, months: int, year: int, month: int) -> dict:
+    return {
+        "Phone": phone_number,
+        "month": f"{year}-{month:02d}-01",
+        "tg": "@bench_user",
+        "payment": {
+            "products": [
+                {"name": f"Подписка на сленг-клуб {months} мес.", "price": 990}
+            ]
+        },
+    }
+
+
+# Локальная замена отправителя вебхуков Tilda: шлёт пачку уведомлений
+# об оплате параллельно и возвращает задержку каждого запроса
+class FakeTildaSender:
+    def __init__(self, url: str, api_key: str, concurrency: int = 16) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.concurrency = concurrency
+
+    def _send(self, body: dict) -> tuple:
+        request = Request(
+            self.url,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", "API-Key": self.api_key},
+            method="POST",
+        )
+        started = time.perf_counter()
+        try:
+            with urlopen(request, timeout=60) as response:
+                status = response.status
+        except Exception as error:
+            status = getattr(error, "code", 599)
+        return time.perf_counter() - started, status
+
+    def send_burst(self, bodies: list) -> list:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(self._send, bodies))
@@ -0,0 +1,401 @@
+import argparse
+import importlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Optional
+
+from benchmarks.fake_servers import (
+    FakeTelegramServer,
+    FakeTildaSender,
+    tilda_payment_body,
+)
+from benchmarks.seed import bench_phone_number, bench_telegram_id, seed_database
+
+SCENARIOS = ["button_storm", "payment_burst", "payment_batch", "jobs"]
+JOBS = [
+    "send_invite_link",
+    "notify_about_new_chat",
+    "get_first_reminder_to_renew_the_subscription",
+    "get_second_reminder_to_renew_the_subscription",
+    "get_first_reminder_to_join_the_club",
+    "get_second_reminder_to_join_the_club",
+    "request_feedback_from_all_users",
+    "check_subscription_validity",
+    "handle_overlapping_subscriptions",
+    "handle_subscription_events",
+]
+# Модули, в которых sleep между запросами к API масштабируется
+SLEEPING_MODULES = [
+    "utils",
+    "invite_links",
+    "subscription_events",
+    "postponed_tasks",
+    "manager_commands",
+    "user_commands",
+]
+
+
+# Подменяем настройки бота так, чтобы он ходил в локальные серверы.
+# Настройки БД берутся из окружения (.env), как и у самого бота.
+def configure_environment(telegram_url: str) -> None:
+    os.environ["TELEGRAM_API_URL"] = telegram_url
+    os.environ["TOKEN"] = "123456:bench"
+    os.environ["TELEGRAM_WEBHOOK"] = "telegram"
+    os.environ["PAYMENT_WEBHOOK"] = "payment"
+    os.environ["PAYMENT_KEY"] = "bench-key"
+    os.environ.setdefault("CHANNEL_ID", "-1001000000001")
+    os.environ.setdefault("CHAT_ID", "-1001000000002")
+    return None
+
+
+# Обёртка над модулем time, которая сокращает паузы в scale раз
+class ScaledTime:
+    def __init__(self, scale: float) -> None:
+        self.scale = scale
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds * self.scale)
+        return None
+
+    def __getattr__(self, name: str):
+        return getattr(time, name)
+
+
+def scale_sleeps(scale: float) -> None:
+    for module_name in SLEEPING_MODULES:
+        module = importlib.import_module(module_name)
+        if hasattr(module, "time"):
+            module.time = ScaledTime(scale)
+    return None
+
+
+def percentile(values: list, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def make_report(
+    name: str,
+    operations: int,
+    seconds: float,
+    latencies: list,
+    profile,
+    telegram: FakeTelegramServer,
+) -> dict:
+    p50 = percentile(latencies, 0.5)
+    p99 = percentile(latencies, 0.99)
+    return {
+        "scenario": name,
+        "operations": operations,
+        "seconds": round(seconds, 3),
+        "throughput": round(operations / seconds, 1) if seconds else None,
+        "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+        "queries": profile.count,
+        "queries_per_operation": (
+            round(profile.count / operations, 2) if operations else None
+        ),
+        "query_ms": round(profile.total_time * 1000, 1),
+        "repeated_queries": [
+            {"count": count, "shape": shape[:200]}
+            for shape, count in profile.repeated_shapes()[:5]
+        ],
+        "telegram_calls": dict(telegram.calls),
+        "flood_responses": telegram.flood_responses,
+    }
+
+
+# Запускаем Flask-приложение бота в отдельном потоке
+def start_app_server():
+    from werkzeug.serving import make_server
+
+    import main
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def telegram_text_update(update_id: int, telegram_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": telegram_id, "type": "private"},
+            "from": {
+                "id": telegram_id,
+                "is_bot": False,
+                "first_name": "bench",
+                "username": f"bench_{telegram_id}",
+            },
+            "text": text,
+        },
+    }
+
+
+# Сценарий: массовые нажатия "Получить ссылку 🏁" первого числа
+def button_storm(app_url, telegram, users, presses, concurrency) -> dict:
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.request import Request, urlopen
+
+    from query_profiler import profile_all_threads
+
+    updates = [
+        telegram_text_update(
+            user * presses + press, bench_telegram_id(user), "Получить ссылку 🏁"
+        )
+        for press in range(presses)
+        for user in range(users)
+        if user % 10 != 9
+    ]
+
+    def send(update: dict) -> float:
+        request = Request(
+            f"{app_url}/telegram/",
+            data=json.dumps(update).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        started = time.perf_counter()
+        with urlopen(request, timeout=120) as response:
+            response.read()
+        return time.perf_counter() - started
+
+    telegram.reset()
+    with profile_all_threads("button_storm") as profile:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(send, updates))
+        seconds = time.perf_counter() - started
+    return make_report(
+        "button_storm", len(updates), seconds, latencies, profile, telegram
+    )
+
+
+# Сценарий: пачка вебхуков об оплате от Tilda
+def payment_burst(app_url, telegram, users, payments, concurrency) -> dict:
+    from query_profiler import profile_all_threads
+
+    now = time.localtime()
+    year, month = (
+        (now.tm_year + 1, 1) if now.tm_mon == 12 else (now.tm_year, now.tm_mon + 1)
+    )
+    # Половина оплат от существующих пользователей, половина от новых
+    bodies = [
+        tilda_payment_body(
+            bench_phone_number(index if index % 2 else users + index),
+            months=1 + index % 3,
+            year=year,
+            month=month,
+        )
+        for index in range(payments)
+    ]
+    sender = FakeTildaSender(f"{app_url}/payment/", "bench-key", concurrency)
+    telegram.reset()
+    with profile_all_threads("payment_burst") as profile:
+        started = time.perf_counter()
+        results = sender.send_burst(bodies)
+        seconds = time.perf_counter() - started
+    report = make_report(
+        "payment_burst",
+        len(bodies),
+        seconds,
+        [latency for latency, _ in results],
+        profile,
+        telegram,
+    )
+    report["failed"] = sum(1 for _, status in results if status != 200)
+    return report
+
+
+# Сценарий: одна и та же пачка оплат применяется построчно через
+# update_subscription и одним вызовом update_subscriptions
+def payment_batch(telegram, engine, users, payments) -> list:
+    from query_profiler import profile_all_threads
+    from utils import update_subscription, update_subscriptions
+
+    now = time.localtime()
+    year, month = (
+        (now.tm_year + 1, 1) if now.tm_mon == 12 else (now.tm_year, now.tm_mon + 1)
+    )
+    # Половина оплат от существующих пользователей, половина от новых
+    rows = [
+        (
+            1 + index % 3,
+            bench_phone_number(index if index % 2 else users + index),
+            month,
+            year,
+            f"bench_{index}",
+        )
+        for index in range(payments)
+    ]
+    reports = []
+    for name, apply in (
+        ("payment_batch[per_row]", lambda: [update_subscription(*row) for row in rows]),
+        ("payment_batch[batch]", lambda: update_subscriptions(rows)),
+    ):
+        seed_database(engine, users)
+        telegram.reset()
+        with profile_all_threads(name) as profile:
+            started = time.perf_counter()
+            apply()
+            seconds = time.perf_counter() - started
+        reports.append(make_report(name, len(rows), seconds, [], profile, telegram))
+    return reports
+
+
+# Сценарий: полный прогон отложенной задачи на заполненной базе
+def run_job(name, telegram, engine, users) -> dict:
+    import main
+    import postponed_tasks
+    from query_profiler import profile_all_threads
+
+    seed_database(engine, users)
+    job = getattr(postponed_tasks, name)
+    telegram.reset()
+    with profile_all_threads(name) as profile:
+        started = time.perf_counter()
+        job(main.club_updaters)
+        seconds = time.perf_counter() - started
+    return make_report(f"{name}[{users}]", users, seconds, [], profile, telegram)
+
+
+def print_reports(reports: list) -> None:
+    columns = [
+        "scenario",
+        "operations",
+        "seconds",
+        "throughput",
+        "p50_ms",
+        "p99_ms",
+        "queries",
+        "flood_responses",
+    ]
+    widths = {
+        column: max(len(column), *(len(str(report.get(column))) for report in reports))
+        for column in columns
+    }
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for report in reports:
+        print(
+            "  ".join(
+                str(report.get(column)).ljust(widths[column]) for column in columns
+            )
+        )
+        print(f"    telegram: {report['telegram_calls']}")
+        for repeated in report["repeated_queries"]:
+            print(f"    x{repeated['count']}: {repeated['shape']}")
+    return None
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Нагрузочные сценарии бота с локальными Telegram и Tilda"
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=SCENARIOS,
+        help=f"Сценарии: {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument(
+        "--job-sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--jobs", nargs="+", default=JOBS, choices=JOBS)
+    parser.add_argument("--presses", type=int, default=3)
+    parser.add_argument("--payments", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument(
+        "--rate-limit", type=int, default=0, help="Запросов в секунду до ответа 429"
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--recorded", help="JSON с записанными ответами Bot API по методам"
+    )
+    parser.add_argument(
+        "--sleep-scale",
+        type=float,
+        default=0.0,
+        help="Множитель для пауз time.sleep в коде бота",
+    )
+    parser.add_argument("--output", help="Сохранить отчёт в JSON")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    recorded = None
+    if args.recorded:
+        with open(args.recorded, encoding="utf-8") as file:
+            recorded = json.load(file)
+    telegram = FakeTelegramServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        recorded=recorded,
+    ).start()
+    configure_environment(telegram.base_url)
+    from database import engine
+    from query_profiler import install
+
+    scale_sleeps(args.sleep_scale)
+    install(engine)
+    reports = []
+    app_server = None
+    try:
+        if {"button_storm", "payment_burst"} & set(args.scenarios):
+            seed_database(engine, args.users)
+            app_server, app_url = start_app_server()
+        if "button_storm" in args.scenarios:
+            reports.append(
+                button_storm(
+                    app_url,
+                    telegram,
+                    args.users,
+                    args.presses,
+                    args.concurrency,
+                )
+            )
+        if "payment_burst" in args.scenarios:
+            reports.append(
+                payment_burst(
+                    app_url,
+                    telegram,
+                    args.users,
+                    args.payments,
+                    args.concurrency,
+                )
+            )
+        if "payment_batch" in args.scenarios:
+            reports.extend(payment_batch(telegram, engine, args.users, args.payments))
+        if "jobs" in args.scenarios:
+            for size in args.job_sizes:
+                for name in args.jobs:
+                    reports.append(run_job(name, telegram, engine, size))
+    finally:
+        if app_server is not None:
+            app_server.shutdown()
+        telegram.stop()
+    print_reports(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(reports, file, ensure_ascii=False, indent=2)
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import datetime
+
+from sqlalchemy import delete, insert, text
+
+BATCH_SIZE = 5000
+TELEGRAM_ID_OFFSET = 10**9
+
+
+# Телефонный номер и телеграм id синтетического пользователя
+def bench_phone_number(index: int) -> str:
+    return f"+7900{index:07d}"
+
+
+def bench_telegram_id(index: int) -> int:
+    return TELEGRAM_ID_OFFSET + index
+
+
+# Заполняем базу синтетическими пользователями и подписками.
+# Подписки распределяются так, чтобы каждая задача postponed_tasks
+# получила свою долю получателей:
+# новые (начались сегодня), продлённые, истекшие и будущие.
+def seed_database(engine, users: int, with_reviews: int = 0) -> None:
+    from database import Base, Review, Subscription, User
+
+    Base.metadata.create_all(engine)
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    month_start = now.replace(day=1, hour=12, minute=0)
+    month_end = (month_start + datetime.timedelta(days=32)).replace(
+        day=1, hour=23, minute=59
+    ) - datetime.timedelta(days=1)
+    with engine.begin() as connection:
+        connection.execute(delete(Review))
+        connection.execute(delete(Subscription))
+        connection.execute(delete(User))
+        for batch_start in range(0, users, BATCH_SIZE):
+            batch = range(batch_start, min(batch_start + BATCH_SIZE, users))
+            connection.execute(
+                insert(User),
+                [
+                    {
+                        "id": index + 1,
+                        # Каждый десятый пользователь ещё не запускал бота
+                        "telegram_id": (
+                            None if index % 10 == 9 else bench_telegram_id(index)
+                        ),
+                        "phone_number": bench_phone_number(index),
+                        "user_link": f"https://t.me/bench_user_{index}",
+                    }
+                    for index in batch
+                ],
+            )
+            subscriptions = []
+            for index in batch:
+                kind = index % 4
+                if kind == 0:
+                    # Новая подписка, начинается сегодня
+                    start, end = now - datetime.timedelta(hours=1), month_end
+                elif kind == 1:
+                    # Продлённая подписка
+                    start, end = month_start - datetime.timedelta(days=40), month_end
+                elif kind == 2:
+                    # Истекшая подписка
+                    start = month_start - datetime.timedelta(days=70)
+                    end = month_start - datetime.timedelta(days=10)
+                else:
+                    # Подписка на следующий месяц
+                    start = month_end + datetime.timedelta(hours=13)
+                    end = start + datetime.timedelta(days=29)
+                subscriptions.append(
+                    {
+                        "user_id": index + 1,
+                        "start_datetime": start,
+                        "end_datetime": end,
+                        "subscription_link": (
+                            f"https://t.me/+seed{index:012d}" if kind == 1 else None
+                        ),
+                        "chat_link": None,
+                    }
+                )
+            connection.execute(insert(Subscription), subscriptions)
+        # Id пользователей заданы явно, поэтому сдвигаем последовательность
+        connection.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+                "GREATEST(MAX(id), 1)) FROM users"
+            )
+        )
+        for batch_start in range(0, with_reviews, BATCH_SIZE):
+            batch = range(batch_start, min(batch_start + BATCH_SIZE, with_reviews))
+            connection.execute(
+                insert(Review),
+                [
+                    {
+                        "user_id": index % users + 1,
+                        "created_at": now - datetime.timedelta(minutes=index),
+                        "review_text": f"Отзыв номер {index}: "
+                        + "очень полезный клуб " * (index % 20 + 1),
+                    }
+                    for index in batch
+                ],
+            )
+    return None
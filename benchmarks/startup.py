@@ -0,0 +1,92 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули, которые не должны загружаться при старте процесса
+DEFERRED_MODULES = ["pandas", "openpyxl", "dateutil"]
+
+
+# Окружение без доступной базы данных: если импорт попробует
+# подключиться к БД, он упадёт, а не будет молча ждать сеть
+def startup_environment() -> dict:
+    env = dict(os.environ)
+    env.update(
+        {
+            "TOKEN": env.get("TOKEN") or "123456:bench",
+            "HOST_DB": "127.0.0.1",
+            "PORT_DB": "1",
+            "LOG_FILE": os.path.join(tempfile.gettempdir(), "startup_bench.log"),
+        }
+    )
+    return env
+
+
+# Разбираем вывод python -X importtime: [(собственное время, суммарное время, модуль)]
+def parse_importtime(output: str) -> list:
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        # Вложенность модуля отмечена отступом в два пробела на уровень
+        modules.append((int(self_us), int(cumulative_us), name[1:].rstrip()))
+    return modules
+
+
+def measure_import(module: str, env: dict) -> list:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Импорт {module} завершился ошибкой:\n{result.stderr}")
+    return parse_importtime(result.stderr)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Время холодного старта: python -X importtime для модулей бота"
+    )
+    parser.add_argument("modules", nargs="*", default=["main"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--budget-ms", type=float, help="Завершиться с ошибкой, если импорт дольше"
+    )
+    args = parser.parse_args(argv)
+    env = startup_environment()
+    failed = False
+    for module in args.modules:
+        runs = [measure_import(module, env) for _ in range(args.repeat)]
+        # Берём самый быстрый прогон: остальные искажены кэшем ФС и шумом
+        fastest = min(runs, key=lambda modules: modules[-1][1])
+        total_ms = fastest[-1][1] / 1000
+        print(f"{module}: {total_ms:.0f} мс (лучший из {args.repeat})")
+        depth_one = [
+            (cumulative, name.strip())
+            for _, cumulative, name in fastest
+            if name.startswith("  ") and not name.startswith("   ")
+        ]
+        for cumulative, name in sorted(depth_one, reverse=True)[: args.top]:
+            print(f"  {cumulative / 1000:8.1f} мс  {name}")
+        loaded = {name.strip() for _, _, name in fastest}
+        deferred = [name for name in DEFERRED_MODULES if name in loaded]
+        if deferred:
+            print(f"  загружены при старте: {', '.join(deferred)}")
+            failed = True
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            print(f"  превышен бюджет {args.budget_ms:.0f} мс")
+            failed = True
+    if failed:
+        sys.exit(1)
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import time
+from io import BytesIO
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+from exports import column_widths_from_dataframe
+
+
+# Синтетическая таблица пользователей, похожая на выгрузку /get_all_users
+def make_users_dataframe(rows: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "Телеграм ID": [
+                None if index % 10 == 9 else 10**9 + index for index in range(rows)
+            ],
+            "Телефонный номер": [f"+7900{index:07d}" for index in range(rows)],
+            "Ссылка на телеграм аккаунт": [
+                f"https://t.me/bench_user_{index}" for index in range(rows)
+            ],
+            "Подписки": [
+                ", ".join(["01.09.2024-30.09.2024"] * (index % 4 + 1))
+                for index in range(rows)
+            ],
+        }
+    )
+
+
+SHEET_TITLE = "Все пользователи"
+
+
+# Записываем DataFrame в книгу openpyxl в обычном режиме или write_only.
+# Ширина столбцов (widths) задаётся до записи строк, как в exports.
+def write_sheet(df: pd.DataFrame, write_only: bool, widths: list = ()) -> Workbook:
+    workbook = Workbook(write_only=write_only)
+    worksheet = workbook.create_sheet(SHEET_TITLE)
+    for index, width in enumerate(widths, start=1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+    worksheet.append(list(df.columns))
+    for row in (
+        df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    ):
+        worksheet.append(list(row))
+    return workbook
+
+
+# Прежний расчёт ширины: обход всех ячеек уже записанного листа
+def widths_by_cells(worksheet) -> None:
+    for col in worksheet.columns:
+        max_length = 0
+        column = col[0].column_letter
+        for cell in col:
+            try:
+                if len(str(cell.value)) > max_length:
+                    max_length = len(cell.value)
+            except Exception:
+                pass
+        worksheet.column_dimensions[column].width = max_length + 2
+    return None
+
+
+def save(workbook: Workbook) -> None:
+    with BytesIO() as output:
+        workbook.save(output)
+    return None
+
+
+# Обычная книга, ширина по ячейкам после записи листа
+def export_by_cells(df: pd.DataFrame) -> None:
+    workbook = write_sheet(df, write_only=False)
+    widths_by_cells(workbook[SHEET_TITLE])
+    save(workbook)
+    return None
+
+
+# Обычная книга, ширина по данным до записи листа
+def export_by_data(df: pd.DataFrame) -> None:
+    save(write_sheet(df, False, column_widths_from_dataframe(df)))
+    return None
+
+
+# Как в exports.XlsxExport: ширина по данным, книга write_only
+def export_write_only(df: pd.DataFrame) -> None:
+    save(write_sheet(df, True, column_widths_from_dataframe(df)))
+    return None
+
+
+def measure(func, df: pd.DataFrame, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(df)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Сравнение расчёта ширины столбцов при выгрузке xlsx"
+    )
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    df = make_users_dataframe(args.rows)
+    # Только расчёт ширины: обход ячеек готового листа и расчёт по данным
+    worksheet = write_sheet(df, write_only=False)[SHEET_TITLE]
+    cells_only = measure(lambda _: widths_by_cells(worksheet), df, args.repeat)
+    data_only = measure(column_widths_from_dataframe, df, args.repeat)
+    # Выгрузка целиком: смена расчёта ширины в обычной книге
+    # и отдельно переход на write_only при одинаковом расчёте ширины
+    by_cells = measure(export_by_cells, df, args.repeat)
+    by_data = measure(export_by_data, df, args.repeat)
+    write_only = measure(export_write_only, df, args.repeat)
+    print(f"rows: {args.rows}")
+    print("расчёт ширины:")
+    print(f"  по ячейкам: {cells_only:.2f} с")
+    print(f"  по данным:  {data_only:.2f} с (x{cells_only / data_only:.1f})")
+    print("выгрузка, обычная книга:")
+    print(f"  ширина по ячейкам: {by_cells:.2f} с")
+    print(f"  ширина по данным:  {by_data:.2f} с (x{by_cells / by_data:.1f})")
+    print("выгрузка, ширина по данным:")
+    print(f"  обычная книга: {by_data:.2f} с")
+    print(f"  write_only:    {write_only:.2f} с (x{by_data / write_only:.1f})")
+    return None
+
+
+if __name__ == "__main__":
+    main()
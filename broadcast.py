@@ -0,0 +1,249 @@
+import datetime
+import time
+from collections import Counter
+from typing import Optional
+
+from sqlalchemy import func, insert, literal, select, update
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+
+from constants import BROADCAST_RATE, JOB_BATCH_SIZE
+from database import (
+    COHORT_ANY_PERIOD,
+    COHORT_SUBSCRIBED,
+    DELIVERY_BLOCKED,
+    DELIVERY_FAILED,
+    DELIVERY_PENDING,
+    DELIVERY_SENT,
+    Broadcast,
+    BroadcastDelivery,
+    CohortMember,
+    Session,
+    User,
+)
+from rate_limiter import KeyedTokenBuckets, TokenBucket
+from shutdown import shutting_down
+from utils import create_session, logger
+
+# copy - сообщение приходит от имени бота, forward - с пометкой "переслано из"
+MODE_COPY = "copy"
+MODE_FORWARD = "forward"
+MODES = {MODE_COPY, MODE_FORWARD}
+AUDIENCE_ALL = "all"
+AUDIENCE_SUBSCRIBERS = "subscribers"
+AUDIENCES = {AUDIENCE_ALL, AUDIENCE_SUBSCRIBERS}
+# Сколько раз повторяем отправку после сетевой ошибки или 429
+SEND_RETRIES = 3
+# Альбом копируется одним запросом copyMessages/forwardMessages
+# (Bot API 7.0), которых ещё нет в python-telegram-bot 13
+ALBUM_METHODS = {MODE_COPY: "copyMessages", MODE_FORWARD: "forwardMessages"}
+
+# Рассылки клуба отправляются не быстрее BROADCAST_RATE сообщений в секунду:
+# у каждого клуба свой бот, поэтому рассылки разных клубов не мешают друг другу
+_buckets = KeyedTokenBuckets(BROADCAST_RATE)
+
+
+# Телеграм id получателей рассылки клуба в виде подзапроса
+# для INSERT ... SELECT
+def _audience_select(broadcast_id: int, club_id: int, audience: str):
+    if audience == AUDIENCE_SUBSCRIBERS:
+        return select(literal(broadcast_id), CohortMember.telegram_id).where(
+            CohortMember.club_id == club_id,
+            CohortMember.cohort == COHORT_SUBSCRIBED,
+            CohortMember.period == COHORT_ANY_PERIOD,
+            CohortMember.telegram_id.is_not(None),
+        )
+    return select(literal(broadcast_id), User.telegram_id).where(
+        User.club_id == club_id, User.telegram_id.is_not(None)
+    )
+
+
+# Создаём рассылку клуба и список получателей одним INSERT ... SELECT
+def create_broadcast(
+    session,
+    club_id: int,
+    mode: str,
+    audience: str,
+    from_chat_id: int,
+    message_ids: list,
+    created_by: Optional[int] = None,
+) -> Broadcast:
+    if mode not in MODES:
+        raise ValueError(f"Неизвестный режим рассылки: {mode}")
+    if audience not in AUDIENCES:
+        raise ValueError(f"Неизвестные получатели рассылки: {audience}")
+    broadcast = Broadcast(
+        club_id=club_id,
+        mode=mode,
+        audience=audience,
+        from_chat_id=from_chat_id,
+        message_ids=sorted(message_ids),
+        created_by=created_by,
+    )
+    session.add(broadcast)
+    session.flush()
+    session.execute(
+        insert(BroadcastDelivery).from_select(
+            ["broadcast_id", "telegram_id"],
+            _audience_select(broadcast.id, club_id, audience),
+        )
+    )
+    return broadcast
+
+
+# Один запрос к Bot API: одиночное сообщение или альбом целиком
+def _deliver(bot: Bot, broadcast: Broadcast, telegram_id: int) -> None:
+    if len(broadcast.message_ids) > 1:
+        bot._post(
+            ALBUM_METHODS[broadcast.mode],
+            {
+                "chat_id": telegram_id,
+                "from_chat_id": broadcast.from_chat_id,
+                "message_ids": broadcast.message_ids,
+            },
+        )
+    elif broadcast.mode == MODE_FORWARD:
+        bot.forward_message(
+            chat_id=telegram_id,
+            from_chat_id=broadcast.from_chat_id,
+            message_id=broadcast.message_ids[0],
+        )
+    else:
+        bot.copy_message(
+            chat_id=telegram_id,
+            from_chat_id=broadcast.from_chat_id,
+            message_id=broadcast.message_ids[0],
+        )
+    return None
+
+
+# Отправка одному получателю с учётом лимита и повторов.
+# Возвращает статус доставки и текст ошибки.
+def _deliver_with_retries(
+    bot: Bot, bucket: TokenBucket, broadcast: Broadcast, telegram_id: int
+) -> tuple:
+    last_error = None
+    for attempt in range(SEND_RETRIES):
+        bucket.acquire()
+        try:
+            _deliver(bot, broadcast, telegram_id)
+            return DELIVERY_SENT, None
+        except RetryAfter as error:
+            # Flood control общий для бота: останавливаем всю рассылку
+            logger.warning(
+                "Рассылка %s: flood control, пауза %s с",
+                broadcast.id,
+                error.retry_after,
+            )
+            bucket.pause(error.retry_after)
+            last_error = error
+        except Unauthorized as error:
+            # Пользователь заблокировал бота или удалил аккаунт
+            return DELIVERY_BLOCKED, str(error)
+        except BadRequest as error:
+            return DELIVERY_FAILED, str(error)
+        except TelegramError as error:
+            logger.warning(
+                "Рассылка %s: попытка %s для %s не удалась: %s",
+                broadcast.id,
+                attempt + 1,
+                telegram_id,
+                error,
+            )
+            last_error = error
+            time.sleep(2**attempt)
+    return DELIVERY_FAILED, str(last_error)
+
+
+# Отправляем рассылку ботом её клуба всем получателям, которым она ещё
+# не доставлена. Без bucket используется общий лимит клуба. Статусы
+# сохраняются пачками, поэтому прерванную рассылку можно продолжить
+# повторным вызовом. Возвращает количество получателей по статусам.
+def run_broadcast(
+    bot: Bot, broadcast_id: int, bucket: Optional[TokenBucket] = None
+) -> Counter:
+    statuses = Counter()
+    with create_session() as session:
+        try:
+            broadcast = session.get(Broadcast, broadcast_id)
+            if broadcast is None:
+                raise ValueError(f"Рассылка {broadcast_id} не найдена")
+            bucket = bucket or _buckets.bucket(broadcast.club_id)
+            pending = (
+                session.execute(
+                    select(BroadcastDelivery.telegram_id).where(
+                        BroadcastDelivery.broadcast_id == broadcast_id,
+                        BroadcastDelivery.status == DELIVERY_PENDING,
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            updates = []
+            stopped = False
+            for telegram_id in pending:
+                # При остановке процесса сохраняем статусы отправленных,
+                # рассылка продолжится с неотправленных после перезапуска
+                if shutting_down.is_set():
+                    stopped = True
+                    break
+                status, error = _deliver_with_retries(
+                    bot, bucket, broadcast, telegram_id
+                )
+                statuses[status] += 1
+                updates.append(
+                    {
+                        "broadcast_id": broadcast_id,
+                        "telegram_id": telegram_id,
+                        "status": status,
+                        "error": error,
+                        "sent_at": datetime.datetime.utcnow(),
+                    }
+                )
+                if len(updates) >= JOB_BATCH_SIZE:
+                    session.execute(update(BroadcastDelivery), updates)
+                    session.commit()
+                    updates.clear()
+            if updates:
+                session.execute(update(BroadcastDelivery), updates)
+            if not stopped:
+                broadcast.finished_at = datetime.datetime.utcnow()
+            session.commit()
+            if stopped:
+                logger.warning(
+                    "Рассылка %s приостановлена до перезапуска: %s",
+                    broadcast_id,
+                    dict(statuses),
+                )
+            else:
+                logger.info("Рассылка %s завершена: %s", broadcast_id, dict(statuses))
+        except Exception as error:
+            logger.error("Ошибка при рассылке %s: %s", broadcast_id, error)
+            session.rollback()
+        finally:
+            Session.remove()
+    return statuses
+
+
+# Количество получателей рассылки по статусам доставки. Если задан
+# club_id, рассылка другого клуба считается несуществующей.
+def broadcast_status(session, broadcast_id: int, club_id: Optional[int] = None) -> dict:
+    query = (
+        select(BroadcastDelivery.status, func.count())
+        .where(BroadcastDelivery.broadcast_id == broadcast_id)
+        .group_by(BroadcastDelivery.status)
+    )
+    if club_id is not None:
+        query = query.join(
+            Broadcast, Broadcast.id == BroadcastDelivery.broadcast_id
+        ).where(Broadcast.club_id == club_id)
+    return dict(session.execute(query).all())
+
+
+# Рассылки, которые не были завершены (например, прерваны остановкой процесса)
+def unfinished_broadcasts(session) -> list:
+    return session.execute(
+        select(Broadcast.id, Broadcast.created_by, Broadcast.club_id)
+        .where(Broadcast.finished_at.is_(None))
+        .order_by(Broadcast.id)
+    ).all()
@@ -0,0 +1,317 @@
+import datetime
+import threading
+from collections import Counter
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select, true, update
+from telegram.error import BadRequest, RetryAfter
+
+from clubs import club_share, interleave_by_club
+from constants import (
+    CLEANUP_MAX_ATTEMPTS,
+    CLEANUP_POLL_INTERVAL,
+    CLEANUP_RATE,
+    CLEANUP_UNBAN_DELAY,
+)
+from database import (
+    CLEANUP_BAN,
+    CLEANUP_REVOKE_LINK,
+    CLEANUP_UNBAN,
+    CleanupTask,
+    Club,
+    session_factory,
+)
+from rate_limiter import KeyedTokenBuckets
+from settings import settings
+from shutdown import shutting_down
+from utils import logger
+
+# Сколько действий обработчик забирает из очереди за раз
+CLAIM_BATCH_SIZE = 100
+# На сколько секунд забранные действия скрываются от других обработчиков.
+# Действия упавшего обработчика вернутся в очередь по истечении этого срока.
+CLAIM_LEASE = 300
+# Пауза перед первым повтором после ошибки, дальше она удваивается
+RETRY_BASE_DELAY = 5
+
+# Результаты выполнения действий очереди
+RESULT_DONE = "done"
+RESULT_RETRY = "retry"
+RESULT_DROPPED = "dropped"
+
+
+# Намерения очистки для подписки клуба: отзыв её ссылок в канал
+# и чат-болталку и, если передан телеграм id, исключение участника из обоих
+def subscription_cleanup_rows(
+    club_id: int,
+    subscription_link: Optional[str],
+    chat_link: Optional[str],
+    telegram_id: Optional[int] = None,
+) -> list:
+    club = settings.club(club_id)
+    rows = []
+    for chat_id, invite_link in (
+        (club.channel_id, subscription_link),
+        (club.chat_id, chat_link),
+    ):
+        if invite_link:
+            rows.append(
+                {
+                    "action": CLEANUP_REVOKE_LINK,
+                    "chat_id": chat_id,
+                    "invite_link": invite_link,
+                    "club_id": club_id,
+                }
+            )
+        if telegram_id:
+            rows.append(
+                {
+                    "action": CLEANUP_BAN,
+                    "chat_id": chat_id,
+                    "telegram_id": telegram_id,
+                    "club_id": club_id,
+                }
+            )
+    return rows
+
+
+# Записываем намерения в текущей транзакции вызывающего кода:
+# они выполнятся, только если изменение в БД будет зафиксировано
+def enqueue(session, rows: list) -> None:
+    if rows:
+        session.execute(insert(CleanupTask), rows)
+    return None
+
+
+# Забираем пачку наступивших действий: не больше per_club действий
+# каждого клуба, чтобы очередь одного клуба не задерживала остальные.
+# FOR UPDATE SKIP LOCKED позволяет нескольким обработчикам разбирать
+# очередь, не мешая друг другу.
+def _claim(session, per_club: int) -> list:
+    now = datetime.datetime.utcnow()
+    due = (
+        select(CleanupTask.id)
+        .where(CleanupTask.club_id == Club.id, CleanupTask.run_at <= now)
+        .order_by(CleanupTask.run_at)
+        .limit(per_club)
+        .with_for_update(skip_locked=True)
+        .lateral()
+    )
+    tasks = session.execute(
+        update(CleanupTask)
+        .where(CleanupTask.id.in_(select(due.c.id).select_from(Club).join(due, true())))
+        .values(
+            run_at=now + datetime.timedelta(seconds=CLAIM_LEASE),
+            attempts=CleanupTask.attempts + 1,
+        )
+        .returning(
+            CleanupTask.id,
+            CleanupTask.action,
+            CleanupTask.chat_id,
+            CleanupTask.telegram_id,
+            CleanupTask.invite_link,
+            CleanupTask.attempts,
+            CleanupTask.club_id,
+        )
+    ).all()
+    session.commit()
+    return interleave_by_club(sorted(tasks, key=lambda task: task.id))
+
+
+# Один запрос к Bot API
+def _execute(bot, task) -> None:
+    if task.action == CLEANUP_REVOKE_LINK:
+        bot.revoke_chat_invite_link(task.chat_id, task.invite_link)
+    elif task.action == CLEANUP_BAN:
+        bot.ban_chat_member(chat_id=task.chat_id, user_id=task.telegram_id)
+        logger.info(
+            "Пользователь с телеграм id: %s был удалён из канала: %s",
+            task.telegram_id,
+            task.chat_id,
+        )
+    elif task.action == CLEANUP_UNBAN:
+        bot.unban_chat_member(
+            chat_id=task.chat_id, user_id=task.telegram_id, only_if_banned=True
+        )
+    else:
+        raise ValueError(f"Неизвестное действие очистки: {task.action}")
+    return None
+
+
+# Выполняем действие ботом клуба с учётом лимита клуба. Действия клуба,
+# приостановленного flood control, откладываются до конца паузы, а не ждут
+# её, чтобы не задерживать другие клубы. Возвращает результат и изменения
+# строки очереди для повтора (или None).
+def _process_task(updaters, buckets: KeyedTokenBuckets, task, now) -> tuple:
+    bucket = buckets.bucket(task.club_id)
+    paused = bucket.paused_for()
+    if paused:
+        return RESULT_RETRY, {
+            "id": task.id,
+            "run_at": now + datetime.timedelta(seconds=paused),
+            "attempts": task.attempts - 1,
+            "last_error": "flood control: пауза клуба",
+        }
+    bucket.acquire()
+    try:
+        _execute(updaters.bot(task.club_id), task)
+        return RESULT_DONE, None
+    except RetryAfter as error:
+        # Flood control общий для бота: приостанавливаем действия клуба,
+        # а попытку не засчитываем
+        logger.warning(
+            "Очистка: flood control клуба %s, пауза %s с",
+            task.club_id,
+            error.retry_after,
+        )
+        bucket.pause(error.retry_after)
+        return RESULT_RETRY, {
+            "id": task.id,
+            "run_at": now + datetime.timedelta(seconds=error.retry_after),
+            "attempts": task.attempts - 1,
+            "last_error": str(error),
+        }
+    except BadRequest as error:
+        # Ссылка уже отозвана или пользователь не состоит в чате:
+        # повтор ничего не изменит
+        logger.warning(
+            "Действие очистки %s (%s) пропущено: %s", task.id, task.action, error
+        )
+        return RESULT_DROPPED, None
+    except Exception as error:
+        if task.attempts >= CLEANUP_MAX_ATTEMPTS:
+            logger.error(
+                "Действие очистки %s (%s) не выполнено после %s попыток: %s",
+                task.id,
+                task.action,
+                task.attempts,
+                error,
+            )
+            return RESULT_DROPPED, None
+        delay = RETRY_BASE_DELAY * 2 ** (task.attempts - 1)
+        return RESULT_RETRY, {
+            "id": task.id,
+            "run_at": now + datetime.timedelta(seconds=delay),
+            "attempts": task.attempts,
+            "last_error": str(error),
+        }
+
+
+# Разбираем все наступившие действия очереди ботами их клубов (updaters -
+# clubs.ClubUpdaters), у каждого клуба своё ведро на rate действий в секунду.
+# Успешный бан планирует разбан через CLEANUP_UNBAN_DELAY секунд
+# отдельным действием, а не ожиданием.
+# Возвращает количество действий по результатам.
+def process_cleanup_queue(
+    updaters, buckets: Optional[KeyedTokenBuckets] = None
+) -> Counter:
+    buckets = buckets or KeyedTokenBuckets(CLEANUP_RATE)
+    results = Counter()
+    with session_factory() as session:
+        # При остановке процесса выходим после зафиксированной пачки
+        while not shutting_down.is_set():
+            tasks = _claim(session, club_share(CLAIM_BATCH_SIZE))
+            if not tasks:
+                break
+            finished_ids = []
+            retries = []
+            unbans = []
+            for task in tasks:
+                result, retry = _process_task(
+                    updaters, buckets, task, datetime.datetime.utcnow()
+                )
+                results[result] += 1
+                if retry is not None:
+                    retries.append(retry)
+                    continue
+                finished_ids.append(task.id)
+                if result == RESULT_DONE and task.action == CLEANUP_BAN:
+                    unbans.append(
+                        {
+                            "action": CLEANUP_UNBAN,
+                            "chat_id": task.chat_id,
+                            "telegram_id": task.telegram_id,
+                            "club_id": task.club_id,
+                            "run_at": datetime.datetime.utcnow()
+                            + datetime.timedelta(seconds=CLEANUP_UNBAN_DELAY),
+                        }
+                    )
+            if finished_ids:
+                session.execute(
+                    delete(CleanupTask).where(CleanupTask.id.in_(finished_ids))
+                )
+            enqueue(session, unbans)
+            if retries:
+                session.execute(update(CleanupTask), retries)
+            session.commit()
+    if results:
+        logger.info("Очередь очистки разобрана: %s", dict(results))
+    return results
+
+
+# Через сколько секунд наступит ближайшее действие очереди (None, если она пуста)
+def seconds_until_next_task() -> Optional[float]:
+    with session_factory() as session:
+        run_at = session.execute(select(func.min(CleanupTask.run_at))).scalar()
+    if run_at is None:
+        return None
+    return max(0.0, (run_at - datetime.datetime.utcnow()).total_seconds())
+
+
+# Фоновый обработчик очереди очистки. Просыпается к ближайшему действию,
+# раз в interval секунд или по сигналу wake() после записи новых намерений.
+class CleanupWorker:
+    def __init__(
+        self, rate: float = CLEANUP_RATE, interval: float = CLEANUP_POLL_INTERVAL
+    ) -> None:
+        self.buckets = KeyedTokenBuckets(rate)
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, updaters) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return None
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(updaters,), name="cleanup-worker", daemon=True
+        )
+        self._thread.start()
+        return None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+        return None
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        return None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Ждём, пока обработчик зафиксирует текущую пачку и остановится
+    def join(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
+
+    def _run(self, updaters) -> None:
+        while not self._stop.is_set():
+            timeout = self.interval
+            try:
+                process_cleanup_queue(updaters, self.buckets)
+                next_task = seconds_until_next_task()
+                if next_task is not None:
+                    timeout = min(timeout, next_task)
+            except Exception as error:
+                logger.error("Ошибка при разборе очереди очистки: %s", error)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+        return None
+
+
+cleanup_worker = CleanupWorker()
@@ -0,0 +1,391 @@
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from types import SimpleNamespace
+from typing import Iterable
+
+# Модули проекта импортируются внутри команд: размер пачки JOB_BATCH_SIZE
+# читается из окружения при импорте constants, поэтому --batch-size
+# должен попасть в окружение раньше.
+
+# Задачи, которые можно выполнять в несколько потоков одновременно:
+# каждый поток забирает свою пачку событий через FOR UPDATE SKIP LOCKED
+PARALLEL_JOBS = {"handle_subscription_events"}
+
+
+def parse_shard(value: str) -> tuple:
+    index, _, count = value.partition("/")
+    if not (index.isdigit() and count.isdigit()) or not 0 <= int(index) < int(count):
+        raise argparse.ArgumentTypeError(
+            f"Ожидается номер/всего, например 0/4: {value}"
+        )
+    return int(index), int(count)
+
+
+# Бот клуба для запуска задач вне процесса бота. Пул соединений рассчитан
+# на параллельные потоки, иначе они ждут единственное соединение.
+def create_bot(connections: int, token: str):
+    from telegram import Bot
+    from telegram.utils.request import Request
+
+    from constants import TELEGRAM_API_URL
+
+    request = Request(
+        con_pool_size=connections + 4, connect_timeout=10, read_timeout=20
+    )
+    return Bot(token, base_url=TELEGRAM_API_URL, request=request)
+
+
+# Боты клубов для задач и рассылок, создаются при первом обращении
+def create_updaters(connections: int):
+    from clubs import ClubUpdaters
+
+    return ClubUpdaters(
+        lambda club: SimpleNamespace(bot=create_bot(connections, club.token))
+    )
+
+
+# Клуб из --club для выгрузок и выдачи подписок
+def selected_club(args):
+    from settings import settings
+
+    club = settings.club_by_slug(args.club)
+    if club is None:
+        raise SystemExit(f"Клуб {args.club} не найден")
+    return club
+
+
+# Условие шарда: строки, у которых id по модулю count равен index
+def shard_filter(column, shard):
+    from sqlalchemy import true
+
+    if shard is None:
+        return true()
+    index, count = shard
+    return column % count == index
+
+
+# Пишем строки потоково в CSV (или в stdout, если путь "-") либо в xlsx
+# в режиме write_only. Формат выбирается по расширению файла.
+# Возвращает количество записанных строк.
+def write_rows(output: str, title: str, headers: list, rows: Iterable) -> int:
+    if output.endswith(".xlsx"):
+        from exports import XlsxExport
+
+        export = XlsxExport()
+        count = export.add_rows(title, headers, rows)
+        export.save(output)
+        return count
+    count = 0
+    target = (
+        nullcontext(sys.stdout)
+        if output == "-"
+        else open(output, "w", encoding="utf-8", newline="")
+    )
+    with target as file:
+        writer = csv.writer(file)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+# Итог команды пишем в лог и в stderr (лог пишется только в файл,
+# а stdout может занимать выгрузка)
+def report(message: str, *args) -> None:
+    from utils import logger
+
+    logger.info(message, *args)
+    print(message % args, file=sys.stderr)
+    return None
+
+
+def run_migrate(args) -> None:
+    from database import migrate
+
+    migrate()
+    report("Схема базы данных обновлена")
+    return None
+
+
+# Запускаем задачи postponed_tasks так же, как планировщик бота, для всех
+# клубов. Разные задачи выполняются одновременно, не больше --parallel
+# потоков, задачи из PARALLEL_JOBS выполняются сразу в --parallel потоков.
+def run_jobs(args) -> None:
+    from job_estimates import JOB_ESTIMATES, estimate_jobs, format_estimate
+
+    unknown = [name for name in args.jobs if name not in JOB_ESTIMATES]
+    if unknown:
+        raise SystemExit(f"Неизвестные задачи: {', '.join(unknown)}")
+    if args.dry_run:
+        for estimate in estimate_jobs(args.jobs):
+            print(format_estimate(estimate))
+        return None
+    import postponed_tasks
+
+    updaters = create_updaters(args.parallel)
+    runs = []
+    for name in args.jobs:
+        runs += [name] * (args.parallel if name in PARALLEL_JOBS else 1)
+    with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        futures = {
+            pool.submit(getattr(postponed_tasks, name), updaters): name for name in runs
+        }
+        for future, name in futures.items():
+            future.result()
+            report("Задача %s выполнена", name)
+    return None
+
+
+def run_export_reviews(args) -> None:
+    import datetime
+
+    from sqlalchemy import select
+
+    from database import Review, User, read_only
+
+    club = selected_club(args)
+    query = (
+        select(
+            Review.created_at,
+            Review.review_text,
+            User.phone_number,
+            User.user_link,
+        )
+        .join(User)
+        .where(Review.club_id == club.id, shard_filter(Review.id, args.shard))
+        .order_by(Review.id)
+    )
+    if args.since:
+        query = query.where(
+            Review.created_at >= datetime.datetime.strptime(args.since, "%Y-%m-%d")
+        )
+    with read_only() as session:
+        rows = session.execute(query.execution_options(yield_per=args.batch_size))
+        count = write_rows(
+            args.output,
+            "Отзывы",
+            [
+                "Дата",
+                "Текст отзыва",
+                "Телефонный номер",
+                "Ссылка на телеграм аккаунт",
+            ],
+            rows,
+        )
+    report("Выгружено отзывов: %s в %s", count, args.output)
+    return None
+
+
+# Пользователи с периодами подписок. С --membership для каждой пачки
+# участие в канале и чате проверяется в --parallel потоков.
+def run_export_users(args) -> None:
+    from sqlalchemy import func, literal, select
+    from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+    from database import Subscription, User, read_only
+    from utils import check_user_in_channel
+
+    club = selected_club(args)
+    period = (
+        func.to_char(Subscription.start_datetime, "DD.MM.YYYY")
+        + "-"
+        + func.to_char(Subscription.end_datetime, "DD.MM.YYYY")
+    )
+    query = (
+        select(
+            User.telegram_id,
+            User.phone_number,
+            User.user_link,
+            func.string_agg(
+                period, aggregate_order_by(literal(", "), Subscription.start_datetime)
+            ),
+        )
+        .outerjoin(Subscription, Subscription.user_id == User.id)
+        .where(User.club_id == club.id, shard_filter(User.id, args.shard))
+        .group_by(User.id)
+        .order_by(User.id)
+    )
+    headers = [
+        "Телеграм ID",
+        "Телефонный номер",
+        "Ссылка на телеграм аккаунт",
+        "Подписки",
+    ]
+    if args.membership:
+        headers += ["В канале", "В чате"]
+        if not club.token:
+            raise SystemExit(f"У клуба {club.slug} не задан токен бота")
+        context = SimpleNamespace(bot=create_bot(args.parallel, club.token))
+        channel_id, chat_id = club.channel_id, club.chat_id
+
+        def membership(row) -> tuple:
+            telegram_id = row[0]
+            if not telegram_id:
+                return tuple(row) + (False, False)
+            return tuple(row) + (
+                bool(check_user_in_channel(context, telegram_id, channel_id)),
+                bool(check_user_in_channel(context, telegram_id, chat_id)),
+            )
+
+    with read_only() as session:
+        result = session.execute(query.execution_options(yield_per=args.batch_size))
+
+        def rows():
+            if not args.membership:
+                yield from result
+                return
+            with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+                for batch in result.partitions():
+                    yield from pool.map(membership, batch)
+
+        count = write_rows(args.output, "Пользователи", headers, rows())
+    report("Выгружено пользователей: %s в %s", count, args.output)
+    return None
+
+
+def read_phone_numbers(args) -> list:
+    phone_numbers = list(args.phone_numbers)
+    if args.file:
+        with open(args.file, encoding="utf-8-sig", newline="") as file:
+            phone_numbers += [row[0] for row in csv.reader(file) if row and row[0]]
+    if args.shard:
+        index, count = args.shard
+        phone_numbers = phone_numbers[index::count]
+    return phone_numbers
+
+
+# Массовая выдача подписок, как /give_free_subscription, но для списка
+# номеров из файла. Все оплаты применяются одной транзакцией пачками
+# по --batch-size номеров.
+def run_give_subscriptions(args) -> None:
+    from utils import update_subscriptions
+
+    phone_numbers = read_phone_numbers(args)
+    if not phone_numbers:
+        raise SystemExit("Не указаны номера телефонов")
+    stats = update_subscriptions(
+        [
+            (args.months, phone_number, args.start_month, args.start_year, "-")
+            for phone_number in phone_numbers
+        ],
+        selected_club(args).id,
+    )
+    report("Выдача подписок: %s", dict(stats))
+    return None
+
+
+# Продолжаем прерванную рассылку ботом её клуба с неотправленных получателей
+def run_broadcast_resume(args) -> None:
+    from broadcast import run_broadcast
+    from database import Broadcast, read_only
+
+    with read_only() as session:
+        broadcast = session.get(Broadcast, args.broadcast_id)
+        club_id = broadcast.club_id if broadcast else None
+    if club_id is None:
+        raise SystemExit(f"Рассылка {args.broadcast_id} не найдена")
+    run_broadcast(create_updaters(1).bot(club_id), args.broadcast_id)
+    return None
+
+
+def run_broadcast_status(args) -> None:
+    from broadcast import broadcast_status
+    from database import read_only
+
+    with read_only() as session:
+        statuses = broadcast_status(session, args.broadcast_id)
+    if not statuses:
+        raise SystemExit(f"Рассылка {args.broadcast_id} не найдена")
+    for status, count in sorted(statuses.items()):
+        print(f"{status}: {count}")
+    return None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Задачи, выгрузки и массовые операции без процесса бота"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(os.getenv("JOB_BATCH_SIZE", 500)),
+        help="Размер пачки чтения и записи (JOB_BATCH_SIZE)",
+    )
+    parser.add_argument("--parallel", type=int, default=1, help="Количество потоков")
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Обработать только часть строк: номер/всего, например 0/4",
+    )
+    parser.add_argument(
+        "--club",
+        default="default",
+        help="Клуб для выгрузок и выдачи подписок (slug из таблицы clubs)",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="Обновить схему БД")
+    migrate_parser.set_defaults(handler=run_migrate)
+
+    job_parser = commands.add_parser("job", help="Выполнить отложенные задачи")
+    job_parser.add_argument("jobs", nargs="+")
+    job_parser.add_argument(
+        "--dry-run", action="store_true", help="Только оценка задач"
+    )
+    job_parser.set_defaults(handler=run_jobs)
+
+    export_parser = commands.add_parser("export", help="Выгрузить в CSV или xlsx")
+    exports = export_parser.add_subparsers(dest="export", required=True)
+    reviews_parser = exports.add_parser("reviews", help="Отзывы")
+    reviews_parser.add_argument("--output", required=True)
+    reviews_parser.add_argument("--since", help="Начиная с даты год-месяц-день")
+    reviews_parser.set_defaults(handler=run_export_reviews)
+    users_parser = exports.add_parser("users", help="Пользователи и подписки")
+    users_parser.add_argument("--output", required=True)
+    users_parser.add_argument(
+        "--membership",
+        action="store_true",
+        help="Проверить участие в канале и чате через Bot API",
+    )
+    users_parser.set_defaults(handler=run_export_users)
+
+    subscriptions_parser = commands.add_parser("subscriptions", help="Подписки")
+    subscriptions = subscriptions_parser.add_subparsers(
+        dest="subscriptions", required=True
+    )
+    give_parser = subscriptions.add_parser("give", help="Выдать подписки")
+    give_parser.add_argument("phone_numbers", nargs="*")
+    give_parser.add_argument("--file", help="CSV с номерами в первом столбце")
+    give_parser.add_argument("--months", type=int, required=True)
+    give_parser.add_argument("--start-month", type=int, required=True)
+    give_parser.add_argument("--start-year", type=int, required=True)
+    give_parser.set_defaults(handler=run_give_subscriptions)
+
+    broadcast_parser = commands.add_parser("broadcast", help="Рассылки")
+    broadcasts = broadcast_parser.add_subparsers(dest="broadcast", required=True)
+    resume_parser = broadcasts.add_parser("resume", help="Продолжить рассылку")
+    resume_parser.add_argument("broadcast_id", type=int)
+    resume_parser.set_defaults(handler=run_broadcast_resume)
+    status_parser = broadcasts.add_parser("status", help="Статус рассылки")
+    status_parser.add_argument("broadcast_id", type=int)
+    status_parser.set_defaults(handler=run_broadcast_status)
+    return parser
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    if args.batch_size < 1 or args.parallel < 1:
+        raise SystemExit("--batch-size и --parallel должны быть положительными")
+    os.environ["JOB_BATCH_SIZE"] = str(args.batch_size)
+    args.handler(args)
+    return None
+
+
+# python cli.py [--batch-size N] [--parallel N] [--shard I/N] [--club SLUG] команда ...
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from typing import Callable, Optional
+
+from telegram.ext import CallbackContext
+
+from constants import CLUB_JOB_WORKERS, DEFAULT_CLUB_ID
+from settings import ClubConfig, settings
+from utils import logger
+
+
+# Клуб, бот которого получил обновление. Диспетчер каждого клуба
+# хранит id клуба в bot_data (см. фабрику Updater в main.py)
+def context_club(context: CallbackContext) -> ClubConfig:
+    return settings.club(context.bot_data.get("club_id", DEFAULT_CLUB_ID))
+
+
+# Клубы, у которых есть свой бот
+def clubs_with_bots() -> list:
+    return [club for club in settings.clubs if club.token]
+
+
+# Сколько строк очереди забирать за раз для каждого клуба, чтобы пачка
+# из limit строк делилась между клубами поровну
+def club_share(limit: int) -> int:
+    return max(1, limit // max(1, len(settings.clubs)))
+
+
+# Чередуем строки пачки по клубам (у строк есть club_id): сначала первая
+# строка каждого клуба, затем вторая и т.д. Порядок внутри клуба сохраняется,
+# поэтому очередь одного клуба не задерживает остальные.
+def interleave_by_club(rows: list) -> list:
+    by_club = {}
+    for row in rows:
+        by_club.setdefault(row.club_id, []).append(row)
+    return [
+        row
+        for group in zip_longest(*by_club.values())
+        for row in group
+        if row is not None
+    ]
+
+
+# Updater каждого клуба процесса (или объект с атрибутом bot для задач
+# вне процесса бота). Создаётся фабрикой factory(club) при первом
+# обращении и переиспользуется. Смена токена клуба вступает в силу
+# после перезапуска процесса.
+class ClubUpdaters:
+    def __init__(self, factory: Optional[Callable] = None) -> None:
+        self.factory = factory
+        self._updaters = {}
+        self._lock = threading.Lock()
+
+    def get(self, club_id: int):
+        updater = self._updaters.get(club_id)
+        if updater is None:
+            with self._lock:
+                updater = self._updaters.get(club_id)
+                if updater is None:
+                    club = settings.club(club_id)
+                    if not club.token:
+                        raise ValueError(f"У клуба {club.slug} не задан токен бота")
+                    updater = self._updaters[club_id] = self.factory(club)
+        return updater
+
+    def bot(self, club_id: int):
+        return self.get(club_id).bot
+
+    # Уже созданные Updater по id клуба
+    def created(self) -> dict:
+        with self._lock:
+            return dict(self._updaters)
+
+
+# Реестр процесса бота, фабрику задаёт main.py
+club_updaters = ClubUpdaters()
+
+
+# Выполняем job(bot, club, *args) для каждого клуба с ботом, одновременно
+# не больше CLUB_JOB_WORKERS клубов. У каждого бота свои ограничения
+# Telegram, поэтому большой клуб не задерживает рассылки остальных.
+# Ошибка в одном клубе не прерывает задачу в других.
+def for_each_club(updaters: ClubUpdaters, job: Callable, *args) -> None:
+    clubs = clubs_with_bots()
+    if not clubs:
+        return None
+    futures = {}
+    with ThreadPoolExecutor(
+        max_workers=min(CLUB_JOB_WORKERS, len(clubs)),
+        thread_name_prefix=f"{job.__name__}",
+    ) as pool:
+        for club in clubs:
+            try:
+                bot = updaters.bot(club.id)
+            except Exception as error:
+                logger.error("Бот клуба %s не создан: %s", club.slug, error)
+                continue
+            futures[club] = pool.submit(job, bot, club, *args)
+    for club, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            logger.error("Ошибка %s в клубе %s: %s", job.__name__, club.slug, error)
+    return None
@@ -1,5 +1,4 @@
 import os
-import re
 
 import pytz
 from dotenv import load_dotenv
@@ -10,17 +9,103 @@ PAYMENT_KEY = os.getenv("PAYMENT_KEY")
 TOKEN = os.getenv("TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")  # ID вашего канала
 CHAT_ID = os.getenv("CHAT_ID")  # ID вашего чата-болталки
-PHONE_NUMBER_REGEX = re.compile(r"^\+[1-9]\d{1,14}$")
+# ID закрытого чата, куда публикуются материалы рассылок для копирования
+STAGING_CHAT_ID = os.getenv("STAGING_CHAT_ID")
+# Клуб, который создаётся миграцией. TOKEN, CHANNEL_ID, CHAT_ID
+# и STAGING_CHAT_ID - его бот, канал и чаты, если они не заданы в таблице clubs
+DEFAULT_CLUB_ID = 1
+DEFAULT_CLUB_SLUG = "default"
+# Сколько клубов одна отложенная задача обрабатывает одновременно
+CLUB_JOB_WORKERS = int(os.getenv("CLUB_JOB_WORKERS", 4))
 MOSCOW_TZ = pytz.timezone("Europe/Moscow")
-MODERATOR_IDS = {436665993, 270966498}
+# Модераторы по умолчанию, пока реестр модераторов в БД и в файле настроек пуст
+MODERATOR_IDS = {
+    int(moderator_id)
+    for moderator_id in os.getenv("MODERATOR_IDS", "436665993,270966498").split(",")
+}
+# JSON-файл с настройками и модераторами, перекрывает переменные окружения
+SETTINGS_FILE = os.getenv("SETTINGS_FILE")
+# Как часто (в секундах) настройки перечитываются без уведомления от БД
+SETTINGS_REFRESH_INTERVAL = float(os.getenv("SETTINGS_REFRESH_INTERVAL", 30))
 USERNAME_DB = os.getenv("USERNAME_DB")
 PASSWORD_DB = os.getenv("PASSWORD_DB")
 HOST_DB = os.getenv("HOST_DB")
 PORT_DB = os.getenv("PORT_DB")
 NAME_DB = os.getenv("NAME_DB")
+# Реплика только для чтения (выгрузки и списки получателей рассылок).
+# Без REPLICA_HOST_DB все запросы идут в основную БД.
+REPLICA_HOST_DB = os.getenv("REPLICA_HOST_DB")
+REPLICA_PORT_DB = os.getenv("REPLICA_PORT_DB", PORT_DB)
+# Если реплика отстаёт больше чем на столько секунд, читаем из основной БД
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 30))
+# Как часто (в секундах) перепроверяем отставание реплики
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", 5))
 DOMAIN = os.getenv("DOMAIN")
 TELEGRAM_WEBHOOK = os.getenv("TELEGRAM_WEBHOOK")
+# Адрес Bot API, можно подменить локальным сервером для нагрузочных тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 PAYMENT_WEBHOOK = os.getenv("PAYMENT_WEBHOOK")
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 50 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 14))
+# Не больше LOG_SAMPLE_RATE одинаковых INFO-записей за LOG_SAMPLE_PERIOD секунд
+LOG_SAMPLE_RATE = int(os.getenv("LOG_SAMPLE_RATE", 100))
+LOG_SAMPLE_PERIOD = float(os.getenv("LOG_SAMPLE_PERIOD", 60))
+# Доля вызовов обработчиков и задач, для которых профилируются SQL-запросы
+QUERY_PROFILE_SAMPLE_RATE = float(os.getenv("QUERY_PROFILE_SAMPLE_RATE", 0))
+# Сколько одинаковых запросов за вызов считать признаком N+1
+QUERY_PROFILE_REPEAT_THRESHOLD = int(os.getenv("QUERY_PROFILE_REPEAT_THRESHOLD", 5))
+# Размер пачки строк, которые отложенные задачи читают и записывают за раз
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 500))
+# Выгрузки xlsx крупнее этого размера (в байтах) пишутся во временный файл на диске
+EXPORT_SPOOL_MAX_SIZE = int(os.getenv("EXPORT_SPOOL_MAX_SIZE", 10 * 1024 * 1024))
+# Сколько сообщений в секунду отправляет рассылка (лимит Telegram около 30)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+# Оценка длительности отложенных задач (job_estimates.py): сколько сообщений
+# в секунду пропускает Telegram и сколько секунд в среднем занимает запрос к Bot API
+TELEGRAM_MESSAGE_RATE = float(os.getenv("TELEGRAM_MESSAGE_RATE", 30))
+TELEGRAM_API_LATENCY = float(os.getenv("TELEGRAM_API_LATENCY", 0.1))
+# После стольких сетевых ошибок Bot API подряд запросы к нему не выполняются
+# TELEGRAM_BREAKER_RESET секунд (ответ как при flood control), затем
+# пропускается один пробный запрос
+TELEGRAM_BREAKER_FAILURES = int(os.getenv("TELEGRAM_BREAKER_FAILURES", 5))
+TELEGRAM_BREAKER_RESET = float(os.getenv("TELEGRAM_BREAKER_RESET", 30))
+# На сколько секунд кэшируется отчёт /healthz и /readyz
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", 1))
+# Сколько раз в секунду и сколько раз подряд один пользователь
+# может запросить ссылку, лишние нажатия отбрасываются
+USER_ACTION_RATE = float(os.getenv("USER_ACTION_RATE", 0.2))
+USER_ACTION_BURST = float(os.getenv("USER_ACTION_BURST", 2))
+# Сколько действий очереди очистки (отзыв ссылки, бан, разбан) выполняется в секунду
+CLEANUP_RATE = float(os.getenv("CLEANUP_RATE", 20))
+# Через сколько секунд после исключения участник разбанивается,
+# чтобы он мог вернуться по новой ссылке
+CLEANUP_UNBAN_DELAY = float(os.getenv("CLEANUP_UNBAN_DELAY", 1))
+# Сколько раз повторяем действие очереди очистки, прежде чем отказаться от него
+CLEANUP_MAX_ATTEMPTS = int(os.getenv("CLEANUP_MAX_ATTEMPTS", 5))
+# Как часто (в секундах) очередь очистки проверяется без явного сигнала
+CLEANUP_POLL_INTERVAL = float(os.getenv("CLEANUP_POLL_INTERVAL", 10))
+# События подписок (приглашение, напоминания, окончание) срабатывают
+# не в одну минуту для всех, а в окне из стольких секунд после
+# своего времени. Сдвиг каждой подписки постоянный и зависит от её id.
+LIFECYCLE_SPREAD = int(os.getenv("LIFECYCLE_SPREAD", 3 * 60 * 60))
+# Через сколько секунд после окончания подписки участник исключается
+LIFECYCLE_EXPIRE_DELAY = int(os.getenv("LIFECYCLE_EXPIRE_DELAY", 18 * 60 * 60 + 600))
+# За сколько дней до окончания подписки отправляется первое напоминание о продлении
+LIFECYCLE_RENEW_REMINDER_DAYS = int(os.getenv("LIFECYCLE_RENEW_REMINDER_DAYS", 6))
+# Напоминания, опоздавшие больше чем на столько секунд, не отправляются
+LIFECYCLE_MAX_DELAY = int(os.getenv("LIFECYCLE_MAX_DELAY", 24 * 60 * 60))
+# Сколько событий подписок в секунду обрабатывается (каждое - сообщение в Telegram)
+LIFECYCLE_RATE = float(os.getenv("LIFECYCLE_RATE", 20))
+# Сколько раз повторяем событие после ошибки, прежде чем отказаться от него
+LIFECYCLE_MAX_ATTEMPTS = int(os.getenv("LIFECYCLE_MAX_ATTEMPTS", 5))
+# Как часто (в секундах) проверяются наступившие события подписок
+LIFECYCLE_POLL_INTERVAL = int(os.getenv("LIFECYCLE_POLL_INTERVAL", 30))
+# Сколько секунд после SIGTERM ждём текущие обработчики и задачи.
+# Должно быть меньше срока, после которого процесс убивают (SIGKILL).
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 25))
 MONTHS = {
     1: ("январь", 31),
     2: ("февраль", 28),
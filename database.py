@@ -1,27 +1,89 @@
-from datetime import datetime
+import logging
+import threading
+import time
+from datetime import date, datetime
+from typing import Optional
 
 from sqlalchemy import (
+    ARRAY,
     BigInteger,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    JSON,
     String,
     create_engine,
+    event,
+    text,
 )
+from sqlalchemy.orm import Session as OrmSession
 from sqlalchemy.orm import declarative_base, relationship, scoped_session, sessionmaker
 
-from constants import HOST_DB, NAME_DB, PASSWORD_DB, PORT_DB, USERNAME_DB
+from constants import (
+    DEFAULT_CLUB_ID,
+    DEFAULT_CLUB_SLUG,
+    HOST_DB,
+    LIFECYCLE_EXPIRE_DELAY,
+    LIFECYCLE_RENEW_REMINDER_DAYS,
+    LIFECYCLE_SPREAD,
+    NAME_DB,
+    PASSWORD_DB,
+    PORT_DB,
+    QUERY_PROFILE_SAMPLE_RATE,
+    REPLICA_HOST_DB,
+    REPLICA_LAG_CHECK_INTERVAL,
+    REPLICA_MAX_LAG,
+    REPLICA_PORT_DB,
+    USERNAME_DB,
+)
+from query_profiler import install as install_query_profiler
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 
+# Клуб: свой бот, канал и чат-болталка. Пустые поля клуба по умолчанию
+# берутся из настроек и переменных окружения (settings.py)
+class Club(Base):
+    __tablename__ = "clubs"
+
+    id = Column(Integer, primary_key=True)
+    slug = Column(String, unique=True, nullable=False)
+    name = Column(String, nullable=True)
+    token = Column(String, nullable=True)
+    channel_id = Column(String, nullable=True)
+    chat_id = Column(String, nullable=True)
+    staging_chat_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+def club_id_column(**kwargs) -> Column:
+    return Column(
+        Integer,
+        ForeignKey("clubs.id"),
+        nullable=False,
+        server_default=str(DEFAULT_CLUB_ID),
+        **kwargs,
+    )
+
+
+# Номер телефона и телеграм id уникальны в пределах клуба:
+# один человек может состоять в нескольких клубах
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ux_users_club_phone_number", "club_id", "phone_number", unique=True),
+        Index("ux_users_club_telegram_id", "club_id", "telegram_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(BigInteger, unique=True, nullable=True)
-    phone_number = Column(String, unique=True, nullable=False)
+    club_id = club_id_column()
+    telegram_id = Column(BigInteger, nullable=True)
+    phone_number = Column(String, nullable=False)
     user_link = Column(String, nullable=True)
 
     subscriptions = relationship(
@@ -40,7 +102,11 @@ class Subscription(Base):
     end_datetime = Column(DateTime, nullable=False)
     subscription_link = Column(String, nullable=True)
     chat_link = Column(String, nullable=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # Клуб пользователя, проставляется триггером subscriptions_club
+    club_id = club_id_column(index=True)
+    # До какого времени ссылки подписки создаёт захвативший их вызов
+    links_claimed_until = Column(DateTime, nullable=True)
 
     user = relationship("User", back_populates="subscriptions")
 
@@ -52,17 +118,676 @@ class Review(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     review_text = Column(String, nullable=False)
+    # Клуб пользователя, проставляется триггером reviews_club
+    club_id = club_id_column(index=True)
 
     user = relationship("User", back_populates="reviews")
 
 
-# Создание соединения с базой данных PostgreSQL
+# Клуб по умолчанию, клуб в уже существующих таблицах и уникальность
+# номера и телеграм id в пределах клуба. Столбцы club_id объявлены
+# и в моделях, здесь они добавляются в таблицы, созданные до клубов:
+# все прежние данные принадлежат клубу по умолчанию.
+CLUBS_SQL = f"""
+INSERT INTO clubs (id, slug, created_at)
+    VALUES ({DEFAULT_CLUB_ID}, '{DEFAULT_CLUB_SLUG}', now() AT TIME ZONE 'utc')
+    ON CONFLICT (id) DO NOTHING;
+SELECT setval(pg_get_serial_sequence('clubs', 'id'), GREATEST(MAX(id), 1)) FROM clubs;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_phone_number_key;
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_telegram_id_key;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_users_club_phone_number
+    ON users (club_id, phone_number);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_users_club_telegram_id
+    ON users (club_id, telegram_id);
+
+ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+CREATE INDEX IF NOT EXISTS ix_subscriptions_club_id ON subscriptions (club_id);
+ALTER TABLE reviews ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+CREATE INDEX IF NOT EXISTS ix_reviews_club_id ON reviews (club_id);
+ALTER TABLE cohort_members ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID};
+ALTER TABLE subscription_events ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID};
+CREATE INDEX IF NOT EXISTS ix_subscription_events_club_due_at
+    ON subscription_events (club_id, due_at);
+ALTER TABLE cleanup_tasks ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+CREATE INDEX IF NOT EXISTS ix_cleanup_tasks_club_run_at
+    ON cleanup_tasks (club_id, run_at);
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+ALTER TABLE failed_payments ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+
+-- Отметка о выгрузке отзывов ведётся отдельно для каждого клуба
+ALTER TABLE review_exports ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+DO $$
+BEGIN
+    IF (SELECT array_length(conkey, 1) FROM pg_constraint
+        WHERE conname = 'review_exports_pkey') = 1 THEN
+        ALTER TABLE review_exports DROP CONSTRAINT review_exports_pkey,
+            ADD PRIMARY KEY (moderator_id, club_id);
+    END IF;
+END $$;
+
+-- Модераторы назначаются в каждом клубе отдельно, прежние остаются
+-- модераторами клуба по умолчанию
+ALTER TABLE moderators ADD COLUMN IF NOT EXISTS club_id integer NOT NULL
+    DEFAULT {DEFAULT_CLUB_ID} REFERENCES clubs (id);
+DO $$
+BEGIN
+    IF (SELECT array_length(conkey, 1) FROM pg_constraint
+        WHERE conname = 'moderators_pkey') = 1 THEN
+        ALTER TABLE moderators DROP CONSTRAINT moderators_pkey,
+            ADD PRIMARY KEY (club_id, telegram_id);
+    END IF;
+END $$;
+
+-- Подписки и отзывы всегда в клубе своего пользователя
+CREATE OR REPLACE FUNCTION inherit_user_club() RETURNS trigger AS $$
+BEGIN
+    SELECT club_id INTO NEW.club_id FROM users WHERE id = NEW.user_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subscriptions_club ON subscriptions;
+CREATE TRIGGER subscriptions_club
+    BEFORE INSERT OR UPDATE OF user_id ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION inherit_user_club();
+
+DROP TRIGGER IF EXISTS reviews_club ON reviews;
+CREATE TRIGGER reviews_club
+    BEFORE INSERT OR UPDATE OF user_id ON reviews
+    FOR EACH ROW EXECUTE FUNCTION inherit_user_club();
+"""
+
+
+# Выполняется первым из обработчиков after_create: триггеры и функции
+# ниже обращаются к club_id
+@event.listens_for(Base.metadata, "after_create")
+def create_clubs(target, connection, **kwargs) -> None:
+    connection.execute(text(CLUBS_SQL))
+    return None
+
+
+# Аренда права на создание ссылок подписки (invite_links)
+SUBSCRIPTION_LINKS_SQL = """
+ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS links_claimed_until timestamp;
+"""
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_subscription_links(target, connection, **kwargs) -> None:
+    connection.execute(text(SUBSCRIPTION_LINKS_SQL))
+    return None
+
+
+class ReviewExport(Base):
+    __tablename__ = "review_exports"
+
+    # Телеграм id модератора и id последнего выгруженного им отзыва клуба
+    moderator_id = Column(BigInteger, primary_key=True)
+    club_id = Column(Integer, ForeignKey("clubs.id"), primary_key=True)
+    last_review_id = Column(Integer, nullable=False)
+    exported_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Конфигурация полнотекстового поиска по отзывам: russian разбирает
+# кириллицу русским стеммером, а латиницу - английским
+REVIEW_SEARCH_CONFIG = "russian"
+
+
+# Сколько отзывов за месяц содержат основу слова, поддерживается триггером
+class ReviewKeyword(Base):
+    __tablename__ = "review_keywords"
+
+    period = Column(Date, primary_key=True)
+    lexeme = Column(String, primary_key=True)
+    reviews = Column(Integer, nullable=False)
+
+
+REVIEW_SEARCH_SQL = f"""
+CREATE INDEX IF NOT EXISTS reviews_search_idx ON reviews
+    USING GIN (to_tsvector('{REVIEW_SEARCH_CONFIG}'::regconfig, review_text));
+
+CREATE OR REPLACE FUNCTION review_keywords_add(
+    p_text text, p_created_at timestamp, p_delta integer
+) RETURNS void AS $$
+DECLARE
+    v_period date := date_trunc('month', COALESCE(p_created_at, now()))::date;
+BEGIN
+    INSERT INTO review_keywords (period, lexeme, reviews)
+    SELECT v_period, lexeme, p_delta
+    FROM unnest(to_tsvector('{REVIEW_SEARCH_CONFIG}'::regconfig, p_text))
+    WHERE length(lexeme) > 2 AND lexeme !~ '^[0-9]+$'
+    ON CONFLICT (period, lexeme)
+        DO UPDATE SET reviews = review_keywords.reviews + EXCLUDED.reviews;
+    IF p_delta < 0 THEN
+        DELETE FROM review_keywords WHERE period = v_period AND reviews <= 0;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION reviews_refresh_keywords() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM review_keywords_add(OLD.review_text, OLD.created_at, -1);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM review_keywords_add(NEW.review_text, NEW.created_at, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reviews_keywords ON reviews;
+CREATE TRIGGER reviews_keywords
+    AFTER INSERT OR DELETE OR UPDATE OF review_text, created_at ON reviews
+    FOR EACH ROW EXECUTE FUNCTION reviews_refresh_keywords();
+"""
+
+
+# Создаём индекс поиска и триггер ключевых слов, а при первом
+# создании таблицы ключевых слов заполняем её по уже существующим отзывам
+@event.listens_for(Base.metadata, "after_create")
+def create_review_search(target, connection, tables=(), **kwargs) -> None:
+    connection.execute(text(REVIEW_SEARCH_SQL))
+    if ReviewKeyword.__table__ in tables:
+        connection.execute(
+            text("SELECT review_keywords_add(review_text, created_at, 1) FROM reviews")
+        )
+    return None
+
+
+# Когорты пользователей для напоминаний, поддерживаются триггерами в БД:
+# renewing - подписка заканчивается в день period,
+# subscribed - есть хотя бы одна подписка, lapsed - подписок нет
+COHORT_RENEWING = "renewing"
+COHORT_SUBSCRIBED = "subscribed"
+COHORT_LAPSED = "lapsed"
+# period для когорт, не привязанных к дате
+COHORT_ANY_PERIOD = date(1970, 1, 1)
+
+
+class CohortMember(Base):
+    __tablename__ = "cohort_members"
+
+    cohort = Column(String, primary_key=True)
+    period = Column(Date, primary_key=True)
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    telegram_id = Column(BigInteger, nullable=True)
+    club_id = Column(Integer, nullable=False, server_default=str(DEFAULT_CLUB_ID))
+
+
+COHORT_TRIGGERS_SQL = f"""
+-- Триггеры ищут подписки и когорты пользователя по user_id. Индексы
+-- объявлены и в моделях, здесь они создаются в уже существующих таблицах.
+CREATE INDEX IF NOT EXISTS ix_subscriptions_user_id ON subscriptions (user_id);
+CREATE INDEX IF NOT EXISTS ix_cohort_members_user_id ON cohort_members (user_id);
+
+CREATE OR REPLACE FUNCTION refresh_user_cohorts(p_user_id integer) RETURNS void AS $$
+BEGIN
+    DELETE FROM cohort_members WHERE user_id = p_user_id;
+    INSERT INTO cohort_members (cohort, period, user_id, telegram_id, club_id)
+    SELECT DISTINCT
+        '{COHORT_RENEWING}', s.end_datetime::date, u.id, u.telegram_id, u.club_id
+    FROM subscriptions s JOIN users u ON u.id = s.user_id
+    WHERE s.user_id = p_user_id;
+    INSERT INTO cohort_members (cohort, period, user_id, telegram_id, club_id)
+    SELECT
+        CASE WHEN EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = u.id)
+            THEN '{COHORT_SUBSCRIBED}' ELSE '{COHORT_LAPSED}' END,
+        DATE '{COHORT_ANY_PERIOD.isoformat()}', u.id, u.telegram_id, u.club_id
+    FROM users u WHERE u.id = p_user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION subscriptions_refresh_cohorts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM refresh_user_cohorts(OLD.user_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.user_id <> OLD.user_id) THEN
+        PERFORM refresh_user_cohorts(NEW.user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION users_refresh_cohorts() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_user_cohorts(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subscriptions_cohorts ON subscriptions;
+CREATE TRIGGER subscriptions_cohorts
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, end_datetime ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION subscriptions_refresh_cohorts();
+
+DROP TRIGGER IF EXISTS users_cohorts ON users;
+CREATE TRIGGER users_cohorts
+    AFTER INSERT OR UPDATE OF telegram_id ON users
+    FOR EACH ROW EXECUTE FUNCTION users_refresh_cohorts();
+"""
+
+
+# Создаём триггеры когорт после создания таблиц, а при первом
+# создании таблицы когорт заполняем её по уже существующим данным
+@event.listens_for(Base.metadata, "after_create")
+def create_cohort_triggers(target, connection, tables=(), **kwargs) -> None:
+    connection.execute(text(COHORT_TRIGGERS_SQL))
+    if CohortMember.__table__ in tables:
+        connection.execute(text("SELECT refresh_user_cohorts(id) FROM users"))
+    return None
+
+
+# Статусы доставки рассылки конкретному получателю
+DELIVERY_PENDING = "pending"
+DELIVERY_SENT = "sent"
+DELIVERY_BLOCKED = "blocked"
+DELIVERY_FAILED = "failed"
+
+
+# Рассылка: сообщения из закрытого чата, которые копируются
+# или пересылаются всем получателям
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True)
+    mode = Column(String, nullable=False)
+    audience = Column(String, nullable=False)
+    from_chat_id = Column(BigInteger, nullable=False)
+    message_ids = Column(ARRAY(Integer), nullable=False)
+    created_by = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    club_id = club_id_column()
+
+
+# Статус доставки рассылки каждому получателю
+class BroadcastDelivery(Base):
+    __tablename__ = "broadcast_deliveries"
+
+    broadcast_id = Column(
+        Integer, ForeignKey("broadcasts.id", ondelete="CASCADE"), primary_key=True
+    )
+    telegram_id = Column(BigInteger, primary_key=True)
+    status = Column(String, nullable=False, server_default=DELIVERY_PENDING)
+    error = Column(String, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+
+
+# Настройки, которые можно менять без перезапуска бота
+class Setting(Base):
+    __tablename__ = "settings"
+
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Реестр модераторов: модератор управляет только своим клубом
+class Moderator(Base):
+    __tablename__ = "moderators"
+
+    club_id = club_id_column(primary_key=True)
+    telegram_id = Column(BigInteger, primary_key=True)
+    added_by = Column(BigInteger, nullable=True)
+    added_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Канал уведомлений Postgres об изменении настроек, модераторов и клубов
+SETTINGS_CHANNEL = "settings_changed"
+SETTINGS_TRIGGERS_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_settings_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{SETTINGS_CHANNEL}', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS settings_changed ON settings;
+CREATE TRIGGER settings_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+
+DROP TRIGGER IF EXISTS moderators_changed ON moderators;
+CREATE TRIGGER moderators_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON moderators
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+
+DROP TRIGGER IF EXISTS clubs_changed ON clubs;
+CREATE TRIGGER clubs_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON clubs
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+"""
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_settings_triggers(target, connection, **kwargs) -> None:
+    connection.execute(text(SETTINGS_TRIGGERS_SQL))
+    return None
+
+
+# Действия очереди отложенной очистки в Telegram
+CLEANUP_REVOKE_LINK = "revoke_link"
+CLEANUP_BAN = "ban"
+CLEANUP_UNBAN = "unban"
+
+
+# Очередь отложенной очистки: отзыв ссылок и исключение участников.
+# Намерения записываются в той же транзакции, что и изменение в БД,
+# а выполняются фоновым обработчиком не раньше run_at.
+class CleanupTask(Base):
+    __tablename__ = "cleanup_tasks"
+    __table_args__ = (Index("ix_cleanup_tasks_club_run_at", "club_id", "run_at"),)
+
+    id = Column(Integer, primary_key=True)
+    action = Column(String, nullable=False)
+    chat_id = Column(String, nullable=False)
+    telegram_id = Column(BigInteger, nullable=True)
+    invite_link = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    run_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Клуб, чей бот выполняет действие
+    club_id = club_id_column()
+
+
+# Уведомления Tilda, которые не удалось обработать. Тело сохраняется
+# целиком, чтобы оплату можно было применить повторно (reconciliation.py).
+class FailedPayment(Base):
+    __tablename__ = "failed_payments"
+
+    id = Column(Integer, primary_key=True)
+    body = Column(JSON, nullable=False)
+    error = Column(String, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    resolved_at = Column(DateTime, nullable=True, index=True)
+    club_id = club_id_column()
+
+
+# Журнал применённых оплат: номер и оплаченный период. Сверка не применяет
+# оплату из журнала повторно, даже если её подписка уже истекла и удалена
+# или объединена с соседними.
+class AppliedPayment(Base):
+    __tablename__ = "applied_payments"
+
+    club_id = club_id_column(primary_key=True)
+    phone_number = Column(String, primary_key=True)
+    start_datetime = Column(DateTime, primary_key=True)
+    end_datetime = Column(DateTime, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+# События жизненного цикла подписки
+EVENT_PERIOD_START = "period_start"
+EVENT_JOIN_REMINDER_1 = "join_reminder_1"
+EVENT_JOIN_REMINDER_2 = "join_reminder_2"
+EVENT_RENEW_REMINDER_1 = "renew_reminder_1"
+EVENT_RENEW_REMINDER_2 = "renew_reminder_2"
+EVENT_EXPIRE = "expire"
+
+
+# Ближайшие события каждой подписки: не больше одного события каждого вида.
+# due_at хранится в том же местном времени, что и даты подписок.
+# События по датам подписки ставит и переносит триггер subscriptions_events,
+# напоминания о вступлении ставит обработчик начала периода.
+class SubscriptionEvent(Base):
+    __tablename__ = "subscription_events"
+    __table_args__ = (Index("ix_subscription_events_club_due_at", "club_id", "due_at"),)
+
+    subscription_id = Column(
+        Integer,
+        ForeignKey("subscriptions.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    kind = Column(String, primary_key=True)
+    due_at = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    last_error = Column(String, nullable=True)
+    # Клуб подписки, по нему события делятся между клубами поровну
+    club_id = Column(Integer, nullable=False, server_default=str(DEFAULT_CLUB_ID))
+
+
+SUBSCRIPTION_EVENTS_SQL = f"""
+-- Постоянный сдвиг события в окне LIFECYCLE_SPREAD секунд
+CREATE OR REPLACE FUNCTION subscription_event_spread(p_id integer, p_kind text)
+RETURNS interval AS $$
+    SELECT make_interval(secs => abs(hashtext(p_id::text || p_kind)) % {LIFECYCLE_SPREAD + 1})
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION schedule_subscription_event(
+    p_id integer, p_kind text, p_at timestamp
+) RETURNS void AS $$
+    INSERT INTO subscription_events (subscription_id, kind, due_at, club_id)
+    SELECT p_id, p_kind, p_at + subscription_event_spread(p_id, p_kind), club_id
+    FROM subscriptions WHERE id = p_id
+    ON CONFLICT (subscription_id, kind) DO UPDATE
+    SET due_at = EXCLUDED.due_at, attempts = 0, last_error = NULL
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION schedule_subscription_end_events(p_id integer, p_end timestamp)
+RETURNS void AS $$
+BEGIN
+    PERFORM schedule_subscription_event(
+        p_id, '{EVENT_RENEW_REMINDER_1}',
+        date_trunc('day', p_end)
+            - interval '{LIFECYCLE_RENEW_REMINDER_DAYS} days' + interval '17 hours'
+    );
+    PERFORM schedule_subscription_event(
+        p_id, '{EVENT_RENEW_REMINDER_2}', date_trunc('day', p_end) + interval '12 hours'
+    );
+    PERFORM schedule_subscription_event(
+        p_id, '{EVENT_EXPIRE}', p_end + interval '{LIFECYCLE_EXPIRE_DELAY} seconds'
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION subscriptions_schedule_events() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM schedule_subscription_event(
+            NEW.id, '{EVENT_PERIOD_START}', NEW.start_datetime
+        );
+    END IF;
+    IF TG_OP = 'INSERT' OR NEW.end_datetime IS DISTINCT FROM OLD.end_datetime THEN
+        PERFORM schedule_subscription_end_events(NEW.id, NEW.end_datetime);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subscriptions_events ON subscriptions;
+CREATE TRIGGER subscriptions_events
+    AFTER INSERT OR UPDATE OF end_datetime ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION subscriptions_schedule_events();
+"""
+
+# При первом создании таблицы событий прошедшие приглашения и напоминания
+# существующих подписок не ставятся: ближайшее начало периода - следующий месяц
+SUBSCRIPTION_EVENTS_BACKFILL_SQL = f"""
+SELECT schedule_subscription_event(
+    id,
+    '{EVENT_PERIOD_START}',
+    GREATEST(
+        start_datetime,
+        date_trunc('month', LOCALTIMESTAMP) + interval '1 month 12 hours'
+    )
+)
+FROM subscriptions
+WHERE end_datetime > LOCALTIMESTAMP;
+SELECT schedule_subscription_end_events(id, end_datetime) FROM subscriptions;
+DELETE FROM subscription_events
+WHERE kind IN ('{EVENT_RENEW_REMINDER_1}', '{EVENT_RENEW_REMINDER_2}')
+    AND due_at < LOCALTIMESTAMP;
+"""
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_subscription_events(target, connection, tables=(), **kwargs) -> None:
+    connection.execute(text(SUBSCRIPTION_EVENTS_SQL))
+    if SubscriptionEvent.__table__ in tables:
+        connection.execute(text(SUBSCRIPTION_EVENTS_BACKFILL_SQL))
+    return None
+
+
 DATABASE_URL = f"postgresql://{USERNAME_DB}:{PASSWORD_DB}@{HOST_DB}:{PORT_DB}/{NAME_DB}"
-engine = create_engine(DATABASE_URL)
+REPLICA_DATABASE_URL = (
+    f"postgresql://{USERNAME_DB}:{PASSWORD_DB}@{REPLICA_HOST_DB}:{REPLICA_PORT_DB}/{NAME_DB}"
+    if REPLICA_HOST_DB
+    else None
+)
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def _create_engine(url: str):
+    engine = create_engine(url)
+    # Профилирование запросов в проде включается только по выборке
+    if QUERY_PROFILE_SAMPLE_RATE > 0:
+        install_query_profiler(engine)
+    return engine
+
+
+def _get_or_create_engine(url: str):
+    engine = _engines.get(url)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(url)
+            if engine is None:
+                engine = _engines[url] = _create_engine(url)
+    return engine
+
+
+# Соединение с базой данных PostgreSQL создаётся при первом обращении,
+# а не при импорте модуля: импорт не стоит ни запросов к БД, ни загрузки драйвера
+def get_engine():
+    return _get_or_create_engine(DATABASE_URL)
+
+
+# Движок реплики или None, если реплика не настроена
+def get_replica_engine():
+    if REPLICA_DATABASE_URL is None:
+        return None
+    return _get_or_create_engine(REPLICA_DATABASE_URL)
+
+
+# Отставание реплики в секундах. Если реплика получила и применила
+# весь WAL, она не отстаёт, даже когда основная БД давно не менялась.
+# Сервер не в режиме восстановления (не реплика) считается актуальным.
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """)
+
+
+def replica_lag(engine) -> Optional[float]:
+    with engine.connect() as connection:
+        lag = connection.execute(REPLICA_LAG_SQL).scalar()
+    return None if lag is None else float(lag)
+
+
+# Проверка отставания реплики с кэшем на REPLICA_LAG_CHECK_INTERVAL секунд,
+# чтобы каждая сессия чтения не делала лишний запрос
+class ReplicaLagCheck:
+    def __init__(
+        self,
+        max_lag: float = REPLICA_MAX_LAG,
+        interval: float = REPLICA_LAG_CHECK_INTERVAL,
+    ) -> None:
+        self.max_lag = max_lag
+        self.interval = interval
+        self._checked_at = None
+        self._usable = False
+        self._lock = threading.Lock()
+
+    def _check(self, engine) -> bool:
+        try:
+            lag = replica_lag(engine)
+        except Exception as error:
+            logger.warning("Реплика недоступна, читаем из основной БД: %s", error)
+            return False
+        if lag is None or lag > self.max_lag:
+            logger.warning("Реплика отстаёт на %s с, читаем из основной БД", lag)
+            return False
+        return True
+
+    def usable(self, engine) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.interval:
+                self._usable = self._check(engine)
+                self._checked_at = now
+            return self._usable
+
+
+replica_lag_check = ReplicaLagCheck()
+
+
+# Движок для сессии только для чтения: реплика, если она настроена
+# и не отстаёт, иначе основная БД с транзакциями в режиме READ ONLY,
+# чтобы случайная запись упала и там. Для реплики режим не задаётся:
+# она и так только для чтения, а сброс режима при возврате соединения
+# в пул на ней невозможен.
+def get_read_only_engine():
+    replica = get_replica_engine()
+    if replica is not None and replica_lag_check.usable(replica):
+        return replica
+    return get_engine().execution_options(postgresql_readonly=True)
+
+
+# database.engine по-прежнему доступен как атрибут модуля
+def __getattr__(name: str):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Создание таблиц и триггеров в базе данных. Выполняется явно:
+# командой python migrate.py при развёртывании и при запуске бота
+def migrate(engine=None) -> None:
+    Base.metadata.create_all(engine or get_engine())
+    return None
+
+
+# Сессия, которая привязывается к движку при первом запросе
+class LazyEngineSession(OrmSession):
+    def get_bind(self, mapper=None, **kwargs):
+        if self.bind is None:
+            self.bind = get_engine()
+        return super().get_bind(mapper, **kwargs)
+
+
+# Сессия для тяжёлого чтения (выгрузки, списки получателей).
+# Движок выбирается один раз при первом запросе.
+class ReadOnlySession(OrmSession):
+    def get_bind(self, mapper=None, **kwargs):
+        if self.bind is None:
+            self.bind = get_read_only_engine()
+        return super().get_bind(mapper, **kwargs)
 
-# Создание таблиц в базе данных
-Base.metadata.create_all(engine)
 
 # Создаем фабрику сессий
-session_factory = sessionmaker(bind=engine)
+session_factory = sessionmaker(class_=LazyEngineSession)
 Session = scoped_session(session_factory)
+# Фабрика сессий только для чтения, используется явно: with read_only() as session
+read_only = sessionmaker(class_=ReadOnlySession)
@@ -0,0 +1,124 @@
+from itertools import chain, islice
+from typing import Iterable, Optional
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+
+# Запас к ширине столбца и ограничение, после которого текст переносится
+WIDTH_PADDING = 2
+MAX_COLUMN_WIDTH = 100
+# Сколько первых строк потока используется для расчёта ширины столбцов
+WIDTH_SAMPLE_SIZE = 1000
+
+WRAP_ALIGNMENT = Alignment(wrap_text=True, vertical="top")
+
+
+def _fit_width(length: int) -> int:
+    return min(int(length) + WIDTH_PADDING, MAX_COLUMN_WIDTH)
+
+
+# Ширина столбцов по данным DataFrame: длина самой длинной строки
+# в каждом столбце, считается векторно через str.len().max()
+def column_widths_from_dataframe(df: pd.DataFrame) -> list:
+    widths = []
+    for column in df.columns:
+        values = df[column].dropna()
+        max_length = values.astype(str).str.len().max() if len(values) else 0
+        widths.append(_fit_width(max(max_length, len(str(column)))))
+    return widths
+
+
+# Накапливаем максимальную длину значений по столбцам для потока строк
+class ColumnWidthTracker:
+    def __init__(self, headers: list) -> None:
+        self.lengths = [len(str(header)) for header in headers]
+
+    def update(self, row: Iterable) -> None:
+        for index, value in enumerate(row):
+            if value is not None:
+                length = len(str(value))
+                if length > self.lengths[index]:
+                    self.lengths[index] = length
+        return None
+
+    @property
+    def widths(self) -> list:
+        return [_fit_width(length) for length in self.lengths]
+
+
+# Создаём лист в режиме write_only с заданными шириной столбцов и заголовком.
+# В этом режиме ширина должна быть задана до записи первой строки.
+def _create_sheet(workbook: Workbook, title: str, headers: list, widths: list):
+    worksheet = workbook.create_sheet(title)
+    for index, width in enumerate(widths, start=1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+    worksheet.append(list(headers))
+    return worksheet
+
+
+def _append_row(worksheet, row: Iterable, wrap_indexes: set) -> None:
+    if not wrap_indexes:
+        worksheet.append(list(row))
+        return None
+    cells = []
+    for index, value in enumerate(row):
+        if index in wrap_indexes:
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell.alignment = WRAP_ALIGNMENT
+            cells.append(cell)
+        else:
+            cells.append(value)
+    worksheet.append(cells)
+    return None
+
+
+# Книга xlsx, которая пишется потоково (write_only) на один или несколько листов
+class XlsxExport:
+    def __init__(self) -> None:
+        self.workbook = Workbook(write_only=True)
+
+    # Лист из DataFrame: ширина считается по всему столбцу заранее
+    def add_dataframe(
+        self, title: str, df: pd.DataFrame, wrap_columns: Optional[set] = None
+    ) -> None:
+        headers = list(df.columns)
+        wrap_indexes = {headers.index(name) for name in wrap_columns or ()}
+        worksheet = _create_sheet(
+            self.workbook, title, headers, column_widths_from_dataframe(df)
+        )
+        for row in (
+            df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        ):
+            _append_row(worksheet, row, wrap_indexes)
+        return None
+
+    # Лист из потока строк: ширина считается по первым sample_size строкам,
+    # остальные строки пишутся сразу, не задерживаясь в памяти.
+    # Возвращает количество записанных строк.
+    def add_rows(
+        self,
+        title: str,
+        headers: list,
+        rows: Iterable,
+        wrap_columns: Optional[set] = None,
+        sample_size: int = WIDTH_SAMPLE_SIZE,
+    ) -> int:
+        rows = iter(rows)
+        wrap_indexes = {headers.index(name) for name in wrap_columns or ()}
+        sample = list(islice(rows, sample_size))
+        tracker = ColumnWidthTracker(headers)
+        for row in sample:
+            tracker.update(row)
+        worksheet = _create_sheet(self.workbook, title, headers, tracker.widths)
+        count = 0
+        for row in chain(sample, rows):
+            _append_row(worksheet, row, wrap_indexes)
+            count += 1
+        return count
+
+    def save(self, output) -> None:
+        self.workbook.save(output)
+        return None
@@ -0,0 +1,163 @@
+import datetime
+import logging
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy import func, select
+
+from constants import HEALTH_CACHE_TTL
+from database import (
+    DELIVERY_PENDING,
+    Broadcast,
+    BroadcastDelivery,
+    CleanupTask,
+    SubscriptionEvent,
+    get_engine,
+    get_replica_engine,
+)
+from rate_limiter import CircuitBreaker
+from shutdown import shutting_down
+from telegram_client import telegram_breaker
+
+logger = logging.getLogger(__name__)
+
+
+# Занятость пула соединений движка. saturation - доля занятых соединений
+# от максимума пула (None, если переполнение не ограничено)
+def pool_status(engine) -> dict:
+    pool = engine.pool
+    status = {"checked_out": pool.checkedout(), "size": pool.size()}
+    max_overflow = getattr(pool, "_max_overflow", -1)
+    if max_overflow >= 0:
+        capacity = pool.size() + max_overflow
+        status["capacity"] = capacity
+        status["saturation"] = round(pool.checkedout() / capacity, 2)
+    return status
+
+
+# Глубина очередей в БД: неотправленные получатели незавершённых рассылок,
+# наступившие действия очереди очистки и события подписок. Все условия
+# идут по индексам, поэтому запрос дешёвый даже при больших таблицах.
+def queue_depths(connection) -> dict:
+    now = datetime.datetime.now()
+    utcnow = datetime.datetime.utcnow()
+    row = connection.execute(
+        select(
+            select(func.count())
+            .select_from(BroadcastDelivery)
+            .where(
+                BroadcastDelivery.broadcast_id.in_(
+                    select(Broadcast.id).where(Broadcast.finished_at.is_(None))
+                ),
+                BroadcastDelivery.status == DELIVERY_PENDING,
+            )
+            .scalar_subquery()
+            .label("broadcast_pending"),
+            select(func.count())
+            .select_from(CleanupTask)
+            .where(CleanupTask.run_at <= utcnow)
+            .scalar_subquery()
+            .label("cleanup_tasks"),
+            select(func.count())
+            .select_from(SubscriptionEvent)
+            .where(SubscriptionEvent.due_at <= now)
+            .scalar_subquery()
+            .label("subscription_events"),
+        )
+    ).one()
+    return dict(row._mapping)
+
+
+# Состояние процесса для /healthz и /readyz. Отчёт собирается не чаще
+# раза в ttl секунд, остальные запросы получают его из кэша, поэтому
+# частые проверки балансировщика не нагружают БД.
+class HealthMonitor:
+    def __init__(
+        self, breaker: CircuitBreaker = telegram_breaker, ttl: float = HEALTH_CACHE_TTL
+    ) -> None:
+        self.breaker = breaker
+        self.ttl = ttl
+        self._components = {}
+        self._queues = {}
+        self._report = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    # Фоновая часть процесса (планировщик, наблюдатель настроек), которая
+    # должна работать. Регистрируется только там, где её запускают.
+    def watch(self, name: str, is_alive: Callable) -> None:
+        self._components[name] = is_alive
+        return None
+
+    # Очередь в памяти процесса, например очередь обновлений диспетчера
+    def watch_queue(self, name: str, depth: Callable) -> None:
+        self._queues[name] = depth
+        return None
+
+    def _database(self) -> dict:
+        engine = get_engine()
+        report = {"pool": pool_status(engine)}
+        replica = get_replica_engine()
+        if replica is not None:
+            report["replica_pool"] = pool_status(replica)
+        # Без свободных соединений проверка ждала бы pool_timeout
+        if report["pool"].get("saturation", 0) >= 1:
+            report["ok"] = False
+            report["error"] = "Нет свободных соединений в пуле"
+            return report
+        try:
+            with engine.connect() as connection:
+                report["queues"] = queue_depths(connection)
+            report["ok"] = True
+        except Exception as error:
+            logger.warning("Проверка готовности: БД недоступна: %s", error)
+            report["ok"] = False
+            report["error"] = str(error)
+        return report
+
+    def _collect(self) -> dict:
+        components = {}
+        for name, is_alive in self._components.items():
+            try:
+                components[name] = bool(is_alive())
+            except Exception:
+                components[name] = False
+        queues = {name: depth() for name, depth in self._queues.items()}
+        database = self._database()
+        queues.update(database.pop("queues", {}))
+        breaker_state = self.breaker.state
+        # Живой процесс - все его фоновые части работают. Готовый - ещё
+        # и не останавливается, БД доступна, в пуле есть свободные
+        # соединения, а Bot API не отключён выключателем.
+        live = all(components.values())
+        ready = (
+            live
+            and not shutting_down.is_set()
+            and database["ok"]
+            and breaker_state != CircuitBreaker.OPEN
+        )
+        return {
+            "live": live,
+            "ready": ready,
+            "shutting_down": shutting_down.is_set(),
+            "components": components,
+            "database": database,
+            "telegram": {
+                "breaker": breaker_state,
+                "failures": self.breaker.failures,
+            },
+            "queues": queues,
+            "checked_at": datetime.datetime.utcnow().isoformat(),
+        }
+
+    def report(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.ttl:
+                self._report = self._collect()
+                self._checked_at = now
+            return self._report
+
+
+health = HealthMonitor()
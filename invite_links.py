@@ -0,0 +1,228 @@
+import datetime
+import time
+
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    String,
+    column,
+    func,
+    or_,
+    select,
+    update,
+    values,
+)
+
+from constants import JOB_BATCH_SIZE
+from database import Subscription, session_factory
+from rate_limiter import KeyedLock
+from settings import settings
+from utils import create_invite_link
+
+# Виды ссылок подписки: в канал и в чат-болталку (названия столбцов)
+LINK_CHANNEL = "subscription_link"
+LINK_CHAT = "chat_link"
+ALL_LINKS = (LINK_CHANNEL, LINK_CHAT)
+# Аренда права на создание ссылок подписки, в секундах: с запасом
+# на ожидание flood control в create_invite_link (три попытки по 40 секунд)
+LINK_CLAIM_LEASE = 300
+# Пауза между проверками, пока ссылки подписки создаёт другой вызов
+LINK_CLAIM_POLL = 0.5
+# Пауза после создания ссылки в отложенных задачах, в секундах
+LINK_PACE_DELAY = 1
+
+# Ожидающие в одном процессе не опрашивают БД
+_subscription_locks = KeyedLock()
+
+
+# Канал или чат клуба подписки
+def _link_chat_id(kind: str, club_id: int) -> str:
+    club = settings.club(club_id)
+    return club.channel_id if kind == LINK_CHANNEL else club.chat_id
+
+
+# Ссылки подписок одним запросом: {id подписки: {вид ссылки: ссылка}}
+def _read_links(subscription_ids: list) -> dict:
+    with session_factory() as session:
+        rows = session.execute(
+            select(
+                Subscription.id,
+                Subscription.subscription_link,
+                Subscription.chat_link,
+            ).where(Subscription.id.in_(subscription_ids))
+        ).all()
+    return {
+        row.id: {LINK_CHANNEL: row.subscription_link, LINK_CHAT: row.chat_link}
+        for row in rows
+    }
+
+
+# Захватываем право на создание ссылок подписок, у которых нет одной
+# из запрошенных ссылок: условный UPDATE ставит аренду на lease секунд,
+# если её нет или она истекла, и сразу фиксируется. Ссылки создаются
+# уже без открытой транзакции. Возвращает захваченные подписки,
+# их links_claimed_until - метка аренды для записи ссылок.
+def _claim_links(
+    subscription_ids: list, kinds: tuple, lease: float = LINK_CLAIM_LEASE
+) -> list:
+    with session_factory() as session:
+        rows = session.execute(
+            update(Subscription)
+            .where(
+                Subscription.id.in_(subscription_ids),
+                or_(*(getattr(Subscription, kind).is_(None) for kind in kinds)),
+                or_(
+                    Subscription.links_claimed_until.is_(None),
+                    Subscription.links_claimed_until < func.localtimestamp(),
+                ),
+            )
+            .values(
+                links_claimed_until=func.localtimestamp()
+                + datetime.timedelta(seconds=lease)
+            )
+            .returning(
+                Subscription.id,
+                Subscription.end_datetime,
+                Subscription.subscription_link,
+                Subscription.chat_link,
+                Subscription.club_id,
+                Subscription.links_claimed_until,
+            )
+            .execution_options(synchronize_session=False)
+        ).all()
+        session.commit()
+    return rows
+
+
+# Создаём недостающие ссылки захваченной подписки и складываем их
+# в created по мере создания, чтобы при ошибке записать уже созданные.
+# Ссылка на чат создаётся только при наличии ссылки на канал.
+def _create_links(bot, row, kinds: tuple, created: dict, pace: bool) -> None:
+    for kind in kinds:
+        if getattr(row, kind):
+            continue
+        link = create_invite_link(
+            bot, row.end_datetime, _link_chat_id(kind, row.club_id)
+        )
+        # Отложенные задачи создают не больше одной ссылки в секунду
+        if pace:
+            time.sleep(LINK_PACE_DELAY)
+        if not link:
+            break
+        created[kind] = link
+    return None
+
+
+# Записываем созданные ссылки захваченных подписок и снимаем аренду одним
+# UPDATE ... FROM (VALUES ...). Подписки, аренду которых успел перехватить
+# другой вызов (истекла), не меняются.
+def _store_links(claimed: list, created: dict) -> None:
+    links = values(
+        column("id", Integer),
+        column("claimed_until", DateTime),
+        column(LINK_CHANNEL, String),
+        column(LINK_CHAT, String),
+        name="links",
+    ).data(
+        [
+            (
+                row.id,
+                row.links_claimed_until,
+                created.get(row.id, {}).get(LINK_CHANNEL),
+                created.get(row.id, {}).get(LINK_CHAT),
+            )
+            for row in claimed
+        ]
+    )
+    with session_factory() as session:
+        session.execute(
+            update(Subscription)
+            .where(
+                Subscription.id == links.c.id,
+                Subscription.links_claimed_until == links.c.claimed_until,
+            )
+            .values(
+                subscription_link=func.coalesce(
+                    links.c[LINK_CHANNEL], Subscription.subscription_link
+                ),
+                chat_link=func.coalesce(links.c[LINK_CHAT], Subscription.chat_link),
+                links_claimed_until=None,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    return None
+
+
+# Создаём недостающие ссылки подписки ровно один раз. Право на создание
+# захватывается арендой (_claim_links), запросы к Bot API выполняются
+# вне транзакции, созданные ссылки записываются второй короткой
+# транзакцией вместе со снятием аренды. Одновременные вызовы (в том
+# числе из других процессов) ждут снятия аренды и получают уже
+# созданные ссылки. Возвращает {вид ссылки: ссылка или None}.
+def ensure_subscription_links(
+    bot, subscription_id: int, kinds: tuple = ALL_LINKS, pace: bool = False
+) -> dict:
+    with _subscription_locks.hold(subscription_id):
+        while True:
+            claimed = _claim_links([subscription_id], kinds)
+            if claimed:
+                break
+            links = _read_links([subscription_id]).get(subscription_id)
+            if links is None or all(links[kind] for kind in kinds):
+                return links or {}
+            time.sleep(LINK_CLAIM_POLL)
+        row = claimed[0]
+        links = {LINK_CHANNEL: row.subscription_link, LINK_CHAT: row.chat_link}
+        created = {}
+        try:
+            _create_links(bot, row, kinds, created, pace=False)
+        finally:
+            _store_links(claimed, {subscription_id: created})
+    # Пауза уже после снятия аренды
+    if pace and created:
+        time.sleep(LINK_PACE_DELAY * len(created))
+    links.update(created)
+    return links
+
+
+# Вариант для отложенных задач: ссылки пачки подписок читаются одним
+# запросом, подписки без ссылок захватываются одним UPDATE, ссылки
+# создаются вне транзакции и записываются одним UPDATE на пачку.
+# Подписки, ссылки которых сейчас создаёт другой вызов, дожидаются его
+# по одной. Возвращает {id подписки: {вид ссылки: ссылка}}.
+def ensure_links_bulk(
+    bot, subscription_ids: list, kinds: tuple = ALL_LINKS, pace: bool = True
+) -> dict:
+    results = {}
+    for start in range(0, len(subscription_ids), JOB_BATCH_SIZE):
+        batch = subscription_ids[start : start + JOB_BATCH_SIZE]
+        results.update(_read_links(batch))
+        missing = [
+            subscription_id
+            for subscription_id in batch
+            if subscription_id in results
+            and not all(results[subscription_id][kind] for kind in kinds)
+        ]
+        if not missing:
+            continue
+        # Аренда с запасом на паузы между ссылками всей пачки
+        lease = LINK_CLAIM_LEASE + len(missing) * len(kinds) * LINK_PACE_DELAY
+        claimed = _claim_links(missing, kinds, lease)
+        created = {row.id: {} for row in claimed}
+        try:
+            for row in claimed:
+                _create_links(bot, row, kinds, created[row.id], pace)
+        finally:
+            _store_links(claimed, created)
+        for row in claimed:
+            results[row.id] = {
+                LINK_CHANNEL: row.subscription_link,
+                LINK_CHAT: row.chat_link,
+                **created[row.id],
+            }
+        for subscription_id in set(missing) - set(created):
+            results[subscription_id] = ensure_subscription_links(
+                bot, subscription_id, kinds, pace
+            )
+    return results
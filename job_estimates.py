@@ -0,0 +1,363 @@
+import datetime
+from collections import Counter
+
+from sqlalchemy import and_, func, select
+
+from constants import (
+    CLEANUP_RATE,
+    LIFECYCLE_RATE,
+    TELEGRAM_API_LATENCY,
+    TELEGRAM_MESSAGE_RATE,
+)
+from database import (
+    COHORT_ANY_PERIOD,
+    COHORT_LAPSED,
+    COHORT_RENEWING,
+    COHORT_SUBSCRIBED,
+    EVENT_EXPIRE,
+    EVENT_JOIN_REMINDER_1,
+    EVENT_JOIN_REMINDER_2,
+    EVENT_PERIOD_START,
+    EVENT_RENEW_REMINDER_1,
+    EVENT_RENEW_REMINDER_2,
+    CohortMember,
+    FailedPayment,
+    Subscription,
+    SubscriptionEvent,
+    User,
+    read_only,
+)
+from invite_links import LINK_PACE_DELAY
+
+SEND_MESSAGE = "sendMessage"
+CREATE_LINK = "createChatInviteLink"
+GET_MEMBER = "getChatMember"
+REVOKE_LINK = "revokeChatInviteLink"
+BAN = "banChatMember"
+UNBAN = "unbanChatMember"
+
+
+# Оценка запуска задачи: получатели и запросы к Bot API по методам.
+# calls выполняет сама задача по очереди, deferred - очередь очистки после неё.
+class JobEstimate:
+    def __init__(self, name: str, message_rate: float = TELEGRAM_MESSAGE_RATE) -> None:
+        self.name = name
+        self.message_rate = message_rate
+        self.recipients = 0
+        self.calls = Counter()
+        self.deferred = Counter()
+
+    # Задача шлёт запросы последовательно: каждый занимает не меньше
+    # задержки Bot API и не меньше интервала своего ограничения
+    def seconds(self) -> float:
+        intervals = {CREATE_LINK: LINK_PACE_DELAY, SEND_MESSAGE: 1 / self.message_rate}
+        return sum(
+            count * max(TELEGRAM_API_LATENCY, intervals.get(method, 0))
+            for method, count in self.calls.items()
+        )
+
+    # Очередь очистки выполняет не больше CLEANUP_RATE действий в секунду
+    def deferred_seconds(self) -> float:
+        return sum(self.deferred.values()) / CLEANUP_RATE
+
+    def as_dict(self) -> dict:
+        return {
+            "job": self.name,
+            "recipients": self.recipients,
+            "calls": dict(self.calls),
+            "deferred_calls": dict(self.deferred),
+            "seconds": round(self.seconds(), 1),
+            "deferred_seconds": round(self.deferred_seconds(), 1),
+        }
+
+
+def _count(session, query) -> int:
+    return session.execute(select(func.count()).select_from(query.subquery())).scalar()
+
+
+def _cohort_count(session, cohort: str, period=COHORT_ANY_PERIOD) -> int:
+    return _count(
+        session,
+        select(CohortMember.user_id).where(
+            CohortMember.cohort == cohort,
+            CohortMember.period == period,
+            CohortMember.telegram_id.is_not(None),
+        ),
+    )
+
+
+def _users_with_telegram(session) -> int:
+    return _count(session, select(User.id).where(User.telegram_id.is_not(None)))
+
+
+# Отзыв ссылок и исключения, которые очередь очистки выполнит
+# после удаления подписок, отобранных условием condition
+def _add_cleanup(session, estimate: JobEstimate, condition) -> int:
+    row = session.execute(
+        select(
+            func.count(),
+            func.count(Subscription.subscription_link),
+            func.count(Subscription.chat_link),
+            func.count(User.telegram_id),
+        )
+        .join(User, User.id == Subscription.user_id)
+        .where(condition)
+    ).one()
+    subscriptions, subscription_links, chat_links, with_telegram = row
+    estimate.deferred[REVOKE_LINK] += subscription_links + chat_links
+    # Исключение и разбан выполняются и в канале, и в чате-болталке
+    estimate.deferred[BAN] += 2 * with_telegram
+    estimate.deferred[UNBAN] += 2 * with_telegram
+    return subscriptions
+
+
+# Новые подписки (send_invite_link) и подписки, начавшиеся раньше
+def _new_subscriptions(now: datetime.datetime):
+    return Subscription.start_datetime > now - datetime.timedelta(days=1)
+
+
+def _prolonged_subscriptions(now: datetime.datetime):
+    return and_(
+        Subscription.start_datetime < now - datetime.timedelta(days=1),
+        Subscription.end_datetime > now,
+    )
+
+
+def estimate_request_feedback_from_all_users(session, estimate) -> None:
+    estimate.recipients = _users_with_telegram(session)
+    estimate.calls[SEND_MESSAGE] = estimate.recipients
+    return None
+
+
+def estimate_get_first_reminder_to_renew_the_subscription(session, estimate) -> None:
+    now = datetime.datetime.now()
+    last_day_of_month = (now.replace(day=1) + datetime.timedelta(days=32)).replace(
+        day=1
+    ) - datetime.timedelta(days=1)
+    estimate.recipients = _cohort_count(
+        session, COHORT_RENEWING, last_day_of_month.date()
+    )
+    estimate.calls[SEND_MESSAGE] = estimate.recipients
+    return None
+
+
+def estimate_remind_lapsed_users(session, estimate) -> None:
+    lapsed = _cohort_count(session, COHORT_LAPSED)
+    estimate.recipients += lapsed
+    # Каждому два сообщения
+    estimate.calls[SEND_MESSAGE] += 2 * lapsed
+    return None
+
+
+def estimate_get_second_reminder_to_renew_the_subscription(session, estimate) -> None:
+    renewing = _cohort_count(session, COHORT_RENEWING, datetime.date.today())
+    estimate.recipients = renewing
+    estimate.calls[SEND_MESSAGE] = renewing
+    estimate_remind_lapsed_users(session, estimate)
+    return None
+
+
+def estimate_get_first_reminder_to_join_the_club(session, estimate) -> None:
+    estimate.recipients = _users_with_telegram(session)
+    estimate.calls[SEND_MESSAGE] = estimate.recipients
+    return None
+
+
+def estimate_get_second_reminder_to_join_the_club(session, estimate) -> None:
+    estimate.recipients = _cohort_count(session, COHORT_SUBSCRIBED)
+    estimate.calls[SEND_MESSAGE] = estimate.recipients
+    return None
+
+
+def estimate_check_subscription_validity(session, estimate) -> None:
+    estimate.recipients = _add_cleanup(
+        session, estimate, Subscription.end_datetime < datetime.datetime.now()
+    )
+    return None
+
+
+def estimate_send_invite_link(session, estimate) -> None:
+    now = datetime.datetime.utcnow()
+    new = session.execute(
+        select(
+            func.count(),
+            func.count(Subscription.subscription_link),
+            func.count(Subscription.chat_link),
+        ).where(_new_subscriptions(now))
+    ).one()
+    prolonged = session.execute(
+        select(func.count(), func.count(Subscription.chat_link)).where(
+            _prolonged_subscriptions(now)
+        )
+    ).one()
+    estimate.recipients = new[0] + prolonged[0]
+    estimate.calls[CREATE_LINK] = (
+        (new[0] - new[1]) + (new[0] - new[2]) + (prolonged[0] - prolonged[1])
+    )
+    estimate.calls[SEND_MESSAGE] = estimate.recipients
+    return None
+
+
+def estimate_handle_overlapping_subscriptions(session, estimate) -> None:
+    # Запросов к Telegram нет, получатели - пользователи с несколькими подписками
+    estimate.recipients = _count(
+        session,
+        select(Subscription.user_id)
+        .group_by(Subscription.user_id)
+        .having(func.count() > 1),
+    )
+    return None
+
+
+def estimate_notify_about_new_chat(session, estimate) -> None:
+    now = datetime.datetime.utcnow()
+    total, chat_links = session.execute(
+        select(func.count(), func.count(Subscription.chat_link))
+        .join(User, User.id == Subscription.user_id)
+        .where(_prolonged_subscriptions(now), User.telegram_id.is_not(None))
+    ).one()
+    estimate.recipients = total
+    estimate.calls[CREATE_LINK] = total - chat_links
+    estimate.calls[SEND_MESSAGE] = total
+    return None
+
+
+def estimate_reconcile_payments(session, estimate) -> None:
+    estimate.recipients = _count(
+        session, select(FailedPayment.id).where(FailedPayment.resolved_at.is_(None))
+    )
+    return None
+
+
+# Наступившие события подписок. Оценка сверху: напоминания, которые
+# обработчик пропустит (уже в канале, подписка продлена), тоже считаются.
+def estimate_handle_subscription_events(session, estimate) -> None:
+    estimate.message_rate = LIFECYCLE_RATE
+    now = datetime.datetime.now()
+    due = SubscriptionEvent.due_at <= now
+    counts = dict(
+        session.execute(
+            select(SubscriptionEvent.kind, func.count())
+            .where(due)
+            .group_by(SubscriptionEvent.kind)
+        ).all()
+    )
+    estimate.recipients = sum(counts.values())
+    missing_links = session.execute(
+        select(
+            func.count()
+            .filter(Subscription.subscription_link.is_(None))
+            .label("subscription_links"),
+            func.count().filter(Subscription.chat_link.is_(None)).label("chat_links"),
+        )
+        .join(SubscriptionEvent, SubscriptionEvent.subscription_id == Subscription.id)
+        .where(due, SubscriptionEvent.kind == EVENT_PERIOD_START)
+    ).one()
+    estimate.calls[CREATE_LINK] = sum(missing_links)
+    estimate.calls[SEND_MESSAGE] = sum(
+        counts.get(kind, 0)
+        for kind in (
+            EVENT_PERIOD_START,
+            EVENT_JOIN_REMINDER_1,
+            EVENT_JOIN_REMINDER_2,
+            EVENT_RENEW_REMINDER_1,
+            EVENT_RENEW_REMINDER_2,
+        )
+    )
+    estimate.calls[GET_MEMBER] = counts.get(EVENT_JOIN_REMINDER_1, 0) + counts.get(
+        EVENT_JOIN_REMINDER_2, 0
+    )
+    expiring = select(SubscriptionEvent.subscription_id).where(
+        due, SubscriptionEvent.kind == EVENT_EXPIRE
+    )
+    _add_cleanup(
+        session,
+        estimate,
+        and_(Subscription.id.in_(expiring), Subscription.end_datetime < now),
+    )
+    return None
+
+
+# Оценки всех задач postponed_tasks, которые запускаются по расписанию
+JOB_ESTIMATES = {
+    "request_feedback_from_all_users": estimate_request_feedback_from_all_users,
+    "get_first_reminder_to_renew_the_subscription": (
+        estimate_get_first_reminder_to_renew_the_subscription
+    ),
+    "get_second_reminder_to_renew_the_subscription": (
+        estimate_get_second_reminder_to_renew_the_subscription
+    ),
+    "remind_lapsed_users": estimate_remind_lapsed_users,
+    "get_first_reminder_to_join_the_club": estimate_get_first_reminder_to_join_the_club,
+    "get_second_reminder_to_join_the_club": (
+        estimate_get_second_reminder_to_join_the_club
+    ),
+    "check_subscription_validity": estimate_check_subscription_validity,
+    "send_invite_link": estimate_send_invite_link,
+    "handle_overlapping_subscriptions": estimate_handle_overlapping_subscriptions,
+    "notify_about_new_chat": estimate_notify_about_new_chat,
+    "reconcile_payments": estimate_reconcile_payments,
+    "handle_subscription_events": estimate_handle_subscription_events,
+}
+
+
+# Оцениваем задачи, выполняя только запросы отбора (на реплике, если она есть)
+def estimate_jobs(names: list) -> list:
+    estimates = []
+    with read_only() as session:
+        for name in names:
+            estimate = JobEstimate(name)
+            JOB_ESTIMATES[name](session, estimate)
+            estimates.append(estimate)
+    return estimates
+
+
+def format_duration(seconds: float) -> str:
+    seconds = round(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def format_estimate(estimate: JobEstimate) -> str:
+    lines = [f"{estimate.name}: получателей {estimate.recipients}"]
+    for method, count in sorted(estimate.calls.items()):
+        if count:
+            lines.append(f"  {method}: {count}")
+    lines.append(f"  длительность: {format_duration(estimate.seconds())}")
+    if sum(estimate.deferred.values()):
+        deferred = ", ".join(
+            f"{method}: {count}"
+            for method, count in sorted(estimate.deferred.items())
+            if count
+        )
+        lines.append(
+            f"  очередь очистки: {deferred}, "
+            f"{format_duration(estimate.deferred_seconds())}"
+        )
+    return "\n".join(lines)
+
+
+# python job_estimates.py [задача ...] [--json]
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description="Оценка отложенных задач без отправки сообщений"
+    )
+    parser.add_argument("jobs", nargs="*", help="Задачи, по умолчанию все")
+    parser.add_argument("--json", action="store_true", help="Вывести отчёт в JSON")
+    args = parser.parse_args()
+    unknown = set(args.jobs) - set(JOB_ESTIMATES)
+    if unknown:
+        parser.error(f"неизвестные задачи: {', '.join(sorted(unknown))}")
+    results = estimate_jobs(args.jobs or list(JOB_ESTIMATES))
+    if args.json:
+        print(
+            json.dumps(
+                [estimate.as_dict() for estimate in results],
+                ensure_ascii=False,
+                indent=2,
+            )
+        )
+    else:
+        print("\n\n".join(format_estimate(estimate) for estimate in results))
@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from constants import (
+    LOG_BACKUP_COUNT,
+    LOG_FILE,
+    LOG_LEVEL,
+    LOG_MAX_BYTES,
+    LOG_ROTATE_WHEN,
+    LOG_SAMPLE_PERIOD,
+    LOG_SAMPLE_RATE,
+)
+
+# Номер телефона в международном формате: "+" и 10-15 цифр, возможно
+# с пробелами, скобками и дефисами. Телеграм id, id чатов (-100...) и даты
+# без "+" номерами не считаются.
+PHONE_IN_TEXT_REGEX = re.compile(r"(?<![\w+])\+\d[\d\s\-()]{8,18}\d")
+# Значение поля или подписи с номером телефона в любом формате,
+# например {'Phone': '8 (999) 123-45-67'} из уведомления об оплате
+PHONE_FIELD_REGEX = re.compile(
+    r"((?:phone(?:_number)?|номер(?:ом)? телефона|телефонный номер)"
+    r"['\"]?\s*[:=]?\s*['\"]?)(\+?\d[\d\s\-()]{8,18}\d)",
+    re.IGNORECASE,
+)
+# Поля записи, которые не нужно выводить в JSON как дополнительные
+RESERVED_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener = None
+
+
+def _mask_phone(value: str) -> str:
+    digits = re.sub(r"\D", "", value)
+    if len(digits) < 10:
+        return value
+    return "+" + "*" * (len(digits) - 2) + digits[-2:]
+
+
+# Маскируем номера телефонов, оставляя видимыми только две последние цифры.
+# Маскируются номера с "+" и значения полей с номером телефона, остальные
+# последовательности цифр (id пользователей и чатов, время) остаются.
+def mask_phone_numbers(text: str) -> str:
+    text = PHONE_FIELD_REGEX.sub(
+        lambda match: match.group(1) + _mask_phone(match.group(2)), text
+    )
+    return PHONE_IN_TEXT_REGEX.sub(lambda match: _mask_phone(match.group()), text)
+
+
+# Форматтер, который пишет каждую запись одной строкой JSON.
+# Вызывается в потоке QueueListener, поэтому форматирование сообщения
+# и маскирование телефонов не нагружают поток обработки запроса.
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": mask_phone_numbers(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = mask_phone_numbers(
+                self.formatException(record.exc_info)
+            )
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+# Ротация файла логов и по времени, и по размеру
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    def __init__(self, filename: str, max_bytes: int = 0, **kwargs) -> None:
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        if super().shouldRollover(record):
+            return 1
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, os.SEEK_END)
+            if self.stream.tell() >= self.max_bytes:
+                return 1
+        return 0
+
+
+# Ограничиваем количество одинаковых (по шаблону сообщения) записей
+# уровня INFO и ниже: не больше rate записей за period секунд.
+# Отброшенные записи учитываются и попадают в лог одной сводкой.
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: int, period: float) -> None:
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno > logging.INFO:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            started_at, count, dropped = self._windows.get(key, (now, 0, 0))
+            if now - started_at >= self.period:
+                if dropped:
+                    record.sampled_out = dropped
+                started_at, count, dropped = now, 0, 0
+            if count >= self.rate:
+                self._windows[key] = (started_at, count, dropped + 1)
+                return False
+            self._windows[key] = (started_at, count + 1, dropped)
+        return True
+
+
+# QueueHandler по умолчанию форматирует запись перед постановкой в очередь.
+# Мы передаём запись как есть, форматирование выполняет QueueListener.
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Настраиваем асинхронное логгирование: обработчики только кладут
+# запись в очередь, запись в файл происходит в отдельном потоке
+def setup_logging() -> QueueListener:
+    global _listener
+    if _listener is not None:
+        return _listener
+    file_handler = SizedTimedRotatingFileHandler(
+        LOG_FILE,
+        max_bytes=LOG_MAX_BYTES,
+        when=LOG_ROTATE_WHEN,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8",
+        delay=True,
+    )
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE, LOG_SAMPLE_PERIOD))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    _listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+# Дописываем все записи из очереди и останавливаем поток логгирования
+def stop_logging() -> None:
+    global _listener
+    if _listener is None:
+        return None
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    return None
@@ -1,5 +1,8 @@
 import datetime
-import re
+import os
+import signal
+import threading
+import time
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask, jsonify, request
@@ -7,43 +10,61 @@ from telegram import KeyboardButton, ReplyKeyboardMarkup, Update
 from telegram.ext import (
     CallbackContext,
     CommandHandler,
+    ExtBot,
     Filters,
     MessageHandler,
     Updater,
 )
 
+from cleanup_queue import cleanup_worker
+from clubs import club_updaters, clubs_with_bots, context_club
 from constants import (
+    DEFAULT_CLUB_SLUG,
+    LIFECYCLE_POLL_INTERVAL,
     MOSCOW_TZ,
     PAYMENT_KEY,
     PAYMENT_WEBHOOK,
-    PHONE_NUMBER_REGEX,
+    SHUTDOWN_TIMEOUT,
+    TELEGRAM_API_URL,
     TELEGRAM_WEBHOOK,
-    TOKEN,
 )
-from database import Review, Session, User
+from database import Review, Session, User, migrate
+from health import health
+from logging_config import stop_logging
 from manager_commands import (
+    add_moderator,
     change_phone_number,
     delete_subscription,
     delete_user,
     get_all_reviews,
     get_all_users,
+    get_broadcast_status,
+    get_review_trends,
     give_free_subscription,
     notify_about_new_chat_personally,
+    remove_moderator,
+    search_reviews_command,
     send_invite_link_personally,
     set_subscription_end_at,
+    start_broadcast,
 )
+from payments import PaymentParseError, parse_tilda_payment, record_failed_payment
+from phone_numbers import canonical_phone_number
 from postponed_tasks import (
-    check_subscription_validity,
-    get_first_reminder_to_join_the_club,
-    get_first_reminder_to_renew_the_subscription,
-    get_second_reminder_to_join_the_club,
-    get_second_reminder_to_renew_the_subscription,
+    estimate_postponed_tasks,
     handle_overlapping_subscriptions,
+    handle_subscription_events,
     notify_about_new_chat,
+    reconcile_payments,
+    remind_lapsed_users,
     request_feedback_from_all_users,
-    send_invite_link,
+    resume_broadcasts,
     test_postponed_task,
 )
+from query_profiler import profiled
+from settings import settings
+from shutdown import shutting_down, stop_all
+from telegram_client import GuardedRequest
 from user_commands import (
     get_demo_version_of_club,
     get_invitation,
@@ -55,89 +76,127 @@ from user_commands import (
 )
 from utils import create_session, logger, update_subscription
 
+# Потоки диспетчера для обработчиков run_async
+DISPATCHER_WORKERS = 4
+
 app = Flask(__name__)
-updater = Updater(
-    TOKEN, use_context=True, request_kwargs={"connect_timeout": 10, "read_timeout": 20}
-)
-dispatcher = updater.dispatcher
+# Приём обновлений ботов клубов запускается один раз
+_polling_lock = threading.RLock()
+
+
+# Updater бота клуба, создаётся при первом обращении к club_updaters.
+# Запросы к Bot API идут через выключатель telegram_breaker. Пул соединений,
+# как у Updater по умолчанию: по одному на поток диспетчера и ещё 4.
+# Обработчики узнают клуб по bot_data["club_id"].
+def create_updater(club) -> Updater:
+    updater = Updater(
+        bot=ExtBot(
+            club.token,
+            base_url=TELEGRAM_API_URL,
+            request=GuardedRequest(
+                con_pool_size=DISPATCHER_WORKERS + 4,
+                connect_timeout=10,
+                read_timeout=20,
+            ),
+        ),
+        workers=DISPATCHER_WORKERS,
+        use_context=True,
+    )
+    updater.dispatcher.bot_data["club_id"] = club.id
+    register_handlers(updater.dispatcher)
+    health.watch_queue(f"updates:{club.slug}", updater.dispatcher.update_queue.qsize)
+    return updater
+
+
+club_updaters.factory = create_updater
+
 
+# Живость процесса: все его фоновые части работают. Ответ 503 - повод
+# перезапустить процесс. Отчёт кэшируется на HEALTH_CACHE_TTL секунд.
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    report = health.report()
+    return jsonify(report), 200 if report["live"] else 503
 
-# Обрабатываем обновления от телеграма с вебхука
-@app.route(f"/{TELEGRAM_WEBHOOK}/", methods=["POST"])
-def telegram_webhook():
+
+# Готовность принимать запросы: БД доступна и в пуле есть соединения,
+# Bot API не отключён выключателем, процесс не останавливается.
+# Ответ 503 - повод не направлять в процесс новые запросы.
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    report = health.report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+# Обрабатываем обновления от телеграма с вебхука бота клуба.
+# Адрес без клуба относится к клубу по умолчанию.
+@app.route(
+    f"/{TELEGRAM_WEBHOOK}/", methods=["POST"], defaults={"slug": DEFAULT_CLUB_SLUG}
+)
+@app.route(f"/{TELEGRAM_WEBHOOK}/<slug>/", methods=["POST"])
+def telegram_webhook(slug: str):
+    club = settings.club_by_slug(slug)
+    if club is None or not club.token:
+        return "not found", 404
+    dispatcher = club_updaters.get(club.id).dispatcher
     update = Update.de_json(request.get_json(force=True), dispatcher.bot)
     dispatcher.process_update(update)
     return "ok"
 
 
-# Обработчик вебхука для уведомлений об оплате от Tilda
-@app.route(f"/{PAYMENT_WEBHOOK}/", methods=["POST"])
-def payment_webhook():
+# Обработчик вебхука для уведомлений об оплате от Tilda.
+# Адрес без клуба относится к клубу по умолчанию.
+@app.route(
+    f"/{PAYMENT_WEBHOOK}/", methods=["POST"], defaults={"slug": DEFAULT_CLUB_SLUG}
+)
+@app.route(f"/{PAYMENT_WEBHOOK}/<slug>/", methods=["POST"])
+@profiled
+def payment_webhook(slug: str):
+    club = settings.club_by_slug(slug)
+    if club is None:
+        return jsonify({"status": "failure", "message": "Unknown club"}), 404
+    data = None
     try:
         # Получаем ключ из заголовков запроса
-        logger.info(f"Got webhook request headrs: {request.headers}")
         payment_key = request.headers.get("API-Key")
+        # Форматирование выполняется в потоке логгирования, ключ в лог не пишем
+        logger.info(
+            "Got webhook request headers: %s",
+            {k: v for k, v in request.headers.items() if k.lower() != "api-key"},
+        )
         # Сравниваем полученный ключ с ожидаемым
         if payment_key != PAYMENT_KEY:
             return (jsonify({"status": "failure", "message": "Invalid key"}), 400)
         data = request.json
-        logger.info(f"Got webhook request body: {data}")
-        phone_number = data.get("Phone")
-        if not phone_number:
-            return (
-                jsonify(
-                    {
-                        "status": "failure",
-                        "message": "В уведомлении отсутствует номер телефона.",
-                    }
-                ),
-                400,
-            )
-        # Регулярное выражение для удаления всех символов,
-        # кроме цифр и знака "+"
-        pattern = re.compile(r"[^\d+]")
-        phone_number = pattern.sub("", phone_number)
-        amount_months = data.get("payment").get("products")[0].get("name").split()[-2]
-        if not amount_months:
-            return (
-                jsonify(
-                    {
-                        "status": "failure",
-                        "message": "В уведомлении в имени товара отсутствует количество месяцев.",
-                    }
-                ),
-                400,
-            )
-        start_year, start_month, _ = data.get("month").split("-")
-        if not start_month or not start_year:
-            return (
-                jsonify(
-                    {
-                        "status": "failure",
-                        "message": "В уведомлении отсутствует начальный месяц или год подписки.",
-                    }
-                ),
-                400,
-            )
-        tg = data.get("tg")
-        tg = tg[1:] if tg.startswith("@") else tg
+        logger.info("Got webhook request body: %s", data)
+        try:
+            payment = parse_tilda_payment(data)
+        except PaymentParseError as error:
+            record_failed_payment(data, error, club.id)
+            return jsonify({"status": "failure", "message": str(error)}), 400
         # Обновляем подписку в соответствии с условиями
-        update_subscription(
-            int(amount_months), phone_number, int(start_month), int(start_year), tg
-        )
+        update_subscription(*payment, club_id=club.id)
     except Exception as error:
-        logger.error(f"payment webhook error: {str(error)}")
+        logger.error("payment webhook error: %s", error)
+        if data is not None:
+            record_failed_payment(data, error, club.id)
         return jsonify({"status": "failure", "message": str(error)}), 500
     return jsonify({"status": "success", "message": "Успешно."}), 200
 
 
 # Выводим логи ошибок, вызванных обновлениями
 def error(update: Update, context: CallbackContext) -> None:
-    logger.warning('Update "%s" caused error "%s"', update, context.error)
+    # Вместо всего объекта Update пишем только его id
+    logger.warning(
+        'Update "%s" caused error "%s"',
+        update.update_id if isinstance(update, Update) else update,
+        context.error,
+    )
     return None
 
 
 # Обработчик текстовых сообщений-действий
+@profiled
 def handle_text(update: Update, context: CallbackContext) -> None:
     try:
         user_text = update.message.text
@@ -157,7 +216,10 @@ def handle_text(update: Update, context: CallbackContext) -> None:
                     telegram_id = update.message.from_user.id
                     user = (
                         session.query(User)
-                        .filter(User.telegram_id == telegram_id)
+                        .filter(
+                            User.club_id == context_club(context).id,
+                            User.telegram_id == telegram_id,
+                        )
                         .first()
                     )
                     new_review = Review(review_text=user_text, user_id=user.id)
@@ -168,8 +230,9 @@ def handle_text(update: Update, context: CallbackContext) -> None:
             context.user_data["awaiting_review"] = False
             return None
 
-        if PHONE_NUMBER_REGEX.match(user_text):
-            get_subscription_link(update, context, user_text)
+        phone_number = canonical_phone_number(user_text)
+        if phone_number:
+            get_subscription_link(update, context, phone_number)
         if user_text == "Получить ссылку 🏁":
             get_subscription_link(update, context)
         elif user_text == "Срок действия подписки 🕑":
@@ -183,7 +246,7 @@ def handle_text(update: Update, context: CallbackContext) -> None:
         elif user_text == "Техническая поддержка ⚙️":
             get_technical_support(update, context)
     except Exception as error:
-        logger.error(str(error))
+        logger.error("Ошибка при обработке текста: %s", error)
         update.message.reply_text(
             "Неизвестная ошибка. Обратитесь в техническую поддержку."
         )
@@ -215,17 +278,14 @@ def start(update: Update, context: CallbackContext) -> None:
 def handle_contact(update: Update, context: CallbackContext) -> None:
     contact = update.message.contact
     if contact is not None:
-        phone_number = contact.phone_number
-        if phone_number[0] != "+":
-            phone_number = "+" + phone_number
-        get_subscription_link(update, context, phone_number)
+        phone_number = canonical_phone_number(contact.phone_number)
+        if phone_number:
+            get_subscription_link(update, context, phone_number)
     return None
 
 
-def main() -> None:
-    # Устанавливаем вебхук
-    # webhook_url = f"https://{DOMAIN}/{TELEGRAM_WEBHOOK}/"
-    # updater.bot.setWebhook(webhook_url)
+# Регистрируем обработчики команд и сообщений в диспетчере бота клуба
+def register_handlers(dispatcher) -> None:
     # Обработчик для текста
     text_handler = MessageHandler(
         Filters.text & ~Filters.command & ~Filters.regex("#"), handle_text
@@ -246,6 +306,7 @@ def main() -> None:
     test_postponed_task_handler = CommandHandler(
         "test_postponed_task", test_postponed_task
     )
+    estimate_jobs_handler = CommandHandler("estimate_jobs", estimate_postponed_tasks)
     set_subscription_end_at_handler = CommandHandler(
         "set_subscription_end_at", set_subscription_end_at
     )
@@ -258,15 +319,28 @@ def main() -> None:
     notify_about_new_chat_personally_handler = CommandHandler(
         "notify_about_new_chat_personally", notify_about_new_chat_personally
     )
+    add_moderator_handler = CommandHandler("add_moderator", add_moderator)
+    remove_moderator_handler = CommandHandler("remove_moderator", remove_moderator)
+    broadcast_handler = CommandHandler("broadcast", start_broadcast)
+    broadcast_status_handler = CommandHandler("broadcast_status", get_broadcast_status)
+    search_reviews_handler = CommandHandler("search_reviews", search_reviews_command)
+    review_trends_handler = CommandHandler("review_trends", get_review_trends)
 
     # Регистрируем все ошибки
     dispatcher.add_error_handler(error)
 
+    dispatcher.add_handler(add_moderator_handler)
+    dispatcher.add_handler(remove_moderator_handler)
+    dispatcher.add_handler(broadcast_handler)
+    dispatcher.add_handler(broadcast_status_handler)
+    dispatcher.add_handler(search_reviews_handler)
+    dispatcher.add_handler(review_trends_handler)
     dispatcher.add_handler(notify_about_new_chat_personally_handler)
     dispatcher.add_handler(delete_user_handler)
     dispatcher.add_handler(send_invite_link_personally_handler)
     dispatcher.add_handler(set_subscription_end_at_handler)
     dispatcher.add_handler(test_postponed_task_handler)
+    dispatcher.add_handler(estimate_jobs_handler)
     dispatcher.add_handler(contact_handler)
     dispatcher.add_handler(text_handler)
     dispatcher.add_handler(get_invitation_handler)
@@ -276,6 +350,37 @@ def main() -> None:
     dispatcher.add_handler(handler_change_phone_number)
     dispatcher.add_handler(handler_delete_subscription)
     dispatcher.add_handler(handler_free_subscription)
+    return None
+
+
+# Запускаем приём обновлений ботов клубов, которые ещё не запущены.
+# Вызывается при старте и после перечитывания настроек, поэтому
+# новый клуб начинает работать без перезапуска процесса.
+def start_polling() -> None:
+    with _polling_lock:
+        if shutting_down.is_set():
+            return None
+        for club in clubs_with_bots():
+            try:
+                updater = club_updaters.get(club.id)
+                if not updater.running:
+                    updater.start_polling()
+                    logger.info("Запущен бот клуба %s", club.slug)
+            except Exception as error:
+                logger.error("Не удалось запустить бота клуба %s: %s", club.slug, error)
+    return None
+
+
+def main() -> None:
+    # Устанавливаем вебхук
+    # webhook_url = f"https://{DOMAIN}/{TELEGRAM_WEBHOOK}/"
+    # club_updaters.bot(DEFAULT_CLUB_ID).setWebhook(webhook_url)
+    # Схема базы данных создаётся явно при запуске бота, а не при импорте
+    migrate()
+    # Настройки и модераторы перечитываются без перезапуска
+    settings.start()
+    # Отзыв ссылок и исключение участников выполняются в фоне
+    cleanup_worker.start(club_updaters)
 
     scheduler = BackgroundScheduler(timezone=MOSCOW_TZ)
 
@@ -286,72 +391,41 @@ def main() -> None:
         day=26,
         hour=14,
         minute=0,
-        args=[updater],
+        args=[club_updaters],
     )
-    # Задача с напоминанием о продлении подписки на
-    # 25-е число каждого месяца в 17:00 MSK
+    # Предложение вернуться пользователям без подписки
+    # в последнее число каждого месяца в 12:00 MSK
     scheduler.add_job(
-        get_first_reminder_to_renew_the_subscription,
-        "cron",
-        day=25,
-        hour=17,
-        minute=0,
-        args=[updater],
-    )
-    # Задача с напоминанием о продлении подписки на последнее
-    # число каждого месяца в 12:00 MSK
-    scheduler.add_job(
-        get_second_reminder_to_renew_the_subscription,
+        remind_lapsed_users,
         "cron",
         day="last",
         hour=12,
         minute=0,
-        args=[updater],
-    )
-    # Задача на первое число каждого месяца в 16:00 MSK
-    scheduler.add_job(
-        get_first_reminder_to_join_the_club,
-        "cron",
-        day=1,
-        hour=15,
-        minute=0,
-        args=[updater],
-    )
-    # Задача на первое число каждого месяца в 18:00 MSK
-    scheduler.add_job(
-        get_second_reminder_to_join_the_club,
-        "cron",
-        day=1,
-        hour=17,
-        minute=0,
-        args=[updater],
-    )
-    # Проверяем валидность подписки у всех пользователей
-    # первого числа каждого месяца в 18:10 MSK
-    scheduler.add_job(
-        check_subscription_validity,
-        "cron",
-        day=1,
-        hour=18,
-        minute=10,
-        args=[updater],
+        args=[club_updaters],
     )
-    # Задача для отправки инвайта новым подписчикам и сообщения о
-    # продлении старым на первое число каждого месяца в 12:00 MSK
+    # Приглашения, напоминания о вступлении и продлении и окончание подписок
+    # срабатывают по расписанию каждой подписки со сдвигом в пределах
+    # LIFECYCLE_SPREAD, а не в одну минуту для всех
     scheduler.add_job(
-        send_invite_link,
-        "cron",
-        day=1,
-        hour=12,
-        minute=0,
-        args=[updater],
+        handle_subscription_events,
+        "interval",
+        seconds=LIFECYCLE_POLL_INTERVAL,
+        args=[club_updaters],
     )
     # Задача для слияния пересекающихся подписок с интервалом в один день
     scheduler.add_job(
         handle_overlapping_subscriptions,
         "interval",
         minutes=10,
-        args=[updater],
+        args=[club_updaters],
+    )
+    # Сверка необработанных уведомлений об оплате каждую ночь в 03:00 MSK
+    scheduler.add_job(
+        reconcile_payments,
+        "cron",
+        hour=3,
+        minute=0,
+        args=[club_updaters],
     )
     # Задача для уведомления о новом чате-болталке
     # для пользователей, продливших подписку
@@ -361,14 +435,79 @@ def main() -> None:
         notify_about_new_chat,
         "date",
         run_date=execution_time,
-        args=[updater],
+        args=[club_updaters],
         replace_existing=True,
     )
 
+    # Рассылки, прерванные прошлой остановкой, продолжаем, когда прежний
+    # процесс гарантированно остановился
+    scheduler.add_job(
+        resume_broadcasts,
+        "date",
+        run_date=datetime.datetime.now(MOSCOW_TZ)
+        + datetime.timedelta(seconds=2 * SHUTDOWN_TIMEOUT),
+        args=[club_updaters],
+    )
+
     scheduler.start()
-    updater.start_polling()
-    updater.idle()
-    app.run(port=5001, debug=False)
+    start_polling()
+    settings.subscribe(lambda settings: start_polling())
+    # Фоновые части процесса бота, за которыми следит /healthz
+    health.watch("scheduler", lambda: scheduler.running)
+    health.watch(
+        "dispatchers",
+        lambda: all(
+            updater.dispatcher.running for updater in club_updaters.created().values()
+        ),
+    )
+    health.watch("settings_watcher", lambda: settings.watching)
+    health.watch("cleanup_worker", lambda: cleanup_worker.is_alive)
+    # Вместо updater.idle(): он останавливает только приём обновлений
+    # и ждёт обработчики без ограничения по времени
+    stop_requested = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop_requested.set())
+    while not stop_requested.wait(1):
+        pass
+    shutdown(scheduler)
+    return None
+
+
+# Плавная остановка по SIGTERM: перестаём получать обновления и запускать
+# задачи, дообрабатываем полученные обновления и ждём текущие задачи
+# не дольше SHUTDOWN_TIMEOUT секунд. Длинные задачи выходят после
+# зафиксированной пачки (shutdown.shutting_down). Затем дописываем логи.
+def shutdown(scheduler) -> None:
+    logger.info("Получен сигнал остановки, ждём текущие задачи")
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    shutting_down.set()
+    settings.stop()
+    cleanup_worker.stop()
+    with _polling_lock:
+        updaters = club_updaters.created()
+    pending = stop_all(
+        {
+            **{
+                f"updater:{club_id}": updater.stop
+                for club_id, updater in updaters.items()
+            },
+            "scheduler": scheduler.shutdown,
+            "cleanup_worker": cleanup_worker.join,
+        },
+        deadline,
+    )
+    if pending:
+        logger.error(
+            "Не остановились за %s секунд: %s", SHUTDOWN_TIMEOUT, ", ".join(pending)
+        )
+    else:
+        logger.info("Процесс остановлен")
+    stop_logging()
+    # Оставшиеся потоки задач не дали бы интерпретатору завершиться
+    # до SIGKILL. Их незафиксированные транзакции откатит Postgres.
+    if pending:
+        os._exit(1)
+    return None
 
 
 if __name__ == "__main__":
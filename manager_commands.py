@@ -1,37 +1,60 @@
 import datetime
-import time
-from io import BytesIO
+from itertools import chain
+from tempfile import SpooledTemporaryFile
 
-import pandas as pd
-from sqlalchemy import asc
+from sqlalchemy import asc, delete, select
+from sqlalchemy.orm import selectinload
 from telegram import Update
 from telegram.ext import CallbackContext
 
+from broadcast import (
+    AUDIENCES,
+    MODES,
+    broadcast_status,
+    create_broadcast,
+    run_broadcast,
+)
+from cleanup_queue import cleanup_worker, enqueue, subscription_cleanup_rows
+from clubs import context_club
 from constants import (
-    CHANNEL_ID,
-    CHAT_ID,
-    MODERATOR_IDS,
+    EXPORT_SPOOL_MAX_SIZE,
+    JOB_BATCH_SIZE,
+    MONTHS,
     MOSCOW_TZ,
-    PHONE_NUMBER_REGEX,
-    TEXT_INVITATION,
 )
-from database import Review, Session, Subscription, User
+from database import (
+    DELIVERY_BLOCKED,
+    DELIVERY_FAILED,
+    DELIVERY_PENDING,
+    DELIVERY_SENT,
+    Moderator,
+    Review,
+    ReviewExport,
+    Session,
+    Subscription,
+    User,
+    read_only,
+)
+from invite_links import LINK_CHANNEL, LINK_CHAT, ensure_subscription_links
+from message_templates import INVITATION, NEW_CHAT_NOTIFICATION
+from phone_numbers import canonical_phone_number
+from query_profiler import profiled
+from review_search import SEARCH_PAGE_SIZE, keyword_trends, search_reviews
+from settings import moderator_only, settings
+from shutdown import shutting_down
 from utils import (
     check_user_in_channel,
-    create_invite_link,
     create_session,
     logger,
-    update_subscription,
+    update_subscriptions,
 )
 
 
 # Установить конец подписки вручную через команду /set_subscription_end_at
+@profiled
+@moderator_only
 def set_subscription_end_at(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 2:
@@ -41,7 +64,8 @@ def set_subscription_end_at(update: Update, context: CallbackContext) -> None:
         )
         return None
     manual_datetime, phone_number = args
-    if not PHONE_NUMBER_REGEX.match(phone_number):
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
@@ -50,7 +74,7 @@ def set_subscription_end_at(update: Update, context: CallbackContext) -> None:
         manual_datetime = list(map(int, manual_datetime.split(":")))
         year, month, day, hour, minute = manual_datetime
     except Exception as error:
-        logger.error(f"Ошибка ввода конца подписки: {error}")
+        logger.error("Ошибка ввода конца подписки: %s", error)
         update.message.reply_text(
             "Вы где-то ошиблись в этом параметре: год:месяц:день:часы:минуты. Попробуйте снова."
             "Должно быть например: 2024:7:21:12:45"
@@ -60,10 +84,13 @@ def set_subscription_end_at(update: Update, context: CallbackContext) -> None:
     end_datetime = datetime.datetime(
         year=year, month=month, day=day, hour=hour, minute=minute
     )
+    club = context_club(context)
     with create_session() as session:
         try:
             user_id = (
-                session.query(User.id).filter(User.phone_number == phone_number).first()
+                session.query(User.id)
+                .filter(User.club_id == club.id, User.phone_number == phone_number)
+                .first()
             )
             # Получаем самую ближайшую подписку
             nearest_subscription = (
@@ -99,19 +126,17 @@ def set_subscription_end_at(update: Update, context: CallbackContext) -> None:
             )
         except Exception as error:
             session.rollback()
-            logger.error(f"Ошибка при set_subscription_end_at: {str(error)}")
+            logger.error("Ошибка при set_subscription_end_at: %s", error)
         finally:
             Session.remove()  # Удаляем сессию из контекста
     return None
 
 
 # По этой команде даём пользователю бесплатную подписку по номеру телефона
+@profiled
+@moderator_only
 def give_free_subscription(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Получаем номер телефона пользователя и количество месяцев из команды
     args = context.args
     if len(args) != 4:
@@ -119,12 +144,17 @@ def give_free_subscription(update: Update, context: CallbackContext) -> None:
             "Пожалуйста, введите команду в формате: /give_free_subscription "
             "номер_телефона количество_месяцев номер_стартового_месяца год_стартового_месяца\n"
             "Пример: /give_free_subscription +79998887776 1 9 2024\n"
+            "Несколько номеров можно перечислить через запятую без пробелов.\n"
             "Одним сообщением, в одну строку."
         )
         return None
     # Обрабатываем возможные ошибки при введении аргументов
-    phone_number, months, start_month, start_year = args
-    if not PHONE_NUMBER_REGEX.match(phone_number):
+    phone_numbers, months, start_month, start_year = args
+    phone_numbers = [
+        canonical_phone_number(phone_number)
+        for phone_number in phone_numbers.split(",")
+    ]
+    if not all(phone_numbers):
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
@@ -153,23 +183,35 @@ def give_free_subscription(update: Update, context: CallbackContext) -> None:
             "Пожалуйста, введите положительное количество месяцев."
         )
         return None
-    # Даём пользователю бесплатную подписку
-    update_subscription(months, phone_number, start_month, start_year, "-")
+    # Даём пользователям бесплатную подписку одной транзакцией
+    try:
+        update_subscriptions(
+            [
+                (months, phone_number, start_month, start_year, "-")
+                for phone_number in phone_numbers
+            ],
+            context_club(context).id,
+        )
+    except Exception:
+        update.message.reply_text("Не удалось предоставить подписку.")
+        return None
     # Отвечаем, что всё прошло успешно
+    if len(phone_numbers) == 1:
+        recipients = f"Пользователю с номером {phone_numbers[0]}"
+    else:
+        recipients = f"Пользователям ({len(phone_numbers)})"
     update.message.reply_text(
-        f"Пользователю с номером {phone_number} была предоставлена подписка на {months} месяцев, "
+        f"{recipients} была предоставлена подписка на {months} месяцев, "
         f"старт подписки {start_month} месяца {start_year} года."
     )
     return None
 
 
 # Функция для удаления ближайшей подписки пользователя
+@profiled
+@moderator_only
 def delete_subscription(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 1:
@@ -180,17 +222,19 @@ def delete_subscription(update: Update, context: CallbackContext) -> None:
         )
         return None
     phone_number = args[0]
-    if not PHONE_NUMBER_REGEX.match(phone_number):
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
         return None
+    club = context_club(context)
     with create_session() as session:
         try:
             # Проверяем наличие пользователя
             user_id = (
                 session.query(User.id)
-                .filter(User.phone_number == phone_number)
+                .filter(User.club_id == club.id, User.phone_number == phone_number)
                 .first()[0]
             )
             if not user_id:
@@ -210,30 +254,27 @@ def delete_subscription(update: Update, context: CallbackContext) -> None:
                     f"У пользователя {phone_number} нет подписки."
                 )
                 return None
-            # Отменяем ссылку-приглашение в канал и чат-болталку, если есть
-            if nearest_subscription.subscription_link:
-                try:
-                    context.bot.revoke_chat_invite_link(
-                        CHANNEL_ID, nearest_subscription.subscription_link
-                    )
-                    context.bot.revoke_chat_invite_link(
-                        CHAT_ID, nearest_subscription.chat_link
-                    )
-                except Exception as error:
-                    logger.error(
-                        f"Ошибка при отмене ссылки на канал или чат-болталку у подписки с id: {nearest_subscription.id}\n"
-                        f"error: {str(error)}"
-                    )
+            # Ссылки-приглашения в канал и чат-болталку отзываются
+            # в фоне после фиксации удаления
+            enqueue(
+                session,
+                subscription_cleanup_rows(
+                    club.id,
+                    nearest_subscription.subscription_link,
+                    nearest_subscription.chat_link,
+                ),
+            )
             # Удаляем подписку
             session.delete(nearest_subscription)
             # Фиксируем изменения в базе данных
             session.commit()
+            cleanup_worker.wake()
             # Сообщаем, что всё прошло успешно
             update.message.reply_text(
                 f"Ближайшая подписка пользователя {phone_number} успешно удалена."
             )
         except Exception as error:
-            logger.error(f"Ошибка при delete_subscription: {str(error)}")
+            logger.error("Ошибка при delete_subscription: %s", error)
             session.rollback()
         finally:
             Session.remove()
@@ -241,12 +282,10 @@ def delete_subscription(update: Update, context: CallbackContext) -> None:
 
 
 # Функция для изменения номера телефона пользователя
+@profiled
+@moderator_only
 def change_phone_number(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 2:
@@ -256,19 +295,20 @@ def change_phone_number(update: Update, context: CallbackContext) -> None:
         )
         return None
     old_phone_number, new_phone_number = args
-    if not PHONE_NUMBER_REGEX.match(old_phone_number) or not PHONE_NUMBER_REGEX.match(
-        new_phone_number
-    ):
+    old_phone_number = canonical_phone_number(old_phone_number)
+    new_phone_number = canonical_phone_number(new_phone_number)
+    if not old_phone_number or not new_phone_number:
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
         return None
+    club = context_club(context)
     with create_session() as session:
         try:
-            # Проверяем, не занят ли такой номер кем-либо ещё
+            # Проверяем, не занят ли такой номер кем-либо ещё в клубе
             user = (
                 session.query(User)
-                .filter(User.phone_number == new_phone_number)
+                .filter(User.club_id == club.id, User.phone_number == new_phone_number)
                 .first()
             )
             if user:
@@ -278,7 +318,7 @@ def change_phone_number(update: Update, context: CallbackContext) -> None:
                 return None
             user = (
                 session.query(User)
-                .filter(User.phone_number == old_phone_number)
+                .filter(User.club_id == club.id, User.phone_number == old_phone_number)
                 .first()
             )
             if not user:
@@ -295,70 +335,238 @@ def change_phone_number(update: Update, context: CallbackContext) -> None:
                 f"Номер телефона успешно изменён на {new_phone_number} у пользователя с прошлым номером: {old_phone_number}."
             )
         except Exception as error:
-            logger.error(f"Ошибка при change_phone_number: {str(error)}")
+            logger.error("Ошибка при change_phone_number: %s", error)
             session.rollback()
         finally:
             Session.remove()
     return None
 
 
+# Разбираем аргумент команды /get_all_reviews:
+# пусто - все отзывы, "new" - новые с прошлой выгрузки,
+# "since=2024-09-01" или "2024-09-01" - начиная с даты
+def parse_reviews_export_args(args: list) -> tuple:
+    if not args:
+        return False, None
+    if len(args) != 1:
+        raise ValueError("Слишком много аргументов")
+    value = args[0]
+    if value == "new":
+        return True, None
+    if value.startswith("since="):
+        value = value[len("since=") :]
+    return False, datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
 # Получаем все отзывы пользователей в файле excel
+@profiled
+@moderator_only
 def get_all_reviews(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
+    moderator_id = update.message.from_user.id
+    club = context_club(context)
+    try:
+        only_new, since = parse_reviews_export_args(context.args)
+    except ValueError:
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /get_all_reviews [new | since=год-месяц-день]\n"
+            "Без аргумента будут выгружены все отзывы, с new - только новые "
+            "с вашей прошлой выгрузки, с since=2024-09-01 - начиная с даты."
+        )
         return None
+    # Отзывы читаются с реплики, а отметка о выгрузке пишется в основную БД
+    reader = read_only()
     with create_session() as session:
-        # Запрашиваем данные из базы
-        query = session.query(
-            Review.review_text, User.phone_number, User.user_link
-        ).join(User)
-    Session.remove()
-    if query.count() == 0:
-        update.message.reply_text("Новых отзывов не найдено.")
-        return None
-    # Преобразуем результаты запроса в DataFrame
-    df = pd.read_sql(query.statement, query.session.bind)
-    # Переименовываем столбцы
-    df.columns = ["Текст отзыва", "Телефонный номер", "Ссылка на телеграм аккаунт"]
-    # Создаём Excel-файла в памяти
-    with BytesIO() as output:
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, sheet_name="Отзывы", index=False)
-            worksheet = writer.sheets["Отзывы"]
-            # Настройка ширины столбцов и перенос текста для длинных отзывов
-            for col in worksheet.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    # Определяем максимальную длину содержимого в ячейке
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(cell.value)
-                    except Exception:
-                        pass
-                # Устанавливаем ширину столбца
-                adjusted_width = max_length + 2
-                worksheet.column_dimensions[column].width = adjusted_width
-        output.seek(0)  # Перемещаемся к началу потока
-        # Отправляем файл пользователю
-        context.bot.send_document(
-            chat_id=update.effective_chat.id, document=output, filename="reviews.xlsx"
+        try:
+            query = (
+                select(Review.id, Review.review_text, User.phone_number, User.user_link)
+                .join(User)
+                .where(Review.club_id == club.id)
+                .order_by(Review.id)
+            )
+            last_export = session.get(ReviewExport, (moderator_id, club.id))
+            if only_new and last_export:
+                query = query.where(Review.id > last_export.last_review_id)
+            if since:
+                query = query.where(Review.created_at >= since)
+            # Читаем отзывы пачками через серверный курсор и сразу пишем их
+            # в книгу в режиме write_only, не держа всю таблицу в памяти
+            rows = reader.execute(query.execution_options(yield_per=JOB_BATCH_SIZE))
+            first_row = next(rows, None)
+            if first_row is None:
+                update.message.reply_text("Новых отзывов не найдено.")
+                return None
+            exported = {"last_review_id": first_row.id}
+
+            # Отдаём строки для листа и запоминаем id последнего отзыва
+            def review_rows():
+                for review_id, review_text, phone_number, user_link in chain(
+                    [first_row], rows
+                ):
+                    exported["last_review_id"] = review_id
+                    yield review_text, phone_number, user_link
+
+            # pandas и openpyxl нужны только выгрузкам, загружаем их при первом вызове
+            from exports import XlsxExport
+
+            export = XlsxExport()
+            export.add_rows(
+                "Отзывы",
+                ["Текст отзыва", "Телефонный номер", "Ссылка на телеграм аккаунт"],
+                review_rows(),
+                wrap_columns={"Текст отзыва"},
+            )
+            with SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as output:
+                export.save(output)
+                output.seek(0)  # Перемещаемся к началу потока
+                # Отправляем файл пользователю
+                context.bot.send_document(
+                    chat_id=update.effective_chat.id,
+                    document=output,
+                    filename="reviews.xlsx",
+                )
+            last_review_id = exported["last_review_id"]
+            # Запоминаем последний выгруженный модератором отзыв
+            if last_export:
+                last_export.last_review_id = max(
+                    last_export.last_review_id, last_review_id
+                )
+                last_export.exported_at = datetime.datetime.utcnow()
+            else:
+                session.add(
+                    ReviewExport(
+                        moderator_id=moderator_id,
+                        club_id=club.id,
+                        last_review_id=last_review_id,
+                    )
+                )
+            session.commit()
+        except Exception as error:
+            logger.error("Ошибка при get_all_reviews: %s", error)
+            session.rollback()
+        finally:
+            reader.close()
+            Session.remove()
+    return None
+
+
+def is_iso_date(value: str) -> bool:
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+# Разбираем аргументы команды /search_reviews: слова запроса,
+# необязательные "since=2024-09-01" (или просто дата последним словом)
+# и "page=2". Возвращает запрос, дату начала и номер страницы.
+def parse_search_reviews_args(args: list) -> tuple:
+    since, page, words = None, 1, []
+    for index, value in enumerate(args):
+        if value.startswith("since="):
+            since = datetime.datetime.strptime(value[len("since=") :], "%Y-%m-%d")
+        elif value.startswith("page="):
+            page = int(value[len("page=") :])
+            if page < 1:
+                raise ValueError(f"Некорректный номер страницы: {value}")
+        elif index == len(args) - 1 and words and is_iso_date(value):
+            since = datetime.datetime.strptime(value, "%Y-%m-%d")
+        else:
+            words.append(value)
+    if not words:
+        raise ValueError("Пустой запрос")
+    return " ".join(words), since, page
+
+
+def format_review_search_results(rows: list, first_number: int) -> str:
+    lines = []
+    for number, row in enumerate(rows, start=first_number):
+        author = " ".join(filter(None, [row.phone_number, row.user_link]))
+        lines.append(
+            f"{number}. {row.created_at:%Y-%m-%d} {author}\n{row.snippet}".strip()
+        )
+    return "\n\n".join(lines)
+
+
+# Полнотекстовый поиск по отзывам через команду /search_reviews
+@profiled
+@moderator_only
+def search_reviews_command(update: Update, context: CallbackContext) -> None:
+    try:
+        query_text, since, page = parse_search_reviews_args(context.args)
+    except ValueError:
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /search_reviews запрос [since=год-месяц-день] [page=номер]\n"
+            'Запрос понимает "точную фразу", -исключение и or.'
+        )
+        return None
+    with read_only() as session:
+        try:
+            rows, has_more = search_reviews(
+                session, context_club(context).id, query_text, since, page
+            )
+        except Exception as error:
+            logger.error("Ошибка при search_reviews: %s", error)
+            update.message.reply_text("Не удалось выполнить поиск.")
+            return None
+    if not rows:
+        update.message.reply_text("Отзывов по запросу не найдено.")
+        return None
+    text = format_review_search_results(rows, (page - 1) * SEARCH_PAGE_SIZE + 1)
+    if has_more:
+        next_args = " ".join(
+            value for value in context.args if not value.startswith("page=")
+        )
+        text += f"\n\nСледующая страница: /search_reviews {next_args} page={page + 1}"
+    update.message.reply_text(text)
+    return None
+
+
+# Самые частые слова в отзывах по месяцам через команду /review_trends
+@profiled
+@moderator_only
+def get_review_trends(update: Update, context: CallbackContext) -> None:
+    args = context.args
+    months = int(args[0]) if len(args) == 1 and args[0].isdigit() else 3
+    if len(args) > 1 or (args and not args[0].isdigit()) or not 0 < months <= 24:
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /review_trends [количество_месяцев]\n"
+            "По умолчанию - 3 последних месяца, не больше 24."
         )
+        return None
+    with read_only() as session:
+        periods, trends = keyword_trends(session, months)
+    if not trends:
+        update.message.reply_text("Отзывов за этот период нет.")
+        return None
+    lines = [
+        "Частые слова в отзывах (всего; "
+        + ", ".join(MONTHS[period.month][0] for period in periods)
+        + "):"
+    ]
+    for lexeme, total, counts in trends:
+        by_month = ", ".join(str(counts.get(period, 0)) for period in periods)
+        lines.append(f"{lexeme}: {total}; {by_month}")
+    update.message.reply_text("\n".join(lines))
     return None
 
 
 # Получаем всех пользователей в файле excel
+@profiled
+@moderator_only
 def get_all_users(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
-    with create_session() as session:
-        # Получаем всех пользователей
-        users = session.query(User).all()
+    club = context_club(context)
+    with read_only() as session:
+        # Получаем всех пользователей клуба, подписки всех пользователей
+        # загружаются вторым запросом, а не отдельно для каждого
+        users = (
+            session.query(User)
+            .options(selectinload(User.subscriptions))
+            .filter(User.club_id == club.id)
+            .all()
+        )
         # Преобразование данных в формат, подходящий для записи в Excel
         all_users_data = []
         subscribed_users_data = []
@@ -384,61 +592,56 @@ def get_all_users(update: Update, context: CallbackContext) -> None:
                 if user.subscriptions:
                     subscribed_users_data.append(user_data)
                     sub = user.subscriptions[0]
-                    if sub.start_datetime.tzinfo is None:
-                        sub.start_datetime = sub.start_datetime.replace(
-                            tzinfo=MOSCOW_TZ
-                        )
-                    if sub.end_datetime.tzinfo is None:
-                        sub.end_datetime = sub.end_datetime.replace(tzinfo=MOSCOW_TZ)
-                    if sub.start_datetime < now < sub.end_datetime:
+                    # Даты не меняем в объекте подписки: сессия только для чтения
+                    start_datetime = sub.start_datetime
+                    if start_datetime.tzinfo is None:
+                        start_datetime = start_datetime.replace(tzinfo=MOSCOW_TZ)
+                    end_datetime = sub.end_datetime
+                    if end_datetime.tzinfo is None:
+                        end_datetime = end_datetime.replace(tzinfo=MOSCOW_TZ)
+                    if start_datetime < now < end_datetime:
                         active_subscriptions_data.append(user_data)
-                        if not sub.user.telegram_id:
+                        if not user.telegram_id:
                             unjoined_users_data.append(user_data)
                             unjoined_in_chat_data.append(user_data)
                             continue
                         if not check_user_in_channel(
-                            context, sub.user.telegram_id, CHANNEL_ID
+                            context, user.telegram_id, club.channel_id
                         ):
                             unjoined_users_data.append(user_data)
                         if not check_user_in_channel(
-                            context, sub.user.telegram_id, CHAT_ID
+                            context, user.telegram_id, club.chat_id
                         ):
                             unjoined_in_chat_data.append(user_data)
             except Exception as error:
                 logger.error(
-                    f"Ошибка при get_all_users: {str(error)}\n"
-                    f"Телефонный номер: {user.phone_number}"
+                    "Ошибка при get_all_users: %s\nТелефонный номер: %s",
+                    error,
+                    user.phone_number,
                 )
-    Session.remove()
     # Создание DataFrame'ов из данных
+    # pandas и openpyxl нужны только выгрузкам, загружаем их при первом вызове
+    import pandas as pd
+
+    from exports import XlsxExport
+
     all_users_df = pd.DataFrame(all_users_data)
     subscribed_users_df = pd.DataFrame(subscribed_users_data)
     active_subscriptions_df = pd.DataFrame(active_subscriptions_data)
     unjoined_users_df = pd.DataFrame(unjoined_users_data)
     unjoined_in_chat_df = pd.DataFrame(unjoined_in_chat_data)
-    # Создание Excel-файла в памяти
-    with BytesIO() as output:
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            for df, sheet_name in [
-                (all_users_df, "Все пользователи"),
-                (subscribed_users_df, "Пользователи с подписками"),
-                (active_subscriptions_df, "Активные подписки"),
-                (unjoined_users_df, "Не вступили в канал"),
-                (unjoined_in_chat_df, "Не вступили в чат"),
-            ]:
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-                worksheet = writer.sheets[sheet_name]
-                for col in worksheet.columns:
-                    max_length = 0
-                    column = col[0].column_letter
-                    for cell in col:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(cell.value)
-                        except Exception:
-                            pass
-                    adjusted_width = max_length + 2
-                    worksheet.column_dimensions[column].width = adjusted_width
+    # Создание Excel-файла, ширина столбцов считается по данным
+    export = XlsxExport()
+    for df, sheet_name in [
+        (all_users_df, "Все пользователи"),
+        (subscribed_users_df, "Пользователи с подписками"),
+        (active_subscriptions_df, "Активные подписки"),
+        (unjoined_users_df, "Не вступили в канал"),
+        (unjoined_in_chat_df, "Не вступили в чат"),
+    ]:
+        export.add_dataframe(sheet_name, df)
+    with SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as output:
+        export.save(output)
         output.seek(0)  # Перемещаемся к началу потока
         # Отправляем файл пользователю
         context.bot.send_document(
@@ -448,12 +651,10 @@ def get_all_users(update: Update, context: CallbackContext) -> None:
 
 
 # Отправить ссылку-приглашение персонально одному пользователю
+@profiled
+@moderator_only
 def send_invite_link_personally(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 1:
@@ -463,14 +664,20 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
         )
         return None
     phone_number = args[0]
-    if not PHONE_NUMBER_REGEX.match(phone_number):
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
         return None
+    club = context_club(context)
     with create_session() as session:
         try:
-            user = session.query(User).filter(User.phone_number == phone_number).first()
+            user = (
+                session.query(User)
+                .filter(User.club_id == club.id, User.phone_number == phone_number)
+                .first()
+            )
             # Проверяем наличие пользователя
             if not user:
                 update.message.reply_text(
@@ -492,12 +699,11 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
             # Проверяем наличие ссылки-приглашения
             if nearest_subscription.subscription_link:
                 if user.telegram_id:
-                    context.bot.send_message(
-                        chat_id=user.telegram_id,
-                        text=TEXT_INVITATION.format(
-                            invite_link=nearest_subscription.subscription_link,
-                            chat_link=nearest_subscription.chat_link,
-                        ),
+                    INVITATION.send(
+                        context.bot,
+                        user.telegram_id,
+                        invite_link=nearest_subscription.subscription_link,
+                        chat_link=nearest_subscription.chat_link,
                     )
                     # Отвечаем, что всё прошло успешно
                     update.message.reply_text(
@@ -512,31 +718,20 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
             if nearest_subscription.start_datetime.astimezone(
                 MOSCOW_TZ
             ) <= datetime.datetime.now(MOSCOW_TZ):
-                # Создаём ссылку, если отсутствует
-                invite_link = create_invite_link(
-                    context.bot,
-                    nearest_subscription.end_datetime.astimezone(MOSCOW_TZ),
-                    CHANNEL_ID,
+                # Создаём ссылки, если отсутствуют
+                links = ensure_subscription_links(
+                    context.bot, nearest_subscription.id, pace=True
                 )
-                time.sleep(1)
-                chat_link = create_invite_link(
-                    context.bot,
-                    nearest_subscription.end_datetime.astimezone(MOSCOW_TZ),
-                    CHAT_ID,
-                )
-                time.sleep(1)
-                # Присваиваем инвайт конкретному пользователю
+                invite_link = links.get(LINK_CHANNEL)
+                chat_link = links.get(LINK_CHAT)
                 if invite_link and chat_link:
-                    nearest_subscription.subscription_link = invite_link
-                    nearest_subscription.chat_link = chat_link
-                    session.commit()
                     # Отправляем текст с инвайтом
                     if user.telegram_id:
-                        context.bot.send_message(
-                            chat_id=user.telegram_id,
-                            text=TEXT_INVITATION.format(
-                                invite_link=invite_link, chat_link=chat_link
-                            ),
+                        INVITATION.send(
+                            context.bot,
+                            user.telegram_id,
+                            invite_link=invite_link,
+                            chat_link=chat_link,
                         )
                         # Отвечаем, что всё прошло успешно
                         update.message.reply_text(
@@ -549,8 +744,9 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
                     )
                     return None
                 logger.error(
-                    f"Не удалось создать сhat_link или invite_link для телеграм id: {user.telegram_id}\n"
-                    "Соответственно сообщение-приглашение не отправлено при задаче send_invite_link"
+                    "Не удалось создать сhat_link или invite_link для телеграм id: %s\n"
+                    "Соответственно сообщение-приглашение не отправлено при задаче send_invite_link",
+                    user.telegram_id,
                 )
                 update.message.reply_text("Не удалось создать ссылку-приглашение.")
                 return None
@@ -558,7 +754,7 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
                 "Ссылка-приглашение не может быть создана, так как период подписки ещё не начался."
             )
         except Exception as error:
-            logger.error(f"Ошибка при send_invite_link_personally: {str(error)}")
+            logger.error("Ошибка при send_invite_link_personally: %s", error)
             session.rollback()
         finally:
             Session.remove()
@@ -566,12 +762,10 @@ def send_invite_link_personally(update: Update, context: CallbackContext) -> Non
 
 
 # Функция для удаления пользователя
+@profiled
+@moderator_only
 def delete_user(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 1:
@@ -581,28 +775,50 @@ def delete_user(update: Update, context: CallbackContext) -> None:
         )
         return None
     phone_number = args[0]
-    if not PHONE_NUMBER_REGEX.match(phone_number):
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
         update.message.reply_text(
             "Пожалуйста, введите номер телефона вида: +71112223331"
         )
         return None
+    club = context_club(context)
     with create_session() as session:
         try:
             # Проверяем наличие пользователя
-            user = session.query(User).filter(User.phone_number == phone_number).first()
+            user = (
+                session.query(User)
+                .filter(User.club_id == club.id, User.phone_number == phone_number)
+                .first()
+            )
             if not user:
                 update.message.reply_text(
                     "Пользователя с таким телефонным номером не существует."
                 )
                 return None
+            # Отзываем ссылки всех подписок и исключаем пользователя
+            # из канала и чата-болталки в фоне после фиксации удаления
+            cleanup_rows = list(
+                chain.from_iterable(
+                    subscription_cleanup_rows(
+                        club.id, subscription.subscription_link, subscription.chat_link
+                    )
+                    for subscription in user.subscriptions
+                )
+            )
+            if user.telegram_id:
+                cleanup_rows += subscription_cleanup_rows(
+                    club.id, None, None, user.telegram_id
+                )
+            enqueue(session, cleanup_rows)
             session.delete(user)
             session.commit()
+            cleanup_worker.wake()
             # Сообщаем, что всё прошло успешно
             update.message.reply_text(
                 f"Пользователь с номером {phone_number} успешно удален."
             )
         except Exception as error:
-            logger.error(f"Ошибка при delete_user: {str(error)}")
+            logger.error("Ошибка при delete_user: %s", error)
             session.rollback()
         finally:
             Session.remove()
@@ -610,12 +826,10 @@ def delete_user(update: Update, context: CallbackContext) -> None:
 
 
 # Отправляем уведомление о новом чате персонально
+@profiled
+@moderator_only
 def notify_about_new_chat_personally(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
     if len(args) != 1:
@@ -630,18 +844,14 @@ def notify_about_new_chat_personally(update: Update, context: CallbackContext) -
         return None
     telegram_id = int(telegram_id)
     bot = context.bot
-    notification_about_chat = (
-        "Ма френд, привет!:)\n\n"
-        "В этом месяце мы добавили новую функцию🪄\n"
-        "Важное нововведение❗️\n\n"
-        "Теперь у нас есть чат клуба, где мы можем с тобой и со всеми участниками клуба общаться!\n"
-        "Скорее переходи и вступай))\n\n"
-        "Ссылка-приглашение для вступления в чат клуба «Sensei, for real!?»:  {chat_link}\n\n"
-        "Жду тебя ✨"
-    )
+    club = context_club(context)
     with create_session() as session:
         try:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
+            user = (
+                session.query(User)
+                .filter(User.club_id == club.id, User.telegram_id == telegram_id)
+                .first()
+            )
             if not user:
                 update.message.reply_text(
                     "Пользователя с таким телеграм id не существует."
@@ -651,26 +861,24 @@ def notify_about_new_chat_personally(update: Update, context: CallbackContext) -
             if not subscription:
                 update.message.reply_text("У пользователя отсутствует подписка.")
                 return None
-            if not subscription.chat_link:
-                chat_link = create_invite_link(bot, subscription.end_datetime, CHAT_ID)
+            chat_link = subscription.chat_link
+            if not chat_link:
+                chat_link = ensure_subscription_links(
+                    bot, subscription.id, (LINK_CHAT,)
+                ).get(LINK_CHAT)
                 if not chat_link:
                     update.message.reply_text(
                         f"Не удалось создать ссылку для {user.telegram_id}"
                     )
                     return None
-                subscription.chat_link = chat_link
             try:
-                bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=notification_about_chat.format(
-                        chat_link=subscription.chat_link
-                    ),
-                )
+                NEW_CHAT_NOTIFICATION.send(bot, user.telegram_id, chat_link=chat_link)
             except Exception as error:
                 logger.error(
                     "Ошибка при отправки сообщения в notify_about_new_chat_personally "
-                    f"для пользователя с телеграм id: {user.telegram_id}\n"
-                    f"Ошибка: {str(error)}"
+                    "для пользователя с телеграм id: %s\nОшибка: %s",
+                    user.telegram_id,
+                    error,
                 )
             else:
                 update.message.reply_text(
@@ -678,8 +886,242 @@ def notify_about_new_chat_personally(update: Update, context: CallbackContext) -
                 )
             session.commit()
         except Exception as error:
-            logger.error(f"Ошибка при notify_about_new_chat: {str(error)}")
+            logger.error("Ошибка при notify_about_new_chat: %s", error)
+            session.rollback()
+        finally:
+            Session.remove()
+    return None
+
+
+# Разбираем номера сообщений рассылки в закрытом чате:
+# одно сообщение "12" или альбом "12-15"
+def parse_message_ids(value: str) -> list:
+    first, _, last = value.partition("-")
+    if not first.isdigit() or (last and not last.isdigit()):
+        raise ValueError(f"Некорректные номера сообщений: {value}")
+    first = int(first)
+    last = int(last) if last else first
+    # В альбоме Telegram не больше 10 сообщений
+    if not 0 <= last - first < 10:
+        raise ValueError(f"Некорректные номера сообщений: {value}")
+    return list(range(first, last + 1))
+
+
+def format_broadcast_statuses(statuses: dict) -> str:
+    return (
+        f"отправлено: {statuses.get(DELIVERY_SENT, 0)}, "
+        f"заблокировали бота: {statuses.get(DELIVERY_BLOCKED, 0)}, "
+        f"ошибки: {statuses.get(DELIVERY_FAILED, 0)}, "
+        f"в очереди: {statuses.get(DELIVERY_PENDING, 0)}"
+    )
+
+
+# Выполняем рассылку в отдельном потоке и сообщаем модератору итог
+def run_broadcast_and_report(bot, broadcast_id: int, chat_id: int) -> None:
+    statuses = run_broadcast(bot, broadcast_id)
+    # Остановка процесса прерывает рассылку, её продолжит resume_broadcasts
+    state = "приостановлена до перезапуска" if shutting_down.is_set() else "завершена"
+    bot.send_message(
+        chat_id=chat_id,
+        text=f"Рассылка {broadcast_id} {state}: "
+        f"{format_broadcast_statuses(statuses)}",
+    )
+    return None
+
+
+# Рассылка материала из закрытого чата копированием или пересылкой
+# через команду /broadcast
+@profiled
+@moderator_only
+def start_broadcast(update: Update, context: CallbackContext) -> None:
+    update.message.reply_text("Запрос обрабатывается...")
+    club = context_club(context)
+    if not club.staging_chat_id:
+        update.message.reply_text("Не задан закрытый чат для рассылок.")
+        return None
+    # Обрабатываем возможные ошибки при введении аргументов
+    args = context.args
+    replied = update.message.reply_to_message
+    if (
+        len(args) not in (2, 3)
+        or args[0] not in AUDIENCES
+        or args[1] not in MODES
+        or (len(args) == 2 and not replied)
+    ):
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: "
+            "/broadcast получатели режим номер_сообщения\n\n"
+            "получатели: all - все пользователи, subscribers - подписчики\n"
+            "режим: copy - от имени бота, forward - пересылкой\n"
+            "номер_сообщения: номер сообщения в закрытом чате для рассылок "
+            "или диапазон вида 12-15 для альбома.\n\n"
+            "Вместо номера можно ответить командой на сообщение, "
+            "оно будет один раз скопировано в закрытый чат."
+        )
+        return None
+    audience, mode = args[0], args[1]
+    staging_chat_id = int(club.staging_chat_id)
+    try:
+        if len(args) == 3:
+            message_ids = parse_message_ids(args[2])
+        elif replied.chat_id == staging_chat_id:
+            message_ids = [replied.message_id]
+        else:
+            # Публикуем материал в закрытый чат, дальше рассылаем только копии
+            message_ids = [
+                context.bot.copy_message(
+                    chat_id=staging_chat_id,
+                    from_chat_id=replied.chat_id,
+                    message_id=replied.message_id,
+                ).message_id
+            ]
+    except Exception as error:
+        update.message.reply_text(f"Не удалось подготовить рассылку: {error}")
+        return None
+    with create_session() as session:
+        try:
+            broadcast = create_broadcast(
+                session,
+                club.id,
+                mode,
+                audience,
+                staging_chat_id,
+                message_ids,
+                update.message.from_user.id,
+            )
+            session.commit()
+            broadcast_id = broadcast.id
+            statuses = broadcast_status(session, broadcast_id)
+        except Exception as error:
+            logger.error("Ошибка при start_broadcast: %s", error)
+            session.rollback()
+            update.message.reply_text("Не удалось создать рассылку.")
+            return None
+        finally:
+            Session.remove()
+    update.message.reply_text(
+        f"Рассылка {broadcast_id} запущена, получателей: "
+        f"{statuses.get(DELIVERY_PENDING, 0)}"
+    )
+    context.dispatcher.run_async(
+        run_broadcast_and_report, context.bot, broadcast_id, update.message.chat_id
+    )
+    return None
+
+
+# Статус доставки рассылки через команду /broadcast_status
+@profiled
+@moderator_only
+def get_broadcast_status(update: Update, context: CallbackContext) -> None:
+    args = context.args
+    if len(args) != 1 or not args[0].isdigit():
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /broadcast_status номер_рассылки"
+        )
+        return None
+    with create_session() as session:
+        try:
+            # Модератор видит только рассылки своего клуба
+            statuses = broadcast_status(session, int(args[0]), context_club(context).id)
+        finally:
+            Session.remove()
+    if not statuses:
+        update.message.reply_text("Такой рассылки не существует.")
+        return None
+    update.message.reply_text(
+        f"Рассылка {args[0]}: {format_broadcast_statuses(statuses)}"
+    )
+    return None
+
+
+# Добавляем модератора через команду /add_moderator
+@profiled
+@moderator_only
+def add_moderator(update: Update, context: CallbackContext) -> None:
+    args = context.args
+    if len(args) != 1 or not args[0].isdigit():
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /add_moderator телеграм_id"
+        )
+        return None
+    telegram_id = int(args[0])
+    club = context_club(context)
+    with create_session() as session:
+        try:
+            # Первый модератор клуба в реестре заменяет список по умолчанию,
+            # поэтому переносим в реестр и текущих модераторов
+            if not session.execute(
+                select(Moderator.telegram_id)
+                .where(Moderator.club_id == club.id)
+                .limit(1)
+            ).first():
+                for moderator_id in settings.moderator_ids(club.id):
+                    session.merge(Moderator(club_id=club.id, telegram_id=moderator_id))
+            session.merge(
+                Moderator(
+                    club_id=club.id,
+                    telegram_id=telegram_id,
+                    added_by=update.message.from_user.id,
+                )
+            )
+            session.commit()
+        except Exception as error:
+            logger.error("Ошибка при add_moderator: %s", error)
+            session.rollback()
+            update.message.reply_text("Не удалось добавить модератора.")
+            return None
+        finally:
+            Session.remove()
+    # Другие процессы узнают об изменении из уведомления БД
+    settings.reload()
+    update.message.reply_text(f"Пользователь {telegram_id} теперь модератор.")
+    return None
+
+
+# Удаляем модератора через команду /remove_moderator
+@profiled
+@moderator_only
+def remove_moderator(update: Update, context: CallbackContext) -> None:
+    args = context.args
+    if len(args) != 1 or not args[0].isdigit():
+        update.message.reply_text(
+            "Пожалуйста, введите команду в формате: /remove_moderator телеграм_id"
+        )
+        return None
+    telegram_id = int(args[0])
+    club = context_club(context)
+    moderator_ids = settings.moderator_ids(club.id)
+    if telegram_id not in moderator_ids:
+        update.message.reply_text("Такого модератора нет.")
+        return None
+    if moderator_ids == {telegram_id}:
+        update.message.reply_text("Нельзя удалить последнего модератора.")
+        return None
+    with create_session() as session:
+        try:
+            # Фиксируем в реестре текущий список клуба, если он ещё
+            # задан по умолчанию
+            if not session.execute(
+                select(Moderator.telegram_id)
+                .where(Moderator.club_id == club.id)
+                .limit(1)
+            ).first():
+                for moderator_id in moderator_ids:
+                    session.merge(Moderator(club_id=club.id, telegram_id=moderator_id))
+                session.flush()
+            session.execute(
+                delete(Moderator).where(
+                    Moderator.club_id == club.id, Moderator.telegram_id == telegram_id
+                )
+            )
+            session.commit()
+        except Exception as error:
+            logger.error("Ошибка при remove_moderator: %s", error)
             session.rollback()
+            update.message.reply_text("Не удалось удалить модератора.")
+            return None
         finally:
             Session.remove()
+    settings.reload()
+    update.message.reply_text(f"Пользователь {telegram_id} больше не модератор.")
     return None
@@ -0,0 +1,284 @@
+import html
+import json
+import re
+from html.parser import HTMLParser
+from string import Formatter
+from typing import Optional
+
+from constants import TEXT_INVITATION, THESE_ARE_YOUR_LINKS
+
+MARKDOWN = "Markdown"
+HTML = "HTML"
+# Ссылка Markdown вида [текст](адрес)
+MARKDOWN_LINK_REGEX = re.compile(r"\[[^\[\]]*\]\([^()\s]+\)")
+MARKDOWN_SPECIAL_REGEX = re.compile(r"([_*`\[])")
+HTML_ALLOWED_TAGS = {
+    "a",
+    "b",
+    "strong",
+    "i",
+    "em",
+    "u",
+    "ins",
+    "s",
+    "strike",
+    "del",
+    "code",
+    "pre",
+    "span",
+    "tg-spoiler",
+}
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+# Проверяем разметку Markdown (legacy): все сущности *, _, ` закрыты,
+# а квадратные скобки используются только в ссылках
+def validate_markdown(text: str) -> None:
+    stripped = MARKDOWN_LINK_REGEX.sub("", text.replace("\\\\", ""))
+    for char in "*_`[":
+        stripped = stripped.replace("\\" + char, "")
+    for char in "*_`":
+        if stripped.count(char) % 2:
+            raise TemplateError(f"Незакрытая сущность Markdown '{char}'")
+    if "[" in stripped:
+        raise TemplateError("Квадратная скобка Markdown вне ссылки")
+    return None
+
+
+class _HtmlValidator(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag not in HTML_ALLOWED_TAGS:
+            raise TemplateError(f"Тег <{tag}> не поддерживается Telegram")
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        if not self.stack or self.stack.pop() != tag:
+            raise TemplateError(f"Непарный закрывающий тег </{tag}>")
+
+
+# Проверяем разметку HTML: только теги Telegram и все теги закрыты
+def validate_html(text: str) -> None:
+    validator = _HtmlValidator()
+    validator.feed(text)
+    validator.close()
+    if validator.stack:
+        raise TemplateError(f"Незакрытый тег <{validator.stack[-1]}>")
+    return None
+
+
+def escape_markdown(value: str) -> str:
+    return MARKDOWN_SPECIAL_REGEX.sub(r"\\\1", value)
+
+
+def _json_string_body(value: str) -> bytes:
+    return json.dumps(value, ensure_ascii=False)[1:-1].encode("utf-8")
+
+
+# Шаблон сообщения, разобранный один раз при загрузке модуля.
+# Разметка проверяется сразу, а постоянная часть тела запроса sendMessage
+# заранее сериализована в JSON: при отправке в неё вставляются только
+# chat_id и значения полей.
+class MessageTemplate:
+    def __init__(self, name: str, text: str, parse_mode: Optional[str] = None):
+        self.name = name
+        self.text = text
+        self.parse_mode = parse_mode
+        self._parts = []
+        fields = []
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            if format_spec or conversion:
+                raise TemplateError(f"{name}: форматирование полей не поддерживается")
+            self._parts.append((literal, field_name))
+            if field_name is not None:
+                if not field_name.isidentifier():
+                    raise TemplateError(f"{name}: некорректное поле '{field_name}'")
+                fields.append(field_name)
+        self.fields = frozenset(fields)
+        # Разметку проверяем на тексте без подставляемых полей
+        skeleton = "".join(literal for literal, _ in self._parts)
+        try:
+            if parse_mode == MARKDOWN:
+                validate_markdown(skeleton)
+            elif parse_mode == HTML:
+                validate_html(skeleton)
+        except TemplateError as error:
+            raise TemplateError(f"{name}: {error}") from None
+        options = f',"parse_mode":"{parse_mode}"' if parse_mode else ""
+        self._payload_head = b'{"chat_id":'
+        self._payload_text_start = (options + ',"text":"').encode("utf-8")
+        self._payload_parts = [
+            (_json_string_body(literal), field_name)
+            for literal, field_name in self._parts
+        ]
+        self._payload_tail = b'"}'
+        # Шаблон без полей сериализуем целиком
+        self._static_text = (
+            b"".join(part for part, _ in self._payload_parts)
+            if not self.fields
+            else None
+        )
+
+    def _escape(self, value) -> str:
+        value = str(value)
+        if self.parse_mode == MARKDOWN:
+            return escape_markdown(value)
+        if self.parse_mode == HTML:
+            return html.escape(value, quote=False)
+        return value
+
+    def _check_fields(self, fields: dict) -> None:
+        if fields.keys() != self.fields:
+            raise TemplateError(
+                f"{self.name}: ожидались поля {sorted(self.fields)}, "
+                f"получены {sorted(fields)}"
+            )
+
+    # Готовый текст сообщения
+    def render(self, **fields) -> str:
+        self._check_fields(fields)
+        return "".join(
+            literal + (self._escape(fields[name]) if name is not None else "")
+            for literal, name in self._parts
+        )
+
+    # Готовое тело запроса sendMessage в JSON
+    def payload(self, chat_id: int, **fields) -> bytes:
+        self._check_fields(fields)
+        if self._static_text is not None:
+            text = self._static_text
+        else:
+            text = b"".join(
+                literal
+                + (
+                    _json_string_body(self._escape(fields[name]))
+                    if name is not None
+                    else b""
+                )
+                for literal, name in self._payload_parts
+            )
+        return b"".join(
+            (
+                self._payload_head,
+                str(int(chat_id)).encode(),
+                self._payload_text_start,
+                text,
+                self._payload_tail,
+            )
+        )
+
+    # Отправляем сообщение готовым телом запроса, минуя сборку словаря
+    # и разбор ответа в объект Message. Ошибки Bot API пробрасываются
+    # так же, как из bot.send_message.
+    def send(self, bot, chat_id: int, **fields) -> dict:
+        request = bot.request
+        result = request._request_wrapper(
+            "POST",
+            f"{bot.base_url}/sendMessage",
+            body=self.payload(chat_id, **fields),
+            headers=JSON_HEADERS,
+        )
+        return request._parse(result)
+
+
+INVITATION = MessageTemplate("invitation", TEXT_INVITATION)
+YOUR_LINKS = MessageTemplate("these_are_your_links", THESE_ARE_YOUR_LINKS)
+FEEDBACK_REQUEST = MessageTemplate(
+    "feedback_request",
+    "Мы стараемся улучшать сленг-клуб каждый день! "
+    "И будем рады получить вашу обратную связь:)\n"
+    "Пожалуйста, отправляйте отзыв одним сообщением, "
+    "нажав на кнопку 'Оставить отзыв'!\n"
+    "Заранее Благодарим 😉",
+    MARKDOWN,
+)
+FIRST_RENEW_REMINDER = MessageTemplate(
+    "first_renew_reminder",
+    "Ма френд, привет!🤗\n"
+    "Совсем скоро начнётся новый месяц, "
+    "а значит и новый период подписки на сленг-клуб «Sensei, for real!?» 🤍\n\n"
+    "Чтобы остаться в самом сленговом комьюнити и продолжить развивать "
+    "свой уровень языка, переходи по ссылке:\n"
+    "https://vasilisa-slang.ru/\n\n"
+    "Важное напоминание: контент в сленг-клубе сохраняется только на оплаченный период.\n\n"
+    "Как только подписка закончится - бот автоматически исключит тебя из сленг-клуба.🥺",
+    MARKDOWN,
+)
+SECOND_RENEW_REMINDER = MessageTemplate(
+    "second_renew_reminder",
+    "Ма френд, привет!:)\n"
+    "Сегодня последний день твоей подписки "
+    "сленг-клуба «Sensei, for real!?»\n\n"
+    "Не забудь [оплатить](https://vasilisa-slang.ru/), если хочешь сохранить контент и продолжить "
+    "вместе со мной совершенствовать свой английский🥳",
+    MARKDOWN,
+)
+# Без разметки, как отправлялось и раньше
+SECOND_RENEW_REMINDER_PLAIN = MessageTemplate(
+    "second_renew_reminder_plain", SECOND_RENEW_REMINDER.text
+)
+COME_BACK_REMINDER = MessageTemplate(
+    "come_back_reminder",
+    "Ма френд, привет!🙂\n"
+    "Недавно ты был участником нашего "
+    "сленг-клуба «Sensei, for real!!?», но что-то пошло не так и ты его покинул.\n\n"
+    "Если ты просто взял паузу, а теперь вновь хочешь присоединиться "
+    "к нашему коммьюнити, то это можно сделать по ссылке: "
+    "https://vasilisa-slang.ru/",
+)
+FIRST_JOIN_REMINDER = MessageTemplate(
+    "first_join_reminder",
+    "Как ответственный бот сленг-клуба «Sensei, for real!?» напоминаю "
+    "о том, что если ты оплатил подписку, то тебе необходимо самостоятельно "
+    "войти в сленг-клуб, чтобы не пропустить первую подборку.\n\n"
+    "❗️Обязательно убедись, что ты находишься в сленг-клубе "
+    "(да, сейчас он может быть пустым, если ты с нами впервые🫂)\n\n"
+    "Ну а если ты ещё думаешь, когда начать свою сленговую жизнь, то сейчас "
+    "самое время, ведь ты еще успеваешь присоединиться в этом месяце к нашему "
+    "комьюнити.\n\n"
+    "Для этого тебе нужно:\n"
+    "- [оплатить](https://vasilisa-slang.ru/) сленг-клуб\n"
+    "- через 10 минут запустить меня🤖\n\n"
+    "Оплаты на {month} закроются сегодня в 18:00. "
+    "Сразу после закрытия оплат будет первый пост🤗\n\n"
+    "Жду тебя✨",
+    MARKDOWN,
+)
+SECOND_JOIN_REMINDER = MessageTemplate(
+    "second_join_reminder",
+    "Как ответственный бот сленг-клуба «Sensei, for real!?», хочу "
+    "тебе напомнить о моём предыдущем сообщении, если ты по каким-либо "
+    "причинам не обратил на него внимание или просто забыл о нём, "
+    "будучи занятым важными делами.\n\n"
+    "Оно поможет тебе вовремя [вступить](https://vasilisa-slang.ru/) в сленг-клуб и не пропустить "
+    "ни капельки смешного и познавательного контента🤗\n\n"
+    "Жду тебя✨",
+    MARKDOWN,
+)
+SUBSCRIPTION_PROLONGED = MessageTemplate(
+    "subscription_prolonged",
+    "Ма френд, привет! ✨\n\n"
+    "Сегодня начинается новый период подписки на сленг-клуб **«Sensei, for real!?»**\n\n"
+    "Твоя подписка успешно продлена, дополнительных действий с твоей стороны не требуется.\n\n"
+    "Информация будет приходить в тот же чат, что и в предыдущем месяце.\n\n"
+    "Make the most of it ♥️",
+    MARKDOWN,
+)
+NEW_CHAT_NOTIFICATION = MessageTemplate(
+    "new_chat_notification",
+    "Ма френд, привет!:)\n\n"
+    "В этом месяце мы добавили новую функцию🪄\n"
+    "Важное нововведение❗️\n\n"
+    "Теперь у нас есть чат клуба, где мы можем с тобой и со всеми участниками клуба общаться!\n"
+    "Скорее переходи и вступай))\n\n"
+    "Ссылка-приглашение для вступления в чат клуба «Sensei, for real!?»:  {chat_link}\n\n"
+    "Жду тебя ✨",
+    MARKDOWN,
+)
@@ -0,0 +1,8 @@
+from database import migrate
+from utils import logger
+
+# Создаём недостающие таблицы и триггеры. Запускается при развёртывании
+# перед стартом бота и веб-сервера: python migrate.py
+if __name__ == "__main__":
+    migrate()
+    logger.info("Схема базы данных обновлена")
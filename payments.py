@@ -0,0 +1,68 @@
+import logging
+
+from sqlalchemy import insert
+
+from constants import DEFAULT_CLUB_ID
+from database import FailedPayment, session_factory
+from phone_numbers import canonical_phone_number
+
+logger = logging.getLogger(__name__)
+
+
+# Уведомление Tilda не содержит данных, нужных для начисления подписки
+class PaymentParseError(ValueError):
+    pass
+
+
+# Разбираем тело уведомления Tilda об оплате. Один и тот же разбор
+# используется вебхуком и сверкой оплат (reconciliation.py).
+# Возвращает (paid_months, phone_number, start_month, start_year, tg)
+# в том виде, в каком их принимают update_subscription(s).
+def parse_tilda_payment(data: dict) -> tuple:
+    phone_number = data.get("Phone")
+    if not phone_number:
+        raise PaymentParseError("В уведомлении отсутствует номер телефона.")
+    # Приводим номер к E.164 так же, как во всех остальных местах
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
+        raise PaymentParseError("В уведомлении некорректный номер телефона.")
+    # Количество месяцев - предпоследнее слово в имени товара:
+    # "Подписка на сленг-клуб 3 мес."
+    try:
+        product_name = (data.get("payment") or {}).get("products")[0].get("name")
+        paid_months = int(product_name.split()[-2])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        raise PaymentParseError(
+            "В уведомлении в имени товара отсутствует количество месяцев."
+        )
+    # Стартовый месяц в формате "2024-09-01"
+    try:
+        start_year, start_month, _ = data.get("month").split("-")
+        start_year, start_month = int(start_year), int(start_month)
+    except (AttributeError, TypeError, ValueError):
+        raise PaymentParseError(
+            "В уведомлении отсутствует начальный месяц или год подписки."
+        )
+    if paid_months < 1 or not 1 <= start_month <= 12:
+        raise PaymentParseError("В уведомлении некорректный срок подписки.")
+    tg = data.get("tg") or ""
+    tg = tg[1:] if tg.startswith("@") else tg
+    return paid_months, phone_number, start_month, start_year, tg
+
+
+# Сохраняем тело необработанного уведомления для повторного применения.
+# Ошибка записи не должна менять ответ вебхука, поэтому только логируется.
+def record_failed_payment(
+    data, error: Exception, club_id: int = DEFAULT_CLUB_ID
+) -> None:
+    try:
+        with session_factory() as session:
+            session.execute(
+                insert(FailedPayment).values(
+                    body=data, error=str(error), club_id=club_id
+                )
+            )
+            session.commit()
+    except Exception as record_error:
+        logger.error("Не удалось сохранить необработанную оплату: %s", record_error)
+    return None
@@ -0,0 +1,137 @@
+import logging
+import re
+from collections import Counter, defaultdict
+from typing import Optional
+
+from sqlalchemy import delete, select, update
+
+from database import Review, Subscription, User, session_factory
+
+logger = logging.getLogger(__name__)
+
+# Номер в формате E.164: "+", код страны и номер, от 8 до 15 цифр.
+# Короче 8 цифр номеров не бывает, а такие строки чаще всего не номера.
+E164_REGEX = re.compile(r"^\+[1-9]\d{7,14}$")
+NON_DIGITS_REGEX = re.compile(r"\D")
+# Код страны, который подставляется к российским номерам без кода
+DEFAULT_COUNTRY_CODE = "7"
+
+
+# Приводим номер телефона к единому виду E.164 (+79991234567) независимо
+# от того, как он набран: с пробелами, скобками, дефисами, без "+",
+# с международным префиксом 00 или российской восьмёркой.
+# Возвращает None, если строка не похожа на номер телефона.
+def canonical_phone_number(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    value = value.strip()
+    digits = NON_DIGITS_REGEX.sub("", value)
+    if not value.startswith("+"):
+        if digits.startswith("00"):
+            digits = digits[2:]
+        elif len(digits) == 11 and digits[0] == "8":
+            digits = DEFAULT_COUNTRY_CODE + digits[1:]
+        elif len(digits) == 10 and digits[0] == "9":
+            digits = DEFAULT_COUNTRY_CODE + digits
+    phone_number = "+" + digits
+    if not E164_REGEX.match(phone_number):
+        return None
+    return phone_number
+
+
+# Из пользователей с одним номером оставляем того, к кому привязан
+# телеграм, иначе самого раннего
+def _choose_survivor(users: list):
+    return min(users, key=lambda user: (user.telegram_id is None, user.id))
+
+
+# Разовое приведение сохранённых номеров к E.164. Пользователи одного
+# клуба, номера которых совпадают после приведения, объединяются: подписки
+# и отзывы переносятся к одному из них, остальные удаляются. Группы,
+# в которых к разным записям привязаны разные телеграм id, не трогаются
+# и попадают в лог для ручного разбора. Возвращает счётчики изменений.
+def backfill_phone_numbers(session, dry_run: bool = False) -> Counter:
+    stats = Counter()
+    groups = defaultdict(list)
+    users = session.execute(
+        select(
+            User.id, User.club_id, User.phone_number, User.telegram_id, User.user_link
+        )
+        .order_by(User.id)
+        .with_for_update()
+    ).all()
+    for user in users:
+        phone_number = canonical_phone_number(user.phone_number)
+        if phone_number is None:
+            logger.warning(
+                "Номер %s пользователя %s не удалось привести к E.164",
+                user.phone_number,
+                user.id,
+            )
+            stats["invalid"] += 1
+            continue
+        # Один номер в разных клубах - разные пользователи
+        groups[user.club_id, phone_number].append(user)
+    for (club_id, phone_number), group in groups.items():
+        survivor = _choose_survivor(group)
+        duplicates = [user for user in group if user.id != survivor.id]
+        telegram_ids = {user.telegram_id for user in group if user.telegram_id}
+        if len(telegram_ids) > 1:
+            logger.warning(
+                "Номер %s клуба %s привязан к разным телеграм id: %s, "
+                "объедините вручную",
+                phone_number,
+                club_id,
+                sorted(telegram_ids),
+            )
+            stats["conflicts"] += 1
+            continue
+        if duplicates:
+            duplicate_ids = [user.id for user in duplicates]
+            user_link = survivor.user_link or next(
+                (user.user_link for user in duplicates if user.user_link), None
+            )
+            if not dry_run:
+                session.execute(
+                    update(Subscription)
+                    .where(Subscription.user_id.in_(duplicate_ids))
+                    .values(user_id=survivor.id)
+                )
+                session.execute(
+                    update(Review)
+                    .where(Review.user_id.in_(duplicate_ids))
+                    .values(user_id=survivor.id)
+                )
+                session.execute(delete(User).where(User.id.in_(duplicate_ids)))
+                if user_link != survivor.user_link:
+                    session.execute(
+                        update(User)
+                        .where(User.id == survivor.id)
+                        .values(user_link=user_link)
+                    )
+            stats["merged"] += len(duplicates)
+        if survivor.phone_number != phone_number:
+            if not dry_run:
+                session.execute(
+                    update(User)
+                    .where(User.id == survivor.id)
+                    .values(phone_number=phone_number)
+                )
+            stats["normalized"] += 1
+    if dry_run:
+        session.rollback()
+    else:
+        session.commit()
+    return stats
+
+
+# Разовый запуск после обновления: python phone_numbers.py [--dry-run]
+if __name__ == "__main__":
+    import sys
+
+    # Логгер utils пишет в файл и консоль через общую настройку логгирования
+    from utils import logger
+
+    with session_factory() as session:
+        result = backfill_phone_numbers(session, dry_run="--dry-run" in sys.argv)
+    logger.info("Приведение номеров телефонов: %s", dict(result))
@@ -1,18 +1,65 @@
 import datetime
-import time
 
-from sqlalchemy import and_, extract, func
-from sqlalchemy.sql import exists
+from sqlalchemy import and_, delete, select
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from constants import CHANNEL_ID, CHAT_ID, MODERATOR_IDS, MONTHS, TEXT_INVITATION
-from database import Session, Subscription, User
-from utils import create_invite_link, create_session, kick_user_from_channel, logger
+from broadcast import run_broadcast, unfinished_broadcasts
+from cleanup_queue import cleanup_worker, enqueue, subscription_cleanup_rows
+from clubs import club_updaters, for_each_club
+from constants import JOB_BATCH_SIZE, MONTHS
+from database import (
+    COHORT_ANY_PERIOD,
+    COHORT_LAPSED,
+    COHORT_RENEWING,
+    COHORT_SUBSCRIBED,
+    CohortMember,
+    Session,
+    Subscription,
+    User,
+    read_only,
+)
+from invite_links import LINK_CHANNEL, LINK_CHAT, ensure_links_bulk
+from job_estimates import JOB_ESTIMATES, estimate_jobs, format_estimate
+from message_templates import (
+    COME_BACK_REMINDER,
+    FEEDBACK_REQUEST,
+    FIRST_JOIN_REMINDER,
+    FIRST_RENEW_REMINDER,
+    INVITATION,
+    NEW_CHAT_NOTIFICATION,
+    SECOND_JOIN_REMINDER,
+    SECOND_RENEW_REMINDER,
+    SECOND_RENEW_REMINDER_PLAIN,
+    SUBSCRIPTION_PROLONGED,
+)
+from query_profiler import profiled
+from reconciliation import reconcile_failed_payments
+from settings import moderator_only
+from shutdown import shutting_down, until_shutdown
+from subscription_events import process_subscription_events
+from utils import (
+    create_session,
+    logger,
+)
+
+
+# Получаем телеграм id участников когорты клуба одним индексным сканированием
+def cohort_telegram_ids(
+    session, club_id: int, cohort: str, period: datetime.date = COHORT_ANY_PERIOD
+) -> list:
+    return session.execute(
+        select(CohortMember.telegram_id).where(
+            CohortMember.club_id == club_id,
+            CohortMember.cohort == cohort,
+            CohortMember.period == period,
+        )
+    ).all()
 
 
 # Объединяем пересекающиеся подписки пользователей
-def handle_overlapping_subscriptions(updater) -> None:
+@profiled
+def handle_overlapping_subscriptions(updaters) -> None:
     with create_session() as session:
         try:
             # Получим id всех пользователей
@@ -61,7 +108,7 @@ def handle_overlapping_subscriptions(updater) -> None:
             # Сохраняем изменения в базе данных
             session.commit()
         except Exception as error:
-            logger.error(f"Ошибка при handle_overlapping_subscriptions: {str(error)}")
+            logger.error("Ошибка при handle_overlapping_subscriptions: %s", error)
             session.rollback()
         finally:
             Session.remove()  # Удаляем сессию из контекста
@@ -69,267 +116,247 @@ def handle_overlapping_subscriptions(updater) -> None:
 
 
 # Запрос обратной связи от всех пользователей 26 числа каждого месяца
-def request_feedback_from_all_users(updater) -> None:
-    bot = updater.bot
-    text = (
-        "Мы стараемся улучшать сленг-клуб каждый день! "
-        "И будем рады получить вашу обратную связь:)\n"
-        "Пожалуйста, отправляйте отзыв одним сообщением, "
-        "нажав на кнопку 'Оставить отзыв'!\n"
-        "Заранее Благодарим 😉"
-    )
-    with create_session() as session:
-        telegram_ids = session.query(User.telegram_id).all()
-        for telegram_id in telegram_ids:
-            chat_id = telegram_id[0]
-            if chat_id:
-                try:
-                    bot.send_message(chat_id=chat_id, text=text, parse_mode="markdown")
-                except Exception as error:
-                    logger.error(
-                        f"Ошибка при отправке сообщения пользователю с chat_id {chat_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный chat_id: None")
-    Session.remove()
+@profiled
+def request_feedback_from_all_users(updaters) -> None:
+    for_each_club(updaters, _request_feedback_from_all_users)
+    return None
+
+
+# request_feedback_from_all_users для одного клуба
+def _request_feedback_from_all_users(bot, club) -> None:
+    # Получателей читаем с реплики и закрываем сессию до начала отправки
+    with read_only() as session:
+        telegram_ids = (
+            session.query(User.telegram_id).filter(User.club_id == club.id).all()
+        )
+    for telegram_id in telegram_ids:
+        chat_id = telegram_id[0]
+        if chat_id:
+            try:
+                FEEDBACK_REQUEST.send(bot, chat_id)
+            except Exception as error:
+                logger.error(
+                    "Ошибка при отправке сообщения пользователю с chat_id %s: %s",
+                    chat_id,
+                    error,
+                )
+        else:
+            logger.error("Неверный chat_id: None")
     return None
 
 
 # Отправляем всем действующим подписчикам 25 числа
 # в 17:00 MSK напоминание о продлении подписки
-def get_first_reminder_to_renew_the_subscription(updater) -> None:
-    bot = updater.bot
-    text = (
-        "Ма френд, привет!🤗\n"
-        "Совсем скоро начнётся новый месяц, "
-        "а значит и новый период подписки на сленг-клуб «Sensei, for real!?» 🤍\n\n"
-        "Чтобы остаться в самом сленговом комьюнити и продолжить развивать "
-        "свой уровень языка, переходи по ссылке:\n"
-        "https://vasilisa-slang.ru/\n\n"
-        "Важное напоминание: контент в сленг-клубе сохраняется только на оплаченный период.\n\n"
-        "Как только подписка закончится - бот автоматически исключит тебя из сленг-клуба.🥺"
-    )
+@profiled
+def get_first_reminder_to_renew_the_subscription(updaters) -> None:
+    for_each_club(updaters, _get_first_reminder_to_renew_the_subscription)
+    return None
+
+
+# get_first_reminder_to_renew_the_subscription для одного клуба
+def _get_first_reminder_to_renew_the_subscription(bot, club) -> None:
     # Определяем текущую дату
     now = datetime.datetime.now()
-    # Находим первый и последний день текущего месяца
-    last_day_of_month = datetime.datetime(
-        now.year, now.month + 1, 1
+    # Находим последний день текущего месяца
+    last_day_of_month = (now.replace(day=1) + datetime.timedelta(days=32)).replace(
+        day=1
     ) - datetime.timedelta(days=1)
     # Получаем телеграм id пользователей, у которых подписка заканчивается в последний день месяца
-    with create_session() as session:
-        telegram_ids = (
-            session.query(User.telegram_id)
-            .join(Subscription)
-            .filter(
-                and_(
-                    extract("year", Subscription.end_datetime) == now.year,
-                    extract("month", Subscription.end_datetime) == now.month,
-                    extract("day", Subscription.end_datetime) == last_day_of_month.day,
-                )
-            )
-            .all()
+    with read_only() as session:
+        telegram_ids = cohort_telegram_ids(
+            session, club.id, COHORT_RENEWING, last_day_of_month.date()
         )
-        # Отправляем им соответствующее сообщение
-        for telegram_id in telegram_ids:
-            if telegram_id[0]:
-                try:
-                    bot.send_message(
-                        chat_id=telegram_id[0], text=text, parse_mode="markdown"
-                    )
-                except Exception as error:
-                    logger.error(
-                        "Задача get_first_reminder_to_renew_the_subscription\n"
-                        f"Ошибка при отправке сообщения пользователю с telegram_id {telegram_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный telegram_id: None")
-    Session.remove()
+    # Отправляем им соответствующее сообщение
+    for telegram_id in telegram_ids:
+        if telegram_id[0]:
+            try:
+                FIRST_RENEW_REMINDER.send(bot, telegram_id[0])
+            except Exception as error:
+                logger.error(
+                    "Задача get_first_reminder_to_renew_the_subscription\n"
+                    "Ошибка при отправке сообщения пользователю с telegram_id %s: %s",
+                    telegram_id[0],
+                    error,
+                )
+        else:
+            logger.error("Неверный telegram_id: None")
     return None
 
 
 # Отправляем подписчикам в последнее число месяца напоминание о продлении/возобновлении подписки в 12:00 MSK
-def get_second_reminder_to_renew_the_subscription(updater) -> None:
-    bot = updater.bot
-    renew_message = (
-        "Ма френд, привет!:)\n"
-        "Сегодня последний день твоей подписки "
-        "сленг-клуба «Sensei, for real!?»\n\n"
-        "Не забудь [оплатить](https://vasilisa-slang.ru/), если хочешь сохранить контент и продолжить "
-        "вместе со мной совершенствовать свой английский🥳"
-    )
-    prolong_message = (
-        "Ма френд, привет!🙂\n"
-        "Недавно ты был участником нашего "
-        "сленг-клуба «Sensei, for real!!?», но что-то пошло не так и ты его покинул.\n\n"
-        "Если ты просто взял паузу, а теперь вновь хочешь присоединиться "
-        "к нашему коммьюнити, то это можно сделать по ссылке: "
-        "https://vasilisa-slang.ru/"
-    )
+@profiled
+def get_second_reminder_to_renew_the_subscription(updaters) -> None:
+    for_each_club(updaters, _get_second_reminder_to_renew_the_subscription)
+    return None
+
+
+# get_second_reminder_to_renew_the_subscription для одного клуба
+def _get_second_reminder_to_renew_the_subscription(bot, club) -> None:
     # Определяем текущую дату
     now = datetime.datetime.now()
     today = now.date()
-    with create_session() as session:
+    with read_only() as session:
         # Получаем все telegram_id подписок, заканчивающихся сегодня
-        renew_ids = (
-            session.query(User.telegram_id)
-            .join(Subscription)
-            .filter(func.date(Subscription.end_datetime) == today)
-            .all()
-        )
-        # Получаем телеграм id пользователей, у которых все подписки закончились
-        ids_without_subscriptions = (
-            session.query(User.telegram_id)
-            .filter(~exists().where(Subscription.user_id == User.id))
-            .all()
-        )
-        # Отправляем всем полученным пользователям соответствующее сообщение
-        for telegram_id in renew_ids:
-            if telegram_id[0]:
-                try:
-                    bot.send_message(
-                        chat_id=telegram_id[0],
-                        text=renew_message,
-                        parse_mode="markdown",
-                    )
-                except Exception as error:
-                    logger.error(
-                        "Задача get_second_reminder_to_renew_the_subscription\n"
-                        f"Ошибка при отправке сообщения пользователю с telegram_id {telegram_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный telegram_id: None")
-        for telegram_id in ids_without_subscriptions:
-            bot.send_message(chat_id=telegram_id[0], text=prolong_message)
-            if telegram_id[0]:
-                try:
-                    bot.send_message(chat_id=telegram_id[0], text=renew_message)
-                except Exception as error:
-                    logger.error(
-                        "Задача get_second_reminder_to_renew_the_subscription\n"
-                        f"Ошибка при отправке сообщения пользователю с telegram_id {telegram_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный telegram_id: None")
-    Session.remove()
+        renew_ids = cohort_telegram_ids(session, club.id, COHORT_RENEWING, today)
+    # Отправляем всем полученным пользователям соответствующее сообщение
+    for telegram_id in renew_ids:
+        if telegram_id[0]:
+            try:
+                SECOND_RENEW_REMINDER.send(bot, telegram_id[0])
+            except Exception as error:
+                logger.error(
+                    "Задача get_second_reminder_to_renew_the_subscription\n"
+                    "Ошибка при отправке сообщения пользователю с telegram_id %s: %s",
+                    telegram_id[0],
+                    error,
+                )
+        else:
+            logger.error("Неверный telegram_id: None")
+    _remind_lapsed_users(bot, club)
+    return None
+
+
+# Предлагаем вернуться пользователям, у которых все подписки закончились,
+# в последнее число месяца в 12:00 MSK
+@profiled
+def remind_lapsed_users(updaters) -> None:
+    for_each_club(updaters, _remind_lapsed_users)
+    return None
+
+
+# remind_lapsed_users для одного клуба
+def _remind_lapsed_users(bot, club) -> None:
+    # Получаем телеграм id пользователей, у которых все подписки закончились
+    with read_only() as session:
+        ids_without_subscriptions = cohort_telegram_ids(session, club.id, COHORT_LAPSED)
+    for telegram_id in ids_without_subscriptions:
+        if telegram_id[0]:
+            try:
+                COME_BACK_REMINDER.send(bot, telegram_id[0])
+                SECOND_RENEW_REMINDER_PLAIN.send(bot, telegram_id[0])
+            except Exception as error:
+                logger.error(
+                    "Задача remind_lapsed_users\n"
+                    "Ошибка при отправке сообщения пользователю с telegram_id %s: %s",
+                    telegram_id[0],
+                    error,
+                )
+        else:
+            logger.error("Неверный telegram_id: None")
     return None
 
 
 # Отправляем напоминание всем подписчикам первого число месяца в 15:00 по MSK
-def get_first_reminder_to_join_the_club(updater) -> None:
-    bot = updater.bot
-    with create_session() as session:
-        telegram_ids = session.query(User.telegram_id).all()
-        text = (
-            "Как ответственный бот сленг-клуба «Sensei, for real!?» напоминаю "
-            "о том, что если ты оплатил подписку, то тебе необходимо самостоятельно "
-            "войти в сленг-клуб, чтобы не пропустить первую подборку.\n\n"
-            "❗️Обязательно убедись, что ты находишься в сленг-клубе "
-            "(да, сейчас он может быть пустым, если ты с нами впервые🫂)\n\n"
-            "Ну а если ты ещё думаешь, когда начать свою сленговую жизнь, то сейчас "
-            "самое время, ведь ты еще успеваешь присоединиться в этом месяце к нашему "
-            "комьюнити.\n\n"
-            "Для этого тебе нужно:\n"
-            "- [оплатить](https://vasilisa-slang.ru/) сленг-клуб\n"
-            "- через 10 минут запустить меня🤖\n\n"
-            f"Оплаты на {MONTHS[datetime.datetime.now().month][0]} закроются сегодня в 18:00. "
-            "Сразу после закрытия оплат будет первый пост🤗\n\n"
-            "Жду тебя✨"
+@profiled
+def get_first_reminder_to_join_the_club(updaters) -> None:
+    for_each_club(updaters, _get_first_reminder_to_join_the_club)
+    return None
+
+
+# get_first_reminder_to_join_the_club для одного клуба
+def _get_first_reminder_to_join_the_club(bot, club) -> None:
+    with read_only() as session:
+        telegram_ids = (
+            session.query(User.telegram_id).filter(User.club_id == club.id).all()
         )
-        for telegram_id in telegram_ids:
-            chat_id = telegram_id[0]
-            if chat_id:
-                try:
-                    bot.send_message(chat_id=chat_id, text=text, parse_mode="markdown")
-                except Exception as error:
-                    logger.error(
-                        "Задача get_first_reminder_to_join_the_club\n"
-                        f"Ошибка при отправке сообщения пользователю с chat_id {chat_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный chat_id: None")
-    Session.remove()
+    month = MONTHS[datetime.datetime.now().month][0]
+    for telegram_id in telegram_ids:
+        chat_id = telegram_id[0]
+        if chat_id:
+            try:
+                FIRST_JOIN_REMINDER.send(bot, chat_id, month=month)
+            except Exception as error:
+                logger.error(
+                    "Задача get_first_reminder_to_join_the_club\n"
+                    "Ошибка при отправке сообщения пользователю с chat_id %s: %s",
+                    chat_id,
+                    error,
+                )
+        else:
+            logger.error("Неверный chat_id: None")
     return None
 
 
 # Отправляем напоминание подписчикам первого число месяца в 17:00 по MSK
-def get_second_reminder_to_join_the_club(updater) -> None:
-    bot = updater.bot
-    with create_session() as session:
-        # Получаем подписки с заполненным полем subscription_link
-        ids_with_subscriptions = (
-            session.query(User.telegram_id)
-            .filter(exists().where(Subscription.user_id == User.id))
-            .all()
-        )
-        text = (
-            "Как ответственный бот сленг-клуба «Sensei, for real!?», хочу "
-            "тебе напомнить о моём предыдущем сообщении, если ты по каким-либо "
-            "причинам не обратил на него внимание или просто забыл о нём, "
-            "будучи занятым важными делами.\n\n"
-            "Оно поможет тебе вовремя [вступить](https://vasilisa-slang.ru/) в сленг-клуб и не пропустить "
-            "ни капельки смешного и познавательного контента🤗\n\n"
-            "Жду тебя✨"
+@profiled
+def get_second_reminder_to_join_the_club(updaters) -> None:
+    for_each_club(updaters, _get_second_reminder_to_join_the_club)
+    return None
+
+
+# get_second_reminder_to_join_the_club для одного клуба
+def _get_second_reminder_to_join_the_club(bot, club) -> None:
+    # Получаем пользователей, у которых есть подписка
+    with read_only() as session:
+        ids_with_subscriptions = cohort_telegram_ids(
+            session, club.id, COHORT_SUBSCRIBED
         )
-        for telegram_id in ids_with_subscriptions:
-            if telegram_id[0]:
-                try:
-                    bot.send_message(
-                        chat_id=telegram_id[0], text=text, parse_mode="markdown"
-                    )
-                except Exception as error:
-                    logger.error(
-                        "Задача get_second_reminder_to_join_the_club\n"
-                        f"Ошибка при отправке сообщения пользователю с telegram_id {telegram_id}: {error}"
-                    )
-            else:
-                logger.error("Неверный chat_id: None")
-    Session.remove()
+    for telegram_id in ids_with_subscriptions:
+        if telegram_id[0]:
+            try:
+                SECOND_JOIN_REMINDER.send(bot, telegram_id[0])
+            except Exception as error:
+                logger.error(
+                    "Задача get_second_reminder_to_join_the_club\n"
+                    "Ошибка при отправке сообщения пользователю с telegram_id %s: %s",
+                    telegram_id[0],
+                    error,
+                )
+        else:
+            logger.error("Неверный chat_id: None")
     return None
 
 
 # Проверям валидность подписки 1ого числа в 18:10 MSK
-def check_subscription_validity(updater) -> None:
-    bot = updater.bot
+@profiled
+def check_subscription_validity(updaters) -> None:
+    now = datetime.datetime.now()
     with create_session() as session:
         try:
-            # Получаем все истекшие подписки
-            expired_subscriptions = (
-                session.query(Subscription)
-                .with_for_update()
-                .filter(Subscription.end_datetime < datetime.datetime.now())
-                .all()
-            )
-            # Удаляем все истекшие подписки
-            for subscription in expired_subscriptions:
-                if subscription.subscription_link:
-                    try:
-                        bot.revoke_chat_invite_link(
-                            CHANNEL_ID, subscription.subscription_link
-                        )
-                    except Exception as error:
-                        logger.error(
-                            "Бот не смог отозвать ссылку-приглашение в клуб у пользователя: "
-                            f"{subscription.user.phone_number}, "
-                            "возможно она была создана другим администратором.\n"
-                            f"Error: {error}"
-                        )
-                    try:
-                        bot.revoke_chat_invite_link(CHAT_ID, subscription.chat_link)
-                    except Exception as error:
-                        logger.error(
-                            "Бот не смог отозвать ссылку-приглашение в чат-болталку у пользователя: "
-                            f"{subscription.user.phone_number}, "
-                            "возможно она была создана другим администратором.\n"
-                            f"Error: {error}"
-                        )
-                session.delete(subscription)
-                # Исключаем из канала и чата-болталки
-                kick_user_from_channel(bot, subscription.user.telegram_id, CHANNEL_ID)
-                kick_user_from_channel(bot, subscription.user.telegram_id, CHAT_ID)
-            # Фиксируем изменения в базе данных
-            session.commit()
+            # Разбираем истекшие подписки пачками. Каждая пачка (намерения
+            # очистки и удаление подписок) фиксируется отдельно, поэтому
+            # при остановке процесса сделанное сохраняется, а остальное
+            # удалит следующий запуск
+            while not shutting_down.is_set():
+                batch = session.execute(
+                    select(
+                        Subscription.id,
+                        Subscription.subscription_link,
+                        Subscription.chat_link,
+                        User.telegram_id,
+                        Subscription.club_id,
+                    )
+                    .join(User, Subscription.user_id == User.id)
+                    .filter(Subscription.end_datetime < now)
+                    .order_by(Subscription.id)
+                    .limit(JOB_BATCH_SIZE)
+                    .with_for_update(of=Subscription)
+                ).all()
+                if not batch:
+                    break
+                # Отзыв ссылок и исключение из канала и чата-болталки
+                # выполнит очередь очистки после фиксации удаления
+                cleanup_rows = []
+                expired_ids = []
+                for (
+                    subscription_id,
+                    subscription_link,
+                    chat_link,
+                    telegram_id,
+                    club_id,
+                ) in batch:
+                    cleanup_rows += subscription_cleanup_rows(
+                        club_id, subscription_link, chat_link, telegram_id
+                    )
+                    expired_ids.append(subscription_id)
+                enqueue(session, cleanup_rows)
+                session.execute(
+                    delete(Subscription).where(Subscription.id.in_(expired_ids))
+                )
+                session.commit()
+                cleanup_worker.wake()
         except Exception as error:
-            logger.error(f"Ошибка при check_subscription_validity: {str(error)}")
+            logger.error("Ошибка при check_subscription_validity: %s", error)
             session.rollback()
         finally:
             Session.remove()
@@ -337,92 +364,105 @@ def check_subscription_validity(updater) -> None:
 
 
 # Отправляем ссылку-приглашение новым подписчикам и сообщении о продлении старым в 12:00 MSK
-def send_invite_link(updater) -> None:
-    bot = updater.bot
-    text_prolonged = (
-        "Ма френд, привет! ✨\n\n"
-        "Сегодня начинается новый период подписки на сленг-клуб **«Sensei, for real!?»**\n\n"
-        "Твоя подписка успешно продлена, дополнительных действий с твоей стороны не требуется.\n\n"
-        "Информация будет приходить в тот же чат, что и в предыдущем месяце.\n\n"
-        "Make the most of it ♥️"
-    )
+@profiled
+def send_invite_link(updaters) -> None:
+    for_each_club(updaters, _send_invite_link)
+    return None
+
+
+# send_invite_link для одного клуба
+def _send_invite_link(bot, club) -> None:
     with create_session() as session:
         try:
             now = datetime.datetime.utcnow()
             yesterday = now - datetime.timedelta(days=1)
-            # Получаем telegram_id пользователей с новыми подписками
-            new_subscriptions = (
-                session.query(Subscription, User.telegram_id)
-                .with_for_update()
+            # Получаем telegram_id пользователей с новыми подписками.
+            # Строки не блокируются: право на создание ссылок каждой
+            # подписки захватывает сервис ссылок
+            new_subscriptions = session.execute(
+                select(Subscription.id, User.telegram_id)
                 .join(User, Subscription.user_id == User.id)
-                .filter(Subscription.start_datetime > yesterday)
-                .all()
+                .filter(
+                    Subscription.club_id == club.id,
+                    Subscription.start_datetime > yesterday,
+                )
+                .execution_options(yield_per=JOB_BATCH_SIZE)
             )
+            for batch in until_shutdown(
+                new_subscriptions.partitions(), "send_invite_link"
+            ):
+                # Создаём инвайты в канал и чат-болталку, если их ещё нет
+                links = ensure_links_bulk(
+                    bot, [subscription_id for subscription_id, _ in batch]
+                )
+                # Отправляем соответствующие сообщения пользователям
+                for subscription_id, telegram_id in batch:
+                    invite_link = links.get(subscription_id, {}).get(LINK_CHANNEL)
+                    chat_link = links.get(subscription_id, {}).get(LINK_CHAT)
+                    if not (invite_link and chat_link):
+                        logger.error(
+                            "Не удалось создать сhat_link или invite_link для телеграм id: %s\n"
+                            "Соответственно сообщение-приглашение не отправлено при задаче send_invite_link",
+                            telegram_id,
+                        )
+                        continue
+                    # Отправляем текст с инвайтом
+                    try:
+                        INVITATION.send(
+                            bot,
+                            telegram_id,
+                            invite_link=invite_link,
+                            chat_link=chat_link,
+                        )
+                    except Exception as error:
+                        logger.error(
+                            "В процессе задачи send_invite_link "
+                            "Ошибка при отправке сообщения пользователю %s: %s",
+                            telegram_id,
+                            error,
+                        )
             # Получаем телеграм id пользователей с продленными подписками
-            prolonged_users = (
-                session.query(User.telegram_id, Subscription)
-                .with_for_update()
+            prolonged_users = session.execute(
+                select(User.telegram_id, Subscription.id, Subscription.chat_link)
                 .join(Subscription, User.id == Subscription.user_id)
                 .filter(
                     and_(
+                        Subscription.club_id == club.id,
                         Subscription.start_datetime
                         < yesterday,  # Подписка началась до вчерашнего дня
                         Subscription.end_datetime
                         > now,  # Подписка еще активна на данный момент
                     )
                 )
-                .all()
+                .execution_options(yield_per=JOB_BATCH_SIZE)
             )
-            # Отправляем соответствующие сообщения пользователям
-            for subscription, telegram_id in new_subscriptions:
-                # Создаём инвайты в канал и чат-болталку
-                invite_link = create_invite_link(
-                    bot, subscription.end_datetime, CHANNEL_ID
+            for batch in until_shutdown(
+                prolonged_users.partitions(), "send_invite_link"
+            ):
+                # Создаём недостающие ссылки на чат-болталку
+                ensure_links_bulk(
+                    bot,
+                    [
+                        subscription_id
+                        for _, subscription_id, chat_link in batch
+                        if not chat_link
+                    ],
+                    (LINK_CHAT,),
                 )
-                time.sleep(1)
-                chat_link = create_invite_link(bot, subscription.end_datetime, CHAT_ID)
-                time.sleep(1)
-                # Присваиваем инвайт конкретному пользователю
-                if invite_link and chat_link:
-                    subscription.subscription_link = invite_link
-                    subscription.chat_link = chat_link
-                    # Отправляем текст с инвайтом
+                for telegram_id, _, _ in batch:
                     try:
-                        bot.send_message(
-                            chat_id=telegram_id,
-                            text=TEXT_INVITATION.format(
-                                invite_link=invite_link, chat_link=chat_link
-                            ),
-                        )
+                        SUBSCRIPTION_PROLONGED.send(bot, telegram_id)
                     except Exception as error:
                         logger.error(
-                            "В процессе задачи send_invite_link"
-                            f"Ошибка при отправке сообщения пользователю {telegram_id}: {error}"
+                            "В процессе задачи send_invite_link "
+                            "Ошибка при отправке сообщения пользователю %s: %s",
+                            telegram_id,
+                            error,
                         )
-                else:
-                    logger.error(
-                        f"Не удалось создать сhat_link или invite_link для телеграм id: {telegram_id}\n"
-                        "Соответственно сообщение-приглашение не отправлено при задаче send_invite_link"
-                    )
-            for telegram_id, subscription in prolonged_users:
-                if not subscription.chat_link:
-                    chat_link = create_invite_link(
-                        bot, subscription.end_datetime, CHAT_ID
-                    )
-                    subscription.chat_link = chat_link
-                try:
-                    bot.send_message(
-                        chat_id=telegram_id, text=text_prolonged, parse_mode="markdown"
-                    )
-                except Exception as error:
-                    logger.error(
-                        "В процессе задачи send_invite_link"
-                        f"Ошибка при отправке сообщения пользователю {telegram_id}: {error}"
-                    )
             # Сохраняем изменения в базе данных
             session.commit()
         except Exception as error:
-            logger.error(f"Ошибка при send_invite_link: {str(error)}")
+            logger.error("Ошибка при send_invite_link: %s", error)
             session.rollback()
         finally:
             Session.remove()
@@ -430,81 +470,135 @@ def send_invite_link(updater) -> None:
 
 
 # Отправляем уведомление подписчикам, продлившим подписку, о новом чате-болталке в 12:05 MSK
-def notify_about_new_chat(updater) -> None:
-    bot = updater.bot
-    notification_about_chat = (
-        "Ма френд, привет!:)\n\n"
-        "В этом месяце мы добавили новую функцию🪄\n"
-        "Важное нововведение❗️\n\n"
-        "Теперь у нас есть чат клуба, где мы можем с тобой и со всеми участниками клуба общаться!\n"
-        "Скорее переходи и вступай))\n\n"
-        "Ссылка-приглашение для вступления в чат клуба «Sensei, for real!?»:  {chat_link}\n\n"
-        "Жду тебя ✨"
-    )
+@profiled
+def notify_about_new_chat(updaters) -> None:
+    for_each_club(updaters, _notify_about_new_chat)
+    return None
+
+
+# notify_about_new_chat для одного клуба
+def _notify_about_new_chat(bot, club) -> None:
     with create_session() as session:
         try:
             now = datetime.datetime.utcnow()
             yesterday = now - datetime.timedelta(days=1)
             # Получаем телеграм id пользователей с продленными подписками
-            prolonged_users = (
-                session.query(User.telegram_id, Subscription)
+            prolonged_users = session.execute(
+                select(User.telegram_id, Subscription.id, Subscription.chat_link)
                 .join(Subscription, User.id == Subscription.user_id)
                 .filter(
                     and_(
+                        Subscription.club_id == club.id,
+                        User.telegram_id.is_not(None),
                         Subscription.start_datetime
                         < yesterday,  # Подписка началась до вчерашнего дня
                         Subscription.end_datetime
                         > now,  # Подписка еще активна на данный момент
                     )
                 )
-                .all()
+                .execution_options(yield_per=JOB_BATCH_SIZE)
             )
-            for telegram_id, subscription in prolonged_users:
-                if not telegram_id:
-                    continue
-                if not subscription.chat_link:
-                    chat_link = create_invite_link(
-                        bot, subscription.end_datetime, CHAT_ID
+            for batch in until_shutdown(
+                prolonged_users.partitions(), "notify_about_new_chat"
+            ):
+                # Создаём недостающие ссылки на чат-болталку
+                links = ensure_links_bulk(
+                    bot,
+                    [
+                        subscription_id
+                        for _, subscription_id, chat_link in batch
+                        if not chat_link
+                    ],
+                    (LINK_CHAT,),
+                )
+                for telegram_id, subscription_id, chat_link in batch:
+                    chat_link = chat_link or links.get(subscription_id, {}).get(
+                        LINK_CHAT
                     )
                     if not chat_link:
-                        logger.error(f"Не удалось создать ссылку для {telegram_id}")
+                        logger.error("Не удалось создать ссылку для %s", telegram_id)
                         continue
-                    subscription.chat_link = chat_link
-                try:
-                    bot.send_message(
-                        chat_id=telegram_id,
-                        text=notification_about_chat.format(
-                            chat_link=subscription.chat_link
-                        ),
-                        parse_mode="markdown",
-                    )
-                except Exception as error:
-                    logger.error(
-                        "Ошибка при отправки сообщения в notify_about_new_chat "
-                        f"для пользователя с телеграм id: {telegram_id}\n"
-                        f"Ошибка: {str(error)}"
-                    )
+                    try:
+                        NEW_CHAT_NOTIFICATION.send(
+                            bot, telegram_id, chat_link=chat_link
+                        )
+                    except Exception as error:
+                        logger.error(
+                            "Ошибка при отправки сообщения в notify_about_new_chat "
+                            "для пользователя с телеграм id: %s\n"
+                            "Ошибка: %s",
+                            telegram_id,
+                            error,
+                        )
             session.commit()
         except Exception as error:
-            logger.error(f"Ошибка при notify_about_new_chat: {str(error)}")
+            logger.error("Ошибка при notify_about_new_chat: %s", error)
             session.rollback()
         finally:
             Session.remove()
     return None
 
 
+# Повторно применяем оплаты, которые вебхук не смог обработать
+@profiled
+def reconcile_payments(updaters) -> None:
+    try:
+        reconcile_failed_payments()
+    except Exception as error:
+        logger.error("Ошибка при reconcile_payments: %s", error)
+    return None
+
+
+# Приглашения, напоминания и окончание подписок по собственному
+# расписанию каждой подписки (subscription_events.py), раз в LIFECYCLE_POLL_INTERVAL секунд
+@profiled
+def handle_subscription_events(updaters) -> None:
+    try:
+        process_subscription_events(updaters)
+    except Exception as error:
+        logger.error("Ошибка при handle_subscription_events: %s", error)
+    return None
+
+
+# Продолжаем рассылки, прерванные остановкой процесса, ботами их клубов.
+# Запускается после старта с задержкой, чтобы прежний процесс успел
+# остановиться.
+@profiled
+def resume_broadcasts(updaters) -> None:
+    from manager_commands import run_broadcast_and_report
+
+    with create_session() as session:
+        try:
+            broadcasts = unfinished_broadcasts(session)
+        finally:
+            Session.remove()
+    for broadcast_id, created_by, club_id in broadcasts:
+        if shutting_down.is_set():
+            break
+        logger.info("Продолжаем рассылку %s", broadcast_id)
+        try:
+            bot = updaters.bot(club_id)
+            if created_by:
+                run_broadcast_and_report(bot, broadcast_id, created_by)
+            else:
+                run_broadcast(bot, broadcast_id)
+        except Exception as error:
+            logger.error("Ошибка при продолжении рассылки %s: %s", broadcast_id, error)
+    return None
+
+
 # Функция для тестирования отложенных задач
+@profiled
+@moderator_only
 def test_postponed_task(update: Update, context: CallbackContext) -> None:
     update.message.reply_text("Запрос обрабатывается...")
-    # Проверяем, является ли пользователь команды модератором
-    if update.message.from_user.id not in MODERATOR_IDS:
-        update.message.reply_text("Вы не являетесь модератором.")
-        return None
     # Обрабатываем возможные ошибки при введении аргументов
     args = context.args
-    if len(args) != 1:
+    if len(args) not in (1, 2) or args[1:] not in ([], ["dry_run"]):
         update.message.reply_text(
-            "Пожалуйста, введите команду в формате: /test_postponed_task название_задачи\n\n"
+            "Пожалуйста, введите команду в формате: /test_postponed_task название_задачи [dry_run]\n\n"
+            "С dry_run задача не выполняется, а выводится её оценка: получатели, "
+            "запросы к Telegram и длительность.\n\n"
             "Одним сообщением, в одну строку. Вот список названий всех задач:\n\n"
             "request_feedback_from_all_users - запросить отзыв от всех пользователей\n\n"
             "get_first_reminder_to_renew_the_subscription - напомнить о продлении подписки 25 числа в 17:00 MSK\n\n"
@@ -513,30 +607,74 @@ def test_postponed_task(update: Update, context: CallbackContext) -> None:
             "get_second_reminder_to_join_the_club - напомнить о вступлении в клуб по ссылке 1ого числа в 18:00 MSK\n\n"
             "check_subscription_validity - проверить валидность подпискок 1ого числа в 18:00 MSK\n\n"
             "send_invite_link - отправить ссылку-приглашение всем новым подписчикам 1ого числа месяца в 12:00 MSK, либо сообщение о продлении подписки, если действующие\n\n"
-            "handle_overlapping_subscriptions - объединить пересекающиеся по времени подписки, выполняется с интервалом в один день"
+            "handle_overlapping_subscriptions - объединить пересекающиеся по времени подписки, выполняется с интервалом в один день\n\n"
+            "reconcile_payments - повторно применить необработанные уведомления об оплате, каждую ночь в 03:00 MSK\n\n"
+            "remind_lapsed_users - предложить вернуться пользователям без подписки, последнего числа месяца в 12:00 MSK\n\n"
+            "handle_subscription_events - обработать наступившие события подписок: приглашения, напоминания и окончание подписок"
         )
         return None
     task_name = args[0]
+    if args[1:] == ["dry_run"]:
+        if task_name not in JOB_ESTIMATES:
+            update.message.reply_text("Такой задачи не существует.")
+            return None
+        reply_with_estimates(update, [task_name])
+        return None
     if task_name == "request_feedback_from_all_users":
-        request_feedback_from_all_users(context)
+        request_feedback_from_all_users(club_updaters)
     elif task_name == "get_first_reminder_to_renew_the_subscription":
-        get_first_reminder_to_renew_the_subscription(context)
+        get_first_reminder_to_renew_the_subscription(club_updaters)
     elif task_name == "get_second_reminder_to_renew_the_subscription":
-        get_second_reminder_to_renew_the_subscription(context)
+        get_second_reminder_to_renew_the_subscription(club_updaters)
     elif task_name == "get_first_reminder_to_join_the_club":
-        get_first_reminder_to_join_the_club(context)
+        get_first_reminder_to_join_the_club(club_updaters)
     elif task_name == "get_second_reminder_to_join_the_club":
-        get_second_reminder_to_join_the_club(context)
+        get_second_reminder_to_join_the_club(club_updaters)
     elif task_name == "check_subscription_validity":
-        check_subscription_validity(context)
+        check_subscription_validity(club_updaters)
     elif task_name == "send_invite_link":
-        send_invite_link(context)
+        send_invite_link(club_updaters)
     elif task_name == "handle_overlapping_subscriptions":
-        handle_overlapping_subscriptions(context)
+        handle_overlapping_subscriptions(club_updaters)
     elif task_name == "notify_about_new_chat":
-        notify_about_new_chat(context)
+        notify_about_new_chat(club_updaters)
+    elif task_name == "reconcile_payments":
+        reconcile_payments(club_updaters)
+    elif task_name == "remind_lapsed_users":
+        remind_lapsed_users(club_updaters)
+    elif task_name == "handle_subscription_events":
+        handle_subscription_events(club_updaters)
     else:
         update.message.reply_text("Такой задачи не существует.")
         return None
     update.message.reply_text("Запрос успешно выполнен.")
     return None
+
+
+def reply_with_estimates(update: Update, names: list) -> None:
+    try:
+        estimates = estimate_jobs(names)
+    except Exception as error:
+        logger.error("Ошибка при оценке задач %s: %s", names, error)
+        update.message.reply_text("Не удалось оценить задачи.")
+        return None
+    for estimate in estimates:
+        update.message.reply_text(format_estimate(estimate))
+    return None
+
+
+# Оценка задач без их выполнения: /estimate_jobs [название_задачи ...],
+# без аргументов оцениваются все задачи
+@profiled
+@moderator_only
+def estimate_postponed_tasks(update: Update, context: CallbackContext) -> None:
+    names = context.args or list(JOB_ESTIMATES)
+    unknown = [name for name in names if name not in JOB_ESTIMATES]
+    if unknown:
+        update.message.reply_text(
+            f"Таких задач не существует: {', '.join(unknown)}\n\n"
+            f"Доступные задачи:\n{chr(10).join(JOB_ESTIMATES)}"
+        )
+        return None
+    reply_with_estimates(update, names)
+    return None
@@ -0,0 +1,172 @@
+import functools
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+from sqlalchemy import event
+
+from constants import QUERY_PROFILE_REPEAT_THRESHOLD, QUERY_PROFILE_SAMPLE_RATE
+
+WHITESPACE_REGEX = re.compile(r"\s+")
+# Литералы и списки параметров, которые не меняют "форму" запроса
+LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+IN_LIST_REGEX = re.compile(r"IN \((?:[^()]|\([^()]*\))*\)", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+_installed_engines = set()
+# Профили, собирающие запросы всех потоков (для нагрузочных сценариев)
+_global_profiles = []
+_global_lock = threading.Lock()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# Приводим запрос к "форме": без литералов, списков IN и лишних пробелов,
+# чтобы одинаковые запросы с разными параметрами считались одним
+def statement_shape(statement: str) -> str:
+    shape = WHITESPACE_REGEX.sub(" ", statement).strip()
+    shape = IN_LIST_REGEX.sub("IN (...)", shape)
+    return LITERAL_REGEX.sub("?", shape)
+
+
+# Статистика запросов за один вызов обработчика или задачи
+class QueryProfile:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.total_time += duration
+        self.shapes[statement_shape(statement)] += 1
+        return None
+
+    def merge(self, other: "QueryProfile") -> None:
+        self.count += other.count
+        self.total_time += other.total_time
+        self.shapes.update(other.shapes)
+        return None
+
+    # Запросы одной формы, выполненные много раз подряд, — признак N+1
+    def repeated_shapes(self, threshold: int = QUERY_PROFILE_REPEAT_THRESHOLD) -> list:
+        return [
+            (shape, count)
+            for shape, count in self.shapes.most_common()
+            if count >= threshold
+        ]
+
+    def summary(self) -> str:
+        lines = [
+            f"{self.name}: {self.count} запросов за {self.total_time * 1000:.1f} мс"
+        ]
+        for shape, count in self.repeated_shapes():
+            lines.append(f"  x{count}: {shape[:300]}")
+        return "\n".join(lines)
+
+
+def current_profile() -> Optional[QueryProfile]:
+    return getattr(_local, "profile", None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    duration = time.perf_counter() - conn.info["query_start_time"].pop()
+    profile = current_profile()
+    if profile is not None:
+        profile.record(statement, duration)
+    if _global_profiles:
+        with _global_lock:
+            for global_profile in _global_profiles:
+                global_profile.record(statement, duration)
+
+
+# Подключаем профилировщик к движку SQLAlchemy (один раз на движок)
+def install(engine) -> None:
+    if id(engine) in _installed_engines:
+        return None
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    _installed_engines.add(id(engine))
+    return None
+
+
+# Считаем запросы, выполненные в текущем потоке внутри блока with.
+# Если задан budget и запросов больше, бросаем QueryBudgetExceeded.
+# Вложенные профили добавляют свою статистику во внешний.
+@contextmanager
+def profile_queries(name: str = "queries", budget: Optional[int] = None):
+    parent = current_profile()
+    profile = QueryProfile(name)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = parent
+        if parent is not None:
+            parent.merge(profile)
+    if budget is not None and profile.count > budget:
+        raise QueryBudgetExceeded(
+            f"Превышен бюджет запросов ({profile.count} > {budget})\n"
+            + profile.summary()
+        )
+
+
+# Считаем запросы всех потоков внутри блока with, например пока
+# нагрузочный сценарий гоняет обработчики в потоках веб-сервера
+@contextmanager
+def profile_all_threads(name: str = "queries"):
+    profile = QueryProfile(name)
+    with _global_lock:
+        _global_profiles.append(profile)
+    try:
+        yield profile
+    finally:
+        with _global_lock:
+            _global_profiles.remove(profile)
+
+
+# Декоратор для обработчиков и задач: с вероятностью sample_rate
+# профилирует вызов и пишет сводку в лог. При нулевой вероятности
+# функция возвращается без обёртки и ничего не стоит.
+def profiled(func=None, *, sample_rate: float = QUERY_PROFILE_SAMPLE_RATE):
+    if func is None:
+        return functools.partial(profiled, sample_rate=sample_rate)
+    if sample_rate <= 0:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_profile() is not None or random.random() >= sample_rate:
+            return func(*args, **kwargs)
+        with profile_queries(func.__qualname__) as profile:
+            result = func(*args, **kwargs)
+        log_profile(profile)
+        return result
+
+    return wrapper
+
+
+def log_profile(profile: QueryProfile) -> None:
+    if profile.repeated_shapes():
+        logger.warning("Повторяющиеся запросы (возможен N+1): %s", profile.summary())
+    else:
+        logger.info(
+            "Профиль запросов %s: %s запросов за %.1f мс",
+            profile.name,
+            profile.count,
+            profile.total_time * 1000,
+        )
+    return None
@@ -0,0 +1,255 @@
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Ведро токенов: не больше rate операций в секунду в среднем
+# и не больше capacity подряд. Потокобезопасно.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        return None
+
+    # Забираем токен без ожидания, если он есть
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    # Ждём, пока появится токен
+    def acquire(self, tokens: float = 1) -> None:
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return None
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Приостанавливаем выдачу токенов, например после ответа 429
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+        return None
+
+    # Сколько секунд ещё длится пауза (0, если ведро не приостановлено)
+    def paused_for(self) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            return max(0.0, -self.tokens / self.rate)
+
+
+# Отдельное ведро токенов на каждый ключ, например телеграм id или клуб.
+# Хранится не больше max_keys вёдер, давно не использованные вытесняются.
+class KeyedTokenBuckets:
+    def __init__(
+        self, rate: float, capacity: Optional[float] = None, max_keys: int = 10000
+    ) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Ведро ключа, чтобы ждать токен (acquire) или приостановить его (pause)
+    def bucket(self, key) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket
+
+    def try_acquire(self, key, tokens: float = 1) -> bool:
+        return self.bucket(key).try_acquire(tokens)
+
+
+# Автоматический выключатель: после failure_threshold ошибок подряд
+# вызовы не выполняются reset_timeout секунд, затем пропускается один
+# пробный вызов. Успешный пробный вызов замыкает цепь, ошибка снова
+# размыкает её. Потокобезопасно.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # Сколько секунд вызовы ещё запрещены, 0 - вызов можно выполнять
+    def before_call(self) -> float:
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            # Пробный вызов уже выполняется, остальные ждут его результата
+            if self._probing:
+                return 1.0
+            self._probing = True
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("%s: цепь замкнута", self.name)
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+        return None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            half_open = self._probing
+            self._probing = False
+            if half_open or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    "%s: цепь разомкнута на %s с после %s ошибок подряд",
+                    self.name,
+                    self.reset_timeout,
+                    self.failures,
+                )
+                self.opened_at = time.monotonic()
+        return None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return self.CLOSED
+            if self._probing or time.monotonic() >= (
+                self.opened_at + self.reset_timeout
+            ):
+                return self.HALF_OPEN
+            return self.OPEN
+
+
+class _InFlightCall:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Объединяем одновременные вызовы с одним ключом: первый выполняет
+# функцию, остальные ждут его и получают тот же результат или исключение
+class InFlightCoalescer:
+    def __init__(self) -> None:
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func: Callable, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+# Блокировки по ключу, например по id подписки. Блокировка удаляется,
+# когда её никто не держит и не ждёт, поэтому словарь не растёт.
+class KeyedLock:
+    def __init__(self) -> None:
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+# Декоратор обработчика: не больше rate вызовов в секунду и capacity подряд
+# от одного пользователя, лишние нажатия отбрасываются без ответа
+def per_user_rate_limit(rate: float, capacity: float) -> Callable:
+    buckets = KeyedTokenBuckets(rate, capacity)
+
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(update, context, *args, **kwargs):
+            user_id = update.message.from_user.id
+            if not buckets.try_acquire(user_id):
+                logger.info(
+                    "Слишком частый вызов %s от пользователя %s",
+                    handler.__name__,
+                    user_id,
+                )
+                return None
+            return handler(update, context, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Декоратор обработчика: одновременные одинаковые вызовы от одного
+# пользователя выполняются один раз, остальные ждут и получают тот же результат
+def coalesce_per_user(handler: Callable) -> Callable:
+    coalescer = InFlightCoalescer()
+
+    @functools.wraps(handler)
+    def wrapper(update, context, *args, **kwargs):
+        key = (update.message.from_user.id, *args)
+        return coalescer.run(key, handler, update, context, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,244 @@
+import csv
+import datetime
+import json
+from collections import Counter
+from typing import Iterable, Iterator
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    exists,
+    insert,
+    select,
+    update,
+)
+
+from constants import DEFAULT_CLUB_ID
+from database import (
+    AppliedPayment,
+    FailedPayment,
+    Subscription,
+    User,
+    session_factory,
+)
+from payments import PaymentParseError, parse_tilda_payment
+from utils import logger, subscription_period, update_subscriptions
+
+# Столбец выгрузки заказов Tilda с названием товара ("... 3 мес.")
+CSV_PRODUCT_COLUMN = "products"
+
+# Временная таблица сверяемых оплат. Создаётся и удаляется в одной
+# транзакции, поэтому не остаётся в соединении из пула.
+_reconcile_payments = Table(
+    "reconcile_payments",
+    MetaData(),
+    Column("row_id", Integer, primary_key=True),
+    Column("phone_number", String, nullable=False),
+    Column("start_datetime", DateTime, nullable=False),
+    Column("end_datetime", DateTime, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+# Строки выгрузки заказов Tilda в виде тел уведомлений об оплате,
+# чтобы разбирать их тем же кодом, что и вебхук
+def read_orders_csv(path: str, product_column: str = CSV_PRODUCT_COLUMN) -> Iterator:
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        try:
+            dialect = csv.Sniffer().sniff(file.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        file.seek(0)
+        for row in csv.DictReader(file, dialect=dialect):
+            yield {
+                "Phone": row.get("Phone"),
+                "tg": row.get("tg"),
+                "month": row.get("month"),
+                "payment": {"products": [{"name": row.get(product_column)}]},
+            }
+
+
+# Тела уведомлений Tilda, по одному JSON-объекту в строке
+def read_webhook_bodies(path: str) -> Iterator:
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# Разбираем уведомления тем же кодом, что и вебхук.
+# Возвращает оплаты и [(номер уведомления, ошибка)] для неразобранных.
+def parse_orders(bodies: Iterable) -> tuple:
+    payments = []
+    errors = []
+    for index, body in enumerate(bodies):
+        try:
+            payments.append(parse_tilda_payment(body))
+        except PaymentParseError as error:
+            errors.append((index, str(error)))
+    return payments, errors
+
+
+# Оплаты, которых нет в журнале применённых и период которых не покрыт
+# ни одной подпиской пользователя клуба с тем же номером. Периоды, которые
+# уже закончились, пропускаются: их подписки могли истечь и удалиться,
+# а повторное применение снова пригласило бы и исключило пользователя.
+# Оплаты загружаются во временную таблицу, а сравнение с subscriptions
+# и applied_payments выполняется одним запросом.
+def find_missing_payments(
+    session, payments: list, club_id: int = DEFAULT_CLUB_ID
+) -> list:
+    if not payments:
+        return []
+    connection = session.connection()
+    _reconcile_payments.create(connection)
+    rows = []
+    for row_id, (paid_months, phone_number, start_month, start_year, _) in enumerate(
+        payments
+    ):
+        start_datetime, end_datetime = subscription_period(
+            paid_months, start_month, start_year
+        )
+        rows.append(
+            {
+                "row_id": row_id,
+                "phone_number": phone_number,
+                "start_datetime": start_datetime,
+                "end_datetime": end_datetime,
+            }
+        )
+    session.execute(insert(_reconcile_payments), rows)
+    covered = exists().where(
+        User.club_id == club_id,
+        User.phone_number == _reconcile_payments.c.phone_number,
+        Subscription.user_id == User.id,
+        Subscription.start_datetime <= _reconcile_payments.c.start_datetime,
+        Subscription.end_datetime >= _reconcile_payments.c.end_datetime,
+    )
+    applied = exists().where(
+        AppliedPayment.club_id == club_id,
+        AppliedPayment.phone_number == _reconcile_payments.c.phone_number,
+        AppliedPayment.start_datetime == _reconcile_payments.c.start_datetime,
+        AppliedPayment.end_datetime == _reconcile_payments.c.end_datetime,
+    )
+    missing_ids = (
+        session.execute(
+            select(_reconcile_payments.c.row_id)
+            .where(
+                _reconcile_payments.c.end_datetime >= datetime.datetime.now(),
+                ~applied,
+                ~covered,
+            )
+            .order_by(_reconcile_payments.c.row_id)
+        )
+        .scalars()
+        .all()
+    )
+    _reconcile_payments.drop(connection)
+    return [payments[row_id] for row_id in missing_ids]
+
+
+# Сверяем разобранные оплаты с подписками и применяем недостающие
+# одним вызовом update_subscriptions. Возвращает счётчики сверки.
+def apply_missing_payments(
+    payments: list,
+    errors: list,
+    dry_run: bool = False,
+    club_id: int = DEFAULT_CLUB_ID,
+) -> Counter:
+    stats = Counter(orders=len(payments) + len(errors), unparsed=len(errors))
+    for index, error in errors:
+        logger.warning("Сверка оплат: уведомление %s не разобрано: %s", index, error)
+    with session_factory() as session:
+        missing = find_missing_payments(session, payments, club_id)
+        session.rollback()
+    stats["missing"] = len(missing)
+    if missing and not dry_run:
+        applied = update_subscriptions(missing, club_id)
+        stats["applied"] = applied["payments"]
+        stats["users_created"] = applied["users_created"]
+    logger.info("Сверка оплат клуба %s: %s", club_id, dict(stats))
+    return stats
+
+
+def reconcile(
+    bodies: Iterable, dry_run: bool = False, club_id: int = DEFAULT_CLUB_ID
+) -> Counter:
+    payments, errors = parse_orders(bodies)
+    return apply_missing_payments(payments, errors, dry_run, club_id)
+
+
+# Повторно применяем уведомления, сохранённые вебхуком при ошибке,
+# отдельно для каждого клуба. Разобранные уведомления помечаются
+# обработанными, а неразобранные остаются в таблице для ручного разбора.
+def reconcile_failed_payments(dry_run: bool = False) -> Counter:
+    with session_factory() as session:
+        rows = session.execute(
+            select(FailedPayment.id, FailedPayment.body, FailedPayment.club_id)
+            .where(FailedPayment.resolved_at.is_(None))
+            .order_by(FailedPayment.id)
+        ).all()
+    by_club = {}
+    for row in rows:
+        by_club.setdefault(row.club_id, []).append(row)
+    stats = Counter()
+    resolved_ids = []
+    for club_id, club_rows in by_club.items():
+        payments, errors = parse_orders(body for _, body, _ in club_rows)
+        stats.update(apply_missing_payments(payments, errors, dry_run, club_id))
+        unparsed = {index for index, _ in errors}
+        resolved_ids += [
+            row.id for index, row in enumerate(club_rows) if index not in unparsed
+        ]
+    if resolved_ids and not dry_run:
+        with session_factory() as session:
+            session.execute(
+                update(FailedPayment)
+                .where(FailedPayment.id.in_(resolved_ids))
+                .values(resolved_at=datetime.datetime.utcnow())
+            )
+            session.commit()
+    stats["resolved"] = len(resolved_ids)
+    return stats
+
+
+# python reconciliation.py --csv orders.csv --bodies webhooks.jsonl --failed --dry-run
+if __name__ == "__main__":
+    import argparse
+    import itertools
+
+    parser = argparse.ArgumentParser(
+        description="Сверка оплат Tilda с подписками и применение недостающих"
+    )
+    parser.add_argument("--csv", nargs="*", default=[], help="Выгрузки заказов")
+    parser.add_argument(
+        "--bodies", nargs="*", default=[], help="Тела уведомлений, JSON в строке"
+    )
+    parser.add_argument(
+        "--failed", action="store_true", help="Уведомления из failed_payments"
+    )
+    parser.add_argument("--product-column", default=CSV_PRODUCT_COLUMN)
+    parser.add_argument(
+        "--club", help="Клуб выгрузок и уведомлений (по умолчанию основной)"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Только подсчёт")
+    args = parser.parse_args()
+    bodies = itertools.chain(
+        *(read_orders_csv(path, args.product_column) for path in args.csv),
+        *(read_webhook_bodies(path) for path in args.bodies),
+    )
+    if args.csv or args.bodies:
+        from settings import settings
+
+        club = settings.club_by_slug(args.club) if args.club else None
+        if args.club and club is None:
+            parser.error(f"Клуб {args.club} не найден")
+        reconcile(bodies, args.dry_run, club.id if club else DEFAULT_CLUB_ID)
+    if args.failed:
+        result = reconcile_failed_payments(args.dry_run)
+        logger.info("Сверка необработанных уведомлений: %s", dict(result))
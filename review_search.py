@@ -0,0 +1,103 @@
+import datetime
+from typing import Optional
+
+from sqlalchemy import func, literal_column, select
+
+from database import REVIEW_SEARCH_CONFIG, Review, ReviewKeyword, User
+
+# Сколько отзывов показываем на одной странице поиска
+SEARCH_PAGE_SIZE = 5
+# Параметры фрагментов текста с подсвеченными словами запроса
+HEADLINE_OPTIONS = (
+    "StartSel=«, StopSel=», MaxWords=30, MinWords=10, "
+    'MaxFragments=2, FragmentDelimiter=" … "'
+)
+
+# Конфигурация записывается литералом, чтобы выражение в запросе
+# совпадало с выражением индекса reviews_search_idx
+_config = literal_column(f"'{REVIEW_SEARCH_CONFIG}'::regconfig")
+
+
+def _review_document():
+    return func.to_tsvector(_config, Review.review_text)
+
+
+# Запрос в синтаксисе поисковиков: слова, "фраза", -исключение, or
+def _review_query(query_text: str):
+    return func.websearch_to_tsquery(_config, query_text)
+
+
+# Ищем отзывы клуба по индексу и возвращаем страницу, отсортированную
+# по релевантности, и признак наличия следующей страницы.
+# Фрагменты с подсветкой строятся только для отзывов страницы.
+def search_reviews(
+    session,
+    club_id: int,
+    query_text: str,
+    since: Optional[datetime.datetime] = None,
+    page: int = 1,
+    page_size: int = SEARCH_PAGE_SIZE,
+) -> tuple:
+    query = _review_query(query_text)
+    rank = func.ts_rank(_review_document(), query)
+    matches = select(Review.id, rank.label("rank")).where(
+        Review.club_id == club_id, _review_document().op("@@")(query)
+    )
+    if since:
+        matches = matches.where(Review.created_at >= since)
+    matches = (
+        matches.order_by(rank.desc(), Review.id.desc())
+        .offset((page - 1) * page_size)
+        .limit(page_size + 1)
+        .subquery()
+    )
+    rows = session.execute(
+        select(
+            Review.id,
+            Review.created_at,
+            User.phone_number,
+            User.user_link,
+            func.ts_headline(
+                _config, Review.review_text, query, HEADLINE_OPTIONS
+            ).label("snippet"),
+        )
+        .join(matches, matches.c.id == Review.id)
+        .join(User, User.id == Review.user_id)
+        .order_by(matches.c.rank.desc(), Review.id.desc())
+    ).all()
+    return rows[:page_size], len(rows) > page_size
+
+
+# Первый день месяца, отстоящего на months назад от текущего
+def _months_ago(months: int) -> datetime.date:
+    today = datetime.date.today()
+    month_index = today.year * 12 + today.month - 1 - months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+# Самые частые основы слов в отзывах за последние months месяцев
+# (включая текущий) по предрасчитанной таблице review_keywords.
+# Возвращает список месяцев и [(основа, всего, {месяц: отзывов})].
+def keyword_trends(session, months: int = 3, limit: int = 15) -> tuple:
+    periods = [_months_ago(offset) for offset in reversed(range(months))]
+    top = (
+        select(
+            ReviewKeyword.lexeme,
+            func.sum(ReviewKeyword.reviews).label("total"),
+        )
+        .where(ReviewKeyword.period >= periods[0])
+        .group_by(ReviewKeyword.lexeme)
+        .order_by(func.sum(ReviewKeyword.reviews).desc(), ReviewKeyword.lexeme)
+        .limit(limit)
+        .subquery()
+    )
+    rows = session.execute(
+        select(top.c.lexeme, top.c.total, ReviewKeyword.period, ReviewKeyword.reviews)
+        .join(ReviewKeyword, ReviewKeyword.lexeme == top.c.lexeme)
+        .where(ReviewKeyword.period >= periods[0])
+    ).all()
+    trends = {}
+    for lexeme, total, period, reviews in rows:
+        trends.setdefault(lexeme, (int(total), {}))[1][period] = reviews
+    ordered = sorted(trends.items(), key=lambda item: (-item[1][0], item[0]))
+    return periods, [(lexeme, total, counts) for lexeme, (total, counts) in ordered]
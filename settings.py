@@ -0,0 +1,312 @@
+import functools
+import json
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+from typing import Callable, Optional
+
+from sqlalchemy import select as sql_select
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from constants import (
+    CHANNEL_ID,
+    CHAT_ID,
+    DEFAULT_CLUB_ID,
+    DEFAULT_CLUB_SLUG,
+    MODERATOR_IDS,
+    SETTINGS_FILE,
+    SETTINGS_REFRESH_INTERVAL,
+    STAGING_CHAT_ID,
+    TOKEN,
+)
+from database import (
+    SETTINGS_CHANNEL,
+    Club,
+    Moderator,
+    Setting,
+    get_engine,
+    session_factory,
+)
+from utils import logger
+
+# Значения по умолчанию из переменных окружения
+DEFAULTS = {
+    "channel_id": CHANNEL_ID,
+    "chat_id": CHAT_ID,
+    "staging_chat_id": STAGING_CHAT_ID,
+}
+# Пауза перед повторным подключением наблюдателя после ошибки
+WATCH_RETRY_DELAY = 5
+
+# Бот, канал и чаты клуба (строка таблицы clubs)
+ClubConfig = namedtuple(
+    "ClubConfig",
+    ["id", "slug", "name", "token", "channel_id", "chat_id", "staging_chat_id"],
+)
+
+
+# Клубы по id. Клуб по умолчанию есть всегда, его незаданные поля
+# берутся из настроек и TOKEN, как до появления клубов.
+def club_configs(values: dict, rows) -> dict:
+    clubs = {
+        row.id: ClubConfig(
+            row.id,
+            row.slug,
+            row.name,
+            row.token,
+            row.channel_id,
+            row.chat_id,
+            row.staging_chat_id,
+        )
+        for row in rows
+    }
+    default = clubs.get(DEFAULT_CLUB_ID) or ClubConfig(
+        DEFAULT_CLUB_ID, DEFAULT_CLUB_SLUG, None, None, None, None, None
+    )
+    clubs[DEFAULT_CLUB_ID] = default._replace(
+        token=default.token or TOKEN,
+        channel_id=default.channel_id or values.get("channel_id"),
+        chat_id=default.chat_id or values.get("chat_id"),
+        staging_chat_id=default.staging_chat_id or values.get("staging_chat_id"),
+    )
+    return clubs
+
+
+# Модераторы по id клуба из строк (club_id, telegram_id) таблицы moderators.
+# Клуб по умолчанию без записей в таблице берёт модераторов из файла
+# или MODERATOR_IDS, у остальных клубов модераторы только из таблицы.
+def club_moderators(rows, default_ids) -> dict:
+    moderators = {}
+    for club_id, telegram_id in rows:
+        moderators.setdefault(club_id, set()).add(int(telegram_id))
+    moderators.setdefault(
+        DEFAULT_CLUB_ID, {int(moderator_id) for moderator_id in default_ids}
+    )
+    return {club_id: frozenset(ids) for club_id, ids in moderators.items()}
+
+
+# Настройки бота, реестр модераторов и клубы в памяти процесса.
+# Источники по возрастанию приоритета: переменные окружения, файл
+# SETTINGS_FILE ({"settings": {...}, "moderator_ids": [...]}) и таблица
+# settings. Модераторы у каждого клуба свои (см. club_moderators).
+# Клубы - из таблицы clubs. Снимок
+# заменяется целиком, поэтому чтение не требует блокировок и обращений к БД.
+class Settings:
+    def __init__(
+        self,
+        defaults: dict,
+        default_moderator_ids: set,
+        file_path: Optional[str] = None,
+        refresh_interval: float = SETTINGS_REFRESH_INTERVAL,
+    ) -> None:
+        self.defaults = dict(defaults)
+        self.default_moderator_ids = frozenset(default_moderator_ids)
+        self.file_path = file_path
+        self.refresh_interval = refresh_interval
+        self._snapshot = (
+            dict(defaults),
+            club_moderators([], self.default_moderator_ids),
+            club_configs(defaults, []),
+        )
+        self._loaded_at = None
+        self._reload_lock = threading.Lock()
+        self._subscribers = []
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def _read_file(self) -> dict:
+        if not self.file_path or not os.path.exists(self.file_path):
+            return {}
+        with open(self.file_path, encoding="utf-8") as file:
+            return json.load(file)
+
+    # Отдельная сессия, а не Session: перечитывание может случиться
+    # внутри обработчика, у которого открыта своя сессия
+    def _read_database(self) -> tuple:
+        with session_factory() as session:
+            values = dict(session.execute(sql_select(Setting.key, Setting.value)).all())
+            moderators = session.execute(
+                sql_select(Moderator.club_id, Moderator.telegram_id)
+            ).all()
+            clubs = session.execute(sql_select(Club)).scalars().all()
+        return values, moderators, clubs
+
+    # Перечитываем все источники и оповещаем подписчиков, если что-то изменилось
+    def reload(self) -> bool:
+        with self._reload_lock:
+            file_data = self._read_file()
+            db_values, db_moderators, db_clubs = self._read_database()
+            values = {**self.defaults, **file_data.get("settings", {}), **db_values}
+            moderators = club_moderators(
+                db_moderators,
+                file_data.get("moderator_ids") or self.default_moderator_ids,
+            )
+            snapshot = (values, moderators, club_configs(values, db_clubs))
+            changed = snapshot != self._snapshot
+            self._snapshot = snapshot
+            self._loaded_at = time.monotonic()
+        if changed:
+            logger.info(
+                "Настройки обновлены, модераторов: %s, клубов: %s",
+                sum(len(ids) for ids in moderators.values()),
+                len(snapshot[2]),
+            )
+            for callback in list(self._subscribers):
+                try:
+                    callback(self)
+                except Exception as error:
+                    logger.error("Ошибка в подписчике на настройки: %s", error)
+        return changed
+
+    # Без наблюдателя (например, в воркерах веб-сервера) настройки
+    # перечитываются при обращении, если с загрузки прошло refresh_interval
+    def _ensure_fresh(self) -> None:
+        loaded_at = self._loaded_at
+        watching = self.watching
+        if loaded_at is not None and (
+            watching or time.monotonic() - loaded_at < self.refresh_interval
+        ):
+            return None
+        try:
+            self.reload()
+        except Exception as error:
+            # Оставляем прежний снимок и пробуем позже
+            logger.error("Не удалось загрузить настройки: %s", error)
+            self._loaded_at = time.monotonic()
+        return None
+
+    # Запущен ли поток, перечитывающий настройки
+    @property
+    def watching(self) -> bool:
+        return self._watcher is not None and self._watcher.is_alive()
+
+    def get(self, key: str, default=None):
+        self._ensure_fresh()
+        return self._snapshot[0].get(key, default)
+
+    # Модераторы клуба
+    def moderator_ids(self, club_id: int) -> frozenset:
+        self._ensure_fresh()
+        return self._snapshot[1].get(club_id, frozenset())
+
+    def is_moderator(self, club_id: int, telegram_id: int) -> bool:
+        return telegram_id in self.moderator_ids(club_id)
+
+    @property
+    def channel_id(self) -> str:
+        return self.get("channel_id")
+
+    @property
+    def chat_id(self) -> str:
+        return self.get("chat_id")
+
+    @property
+    def staging_chat_id(self) -> Optional[str]:
+        return self.get("staging_chat_id")
+
+    # Все клубы в порядке id
+    @property
+    def clubs(self) -> tuple:
+        self._ensure_fresh()
+        return tuple(club for _, club in sorted(self._snapshot[2].items()))
+
+    # Клуб, созданный после загрузки снимка, подгружается сразу,
+    # а не через refresh_interval
+    def club(self, club_id: int) -> ClubConfig:
+        self._ensure_fresh()
+        club = self._snapshot[2].get(club_id)
+        if club is None:
+            self.reload()
+            club = self._snapshot[2].get(club_id)
+        if club is None:
+            raise KeyError(f"Клуб {club_id} не найден")
+        return club
+
+    def club_by_slug(self, slug: str) -> Optional[ClubConfig]:
+        for club in self.clubs:
+            if club.slug == slug:
+                return club
+        return None
+
+    # Подписка на изменение настроек: callback(settings) вызывается после замены снимка
+    def subscribe(self, callback: Callable) -> None:
+        self._subscribers.append(callback)
+        return None
+
+    # Загружаем настройки и запускаем поток, который перечитывает их
+    # по уведомлению от БД и раз в refresh_interval секунд
+    def start(self) -> None:
+        self._ensure_fresh()
+        if self._watcher is not None and self._watcher.is_alive():
+            return None
+        self._stop.clear()
+        self._watcher = threading.Thread(
+            target=self._watch, name="settings-watcher", daemon=True
+        )
+        self._watcher.start()
+        return None
+
+    def stop(self) -> None:
+        self._stop.set()
+        return None
+
+    # Соединение, слушающее канал уведомлений. Оно отсоединяется
+    # от пула, чтобы не занимать место обычных запросов.
+    def _listen(self):
+        pooled = get_engine().raw_connection()
+        pooled.detach()
+        connection = pooled.dbapi_connection
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute(f"LISTEN {SETTINGS_CHANNEL}")
+        cursor.close()
+        return connection
+
+    def _watch(self) -> None:
+        connection = None
+        while not self._stop.is_set():
+            try:
+                if connection is None:
+                    connection = self._listen()
+                    # Изменения, пропущенные до подписки на уведомления
+                    self.reload()
+                select.select([connection], [], [], self.refresh_interval)
+                connection.poll()
+                connection.notifies.clear()
+                if not self._stop.is_set():
+                    self.reload()
+            except Exception as error:
+                logger.error("Ошибка при отслеживании настроек: %s", error)
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                    connection = None
+                self._stop.wait(WATCH_RETRY_DELAY)
+        if connection is not None:
+            connection.close()
+        return None
+
+
+settings = Settings(DEFAULTS, MODERATOR_IDS, SETTINGS_FILE)
+
+
+# Проверка прав модератора клуба, боту которого пишут, до любых обращений
+# к Telegram и БД: посторонним отвечаем отказом, сам обработчик не вызывается
+def moderator_only(handler: Callable) -> Callable:
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        # clubs импортирует settings, поэтому импортируем его при вызове
+        from clubs import context_club
+
+        club_id = context_club(context).id
+        if not settings.is_moderator(club_id, update.message.from_user.id):
+            update.message.reply_text("Вы не являетесь модератором.")
+            return None
+        return handler(update, context, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,41 @@
+import logging
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Процесс останавливается: длинные задачи завершают текущую пачку,
+# фиксируют её и выходят, остальное сделает следующий запуск
+shutting_down = threading.Event()
+
+
+# Пачки задачи до начала остановки процесса
+def until_shutdown(batches: Iterable, name: str) -> Iterator:
+    for batch in batches:
+        if shutting_down.is_set():
+            logger.warning("%s прервана между пачками: процесс останавливается", name)
+            return
+        yield batch
+
+
+# Одновременно останавливаем части процесса и ждём их до deadline
+# (time.monotonic()). Возвращает названия частей, не успевших остановиться.
+def stop_all(stoppers: dict, deadline: float) -> list:
+    threads = {}
+    for name, stop in stoppers.items():
+        threads[name] = threading.Thread(
+            target=_run_stopper, args=(name, stop), name=f"stop-{name}", daemon=True
+        )
+        threads[name].start()
+    for thread in threads.values():
+        thread.join(max(0.0, deadline - time.monotonic()))
+    return [name for name, thread in threads.items() if thread.is_alive()]
+
+
+def _run_stopper(name: str, stop: Callable) -> None:
+    try:
+        stop()
+    except Exception as error:
+        logger.error("Ошибка при остановке %s: %s", name, error)
+    return None
@@ -0,0 +1,406 @@
+import datetime
+from collections import Counter, namedtuple
+
+from sqlalchemy import bindparam, delete, exists, func, select, true, tuple_, update
+from sqlalchemy.orm import aliased
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+
+from cleanup_queue import cleanup_worker, enqueue, subscription_cleanup_rows
+from clubs import club_share, interleave_by_club
+from constants import (
+    LIFECYCLE_MAX_ATTEMPTS,
+    LIFECYCLE_MAX_DELAY,
+    LIFECYCLE_RATE,
+    MONTHS,
+)
+from database import (
+    EVENT_EXPIRE,
+    EVENT_JOIN_REMINDER_1,
+    EVENT_JOIN_REMINDER_2,
+    EVENT_PERIOD_START,
+    EVENT_RENEW_REMINDER_1,
+    EVENT_RENEW_REMINDER_2,
+    Club,
+    Subscription,
+    SubscriptionEvent,
+    User,
+    session_factory,
+)
+from invite_links import ALL_LINKS, LINK_CHANNEL, LINK_CHAT, ensure_subscription_links
+from message_templates import (
+    FIRST_JOIN_REMINDER,
+    FIRST_RENEW_REMINDER,
+    INVITATION,
+    SECOND_JOIN_REMINDER,
+    SECOND_RENEW_REMINDER,
+    SUBSCRIPTION_PROLONGED,
+)
+from rate_limiter import KeyedTokenBuckets
+from settings import settings
+from shutdown import shutting_down
+from utils import check_user_in_channel, logger
+
+# Сколько событий обработчик забирает за раз
+CLAIM_BATCH_SIZE = 100
+# На сколько секунд забранные события скрываются от других обработчиков
+CLAIM_LEASE = 300
+# Пауза перед первым повтором после ошибки, дальше она удваивается
+RETRY_BASE_DELAY = 60
+# Через сколько часов после начала периода напоминаем о вступлении в клуб
+JOIN_REMINDER_DELAYS = {
+    EVENT_JOIN_REMINDER_1: datetime.timedelta(hours=3),
+    EVENT_JOIN_REMINDER_2: datetime.timedelta(hours=5),
+}
+# Напоминания, которые не отправляются, если опоздали
+REMINDERS = {
+    EVENT_JOIN_REMINDER_1,
+    EVENT_JOIN_REMINDER_2,
+    EVENT_RENEW_REMINDER_1,
+    EVENT_RENEW_REMINDER_2,
+}
+
+ClaimedEvent = namedtuple(
+    "ClaimedEvent", ["subscription_id", "kind", "due_at", "attempts", "club_id"]
+)
+
+# События каждого клуба отправляют не больше LIFECYCLE_RATE сообщений
+# в секунду: у каждого клуба свой бот и свои ограничения Telegram
+_buckets = KeyedTokenBuckets(LIFECYCLE_RATE)
+
+
+# Забираем пачку наступивших событий, как и очередь очистки:
+# не больше per_club событий каждого клуба, FOR UPDATE SKIP LOCKED
+# и аренда на CLAIM_LEASE секунд. Возвращаются исходные due_at,
+# от которых считается следующий раз.
+def _claim(session, per_club: int, now: datetime.datetime) -> list:
+    due = (
+        select(
+            SubscriptionEvent.subscription_id,
+            SubscriptionEvent.kind,
+            SubscriptionEvent.due_at,
+            SubscriptionEvent.attempts,
+            SubscriptionEvent.club_id,
+        )
+        .where(SubscriptionEvent.club_id == Club.id, SubscriptionEvent.due_at <= now)
+        .order_by(SubscriptionEvent.due_at)
+        .limit(per_club)
+        .with_for_update(skip_locked=True)
+        .lateral()
+    )
+    rows = session.execute(
+        select(due).select_from(Club).join(due, true()).order_by(due.c.due_at)
+    ).all()
+    if rows:
+        session.execute(
+            update(SubscriptionEvent)
+            .where(
+                tuple_(SubscriptionEvent.subscription_id, SubscriptionEvent.kind).in_(
+                    [(row.subscription_id, row.kind) for row in rows]
+                )
+            )
+            .values(
+                due_at=now + datetime.timedelta(seconds=CLAIM_LEASE),
+                attempts=SubscriptionEvent.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+    session.commit()
+    return interleave_by_club(
+        [
+            ClaimedEvent(
+                row.subscription_id,
+                row.kind,
+                row.due_at,
+                row.attempts + 1,
+                row.club_id,
+            )
+            for row in rows
+        ]
+    )
+
+
+# Подписки пачки событий одним запросом. renewed - у пользователя
+# есть подписка, которая заканчивается позже этой (подписка продлена).
+def _load_subscriptions(session, subscription_ids: list) -> dict:
+    other = aliased(Subscription)
+    renewed = (
+        exists()
+        .where(
+            other.user_id == Subscription.user_id,
+            other.id != Subscription.id,
+            other.end_datetime > Subscription.end_datetime,
+        )
+        .label("renewed")
+    )
+    rows = session.execute(
+        select(
+            Subscription.id,
+            Subscription.start_datetime,
+            Subscription.end_datetime,
+            Subscription.subscription_link,
+            Subscription.chat_link,
+            Subscription.club_id,
+            User.telegram_id,
+            renewed,
+        )
+        .join(User, User.id == Subscription.user_id)
+        .where(Subscription.id.in_(subscription_ids))
+    ).all()
+    return {row.id: row for row in rows}
+
+
+def _schedule(session, subscription_id: int, kind: str, at) -> None:
+    session.execute(select(func.schedule_subscription_event(subscription_id, kind, at)))
+    return None
+
+
+# Начало следующего месяца подписки в 12:00
+def _next_period_start(period_start: datetime.datetime) -> datetime.datetime:
+    return (period_start.replace(day=1) + datetime.timedelta(days=32)).replace(
+        day=1, hour=12, minute=0, second=0, microsecond=0
+    )
+
+
+# Начало периода: в первый месяц подписки - приглашение со ссылками
+# и напоминания о вступлении, в следующие - сообщение о продлении.
+# Пропущенные месяцы (подписку добавили задним числом) не догоняются,
+# а опоздавшее сообщение о продлении не отправляется. Приглашение
+# отправляется всегда: без него пользователь не попадёт в клуб.
+# Возвращает время следующего начала периода: 1-е число в 12:00
+# плюс постоянный сдвиг события.
+def _period_start(updater, session, event, subscription) -> datetime.datetime:
+    now = datetime.datetime.now()
+    # Сдвиг берём у той же функции, что и триггер: первое событие подписки,
+    # начавшейся в середине месяца, приходится не на 1-е число
+    spread = session.scalar(
+        select(func.subscription_event_spread(subscription.id, event.kind))
+    )
+    period_start = (event.due_at - spread).replace(
+        day=1, hour=12, minute=0, second=0, microsecond=0
+    )
+    while _next_period_start(period_start) + spread <= now:
+        period_start = _next_period_start(period_start)
+    next_due = _next_period_start(period_start) + spread
+    if subscription.end_datetime < period_start:
+        return next_due
+    first_month = (subscription.start_datetime.year, subscription.start_datetime.month)
+    if first_month == (period_start.year, period_start.month):
+        links = ensure_subscription_links(updater.bot, subscription.id, ALL_LINKS)
+        if not (links.get(LINK_CHANNEL) and links.get(LINK_CHAT)):
+            raise RuntimeError("Не удалось создать ссылки-приглашения")
+        if subscription.telegram_id:
+            _buckets.bucket(subscription.club_id).acquire()
+            INVITATION.send(
+                updater.bot,
+                subscription.telegram_id,
+                invite_link=links[LINK_CHANNEL],
+                chat_link=links[LINK_CHAT],
+            )
+        for kind, delay in JOIN_REMINDER_DELAYS.items():
+            _schedule(session, subscription.id, kind, max(period_start, now) + delay)
+    elif (now - period_start - spread).total_seconds() <= LIFECYCLE_MAX_DELAY:
+        if not subscription.chat_link:
+            ensure_subscription_links(updater.bot, subscription.id, (LINK_CHAT,))
+        if subscription.telegram_id:
+            _buckets.bucket(subscription.club_id).acquire()
+            SUBSCRIPTION_PROLONGED.send(updater.bot, subscription.telegram_id)
+    return next_due
+
+
+# Напоминание о вступлении не отправляется тем, кто уже в канале
+def _join_reminder(updater, session, event, subscription) -> None:
+    if not subscription.telegram_id:
+        return None
+    bucket = _buckets.bucket(subscription.club_id)
+    bucket.acquire()
+    channel_id = settings.club(subscription.club_id).channel_id
+    if check_user_in_channel(updater, subscription.telegram_id, channel_id):
+        return None
+    bucket.acquire()
+    if event.kind == EVENT_JOIN_REMINDER_1:
+        month = MONTHS[subscription.start_datetime.month][0]
+        FIRST_JOIN_REMINDER.send(updater.bot, subscription.telegram_id, month=month)
+    else:
+        SECOND_JOIN_REMINDER.send(updater.bot, subscription.telegram_id)
+    return None
+
+
+# Напоминание о продлении не отправляется, если подписка уже продлена
+def _renew_reminder(updater, session, event, subscription) -> None:
+    if not subscription.telegram_id or subscription.renewed:
+        return None
+    _buckets.bucket(subscription.club_id).acquire()
+    if event.kind == EVENT_RENEW_REMINDER_1:
+        FIRST_RENEW_REMINDER.send(updater.bot, subscription.telegram_id)
+    else:
+        SECOND_RENEW_REMINDER.send(updater.bot, subscription.telegram_id)
+    return None
+
+
+# Окончание подписки: удаляем её (события удалятся каскадом) и ставим
+# в очередь очистки отзыв ссылок и исключение участника. Если подписку
+# успели продлить, триггер уже перенёс событие, и ничего не делаем.
+def _expire(updater, session, event, subscription) -> None:
+    if subscription.end_datetime >= datetime.datetime.now():
+        return None
+    enqueue(
+        session,
+        subscription_cleanup_rows(
+            subscription.club_id,
+            subscription.subscription_link,
+            subscription.chat_link,
+            subscription.telegram_id,
+        ),
+    )
+    session.execute(delete(Subscription).where(Subscription.id == subscription.id))
+    return None
+
+
+HANDLERS = {
+    EVENT_PERIOD_START: _period_start,
+    EVENT_JOIN_REMINDER_1: _join_reminder,
+    EVENT_JOIN_REMINDER_2: _join_reminder,
+    EVENT_RENEW_REMINDER_1: _renew_reminder,
+    EVENT_RENEW_REMINDER_2: _renew_reminder,
+    EVENT_EXPIRE: _expire,
+}
+
+
+# Обрабатываем одно событие ботом его клуба (updaters - clubs.ClubUpdaters).
+# Возвращает результат и новое время события (для повторяющихся событий
+# и повторов после ошибки) или None.
+def _process_event(updaters, session, event, subscription, now) -> tuple:
+    if subscription is None:
+        return "dropped", None
+    if event.kind in REMINDERS and (now - event.due_at).total_seconds() > (
+        LIFECYCLE_MAX_DELAY
+    ):
+        logger.warning(
+            "Событие %s подписки %s опоздало и пропущено",
+            event.kind,
+            event.subscription_id,
+        )
+        return "skipped", None
+    # События клуба, приостановленного flood control, переносим на конец
+    # паузы, а не ждём её: остальные клубы пачки обрабатываются сразу
+    paused = _buckets.bucket(event.club_id).paused_for()
+    if paused:
+        return "flood", now + datetime.timedelta(seconds=paused)
+    try:
+        # Бот клуба без токена (или неизвестного клуба) - ошибка только
+        # этого события: оно повторяется как после любой другой ошибки,
+        # а остальные события пачки обрабатываются
+        updater = updaters.get(event.club_id)
+        next_due = HANDLERS[event.kind](updater, session, event, subscription)
+        return "done", next_due
+    except RetryAfter as error:
+        # Flood control общий для бота: приостанавливаем события клуба,
+        # а попытку не засчитываем
+        _buckets.bucket(event.club_id).pause(error.retry_after)
+        return "flood", now + datetime.timedelta(seconds=error.retry_after)
+    except (BadRequest, Unauthorized) as error:
+        # Пользователь заблокировал бота или удалил чат: повтор не поможет
+        logger.warning(
+            "Событие %s подписки %s пропущено: %s",
+            event.kind,
+            event.subscription_id,
+            error,
+        )
+        return "dropped", None
+    except Exception as error:
+        if event.attempts >= LIFECYCLE_MAX_ATTEMPTS:
+            logger.error(
+                "Событие %s подписки %s не выполнено после %s попыток: %s",
+                event.kind,
+                event.subscription_id,
+                event.attempts,
+                error,
+            )
+            return "dropped", None
+        logger.warning(
+            "Ошибка события %s подписки %s: %s",
+            event.kind,
+            event.subscription_id,
+            error,
+        )
+        delay = RETRY_BASE_DELAY * 2 ** (event.attempts - 1)
+        return "retry", now + datetime.timedelta(seconds=delay)
+
+
+# Разбираем все наступившие события подписок ботами их клубов (updaters -
+# clubs.ClubUpdaters). События клубов в пачке чередуются. Каждая пачка
+# обрабатывается в одной транзакции: выполненные события удаляются,
+# повторяющиеся переносятся на следующий раз.
+# Возвращает количество событий по результатам.
+def process_subscription_events(updaters) -> Counter:
+    results = Counter()
+    with session_factory() as session:
+        # При остановке процесса выходим после зафиксированной пачки,
+        # оставшиеся события заберёт следующий запуск
+        while not shutting_down.is_set():
+            now = datetime.datetime.now()
+            events = _claim(session, club_share(CLAIM_BATCH_SIZE), now)
+            if not events:
+                break
+            subscriptions = _load_subscriptions(
+                session, list({event.subscription_id for event in events})
+            )
+            finished = []
+            rescheduled = []
+            for event in events:
+                result, next_due = _process_event(
+                    updaters,
+                    session,
+                    event,
+                    subscriptions.get(event.subscription_id),
+                    now,
+                )
+                results[f"{event.kind}:{result}"] += 1
+                if next_due is None:
+                    finished.append((event.subscription_id, event.kind))
+                    continue
+                # Повторяющееся событие начинает попытки заново, повтор
+                # после ошибки - нет, а попытка при flood control не считается
+                attempts = 0
+                if result == "retry":
+                    attempts = event.attempts
+                elif result == "flood":
+                    attempts = event.attempts - 1
+                rescheduled.append(
+                    {
+                        "event_subscription_id": event.subscription_id,
+                        "event_kind": event.kind,
+                        "due_at": next_due,
+                        "attempts": attempts,
+                    }
+                )
+            # Событие, которое триггер перенёс во время обработки (подписку
+            # продлили), уже не под арендой и не трогается
+            leased = SubscriptionEvent.due_at == now + datetime.timedelta(
+                seconds=CLAIM_LEASE
+            )
+            if finished:
+                session.execute(
+                    delete(SubscriptionEvent).where(
+                        tuple_(
+                            SubscriptionEvent.subscription_id, SubscriptionEvent.kind
+                        ).in_(finished),
+                        leased,
+                    )
+                )
+            if rescheduled:
+                session.execute(
+                    update(SubscriptionEvent.__table__).where(
+                        SubscriptionEvent.subscription_id
+                        == bindparam("event_subscription_id"),
+                        SubscriptionEvent.kind == bindparam("event_kind"),
+                        leased,
+                    ),
+                    rescheduled,
+                )
+            session.commit()
+            if results[f"{EVENT_EXPIRE}:done"]:
+                cleanup_worker.wake()
+    if results:
+        logger.info("События подписок обработаны: %s", dict(results))
+    return results
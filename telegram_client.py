@@ -0,0 +1,47 @@
+import math
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.utils.request import Request
+
+from constants import TELEGRAM_BREAKER_FAILURES, TELEGRAM_BREAKER_RESET
+from rate_limiter import CircuitBreaker
+
+# Общий для процесса выключатель запросов к Bot API
+telegram_breaker = CircuitBreaker(
+    "Bot API", TELEGRAM_BREAKER_FAILURES, TELEGRAM_BREAKER_RESET
+)
+
+
+# Bot API недоступен. Наследуется от RetryAfter, поэтому задачи и очереди
+# откладывают запрос так же, как при flood control, а не тратят попытки.
+class CircuitOpen(RetryAfter):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(math.ceil(retry_after))
+        self.message = f"Bot API недоступен, повтор через {math.ceil(retry_after)} с"
+
+
+# Request, который считает сетевые ошибки Bot API и при разомкнутой цепи
+# не ждёт таймаута, а сразу отвечает CircuitOpen. Ответы Telegram с ошибкой
+# (400, 403, 429) означают, что API доступен, и замыкают цепь.
+class GuardedRequest(Request):
+    __slots__ = ("breaker",)
+
+    def __init__(self, *args, breaker: CircuitBreaker = telegram_breaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def _request_wrapper(self, *args, **kwargs) -> bytes:
+        wait = self.breaker.before_call()
+        if wait:
+            raise CircuitOpen(wait)
+        failed = False
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        except NetworkError as error:
+            failed = not isinstance(error, BadRequest)
+            raise
+        finally:
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
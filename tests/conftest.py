@@ -0,0 +1,155 @@
+import datetime
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import OperationalError
+
+from query_profiler import install, profile_queries
+
+# Пользователей в клубе теста: при N+1 запросов было бы не меньше
+CLUB_USERS = 20
+
+
+# Фикстура для тестов обработчиков и задач: подключает профилировщик
+# к движку и отдаёт контекстный менеджер, который падает при превышении
+# бюджета запросов.
+#
+#     def test_get_subscription_period(query_budget):
+#         with query_budget("get_subscription_period", budget=2):
+#             get_subscription_period(update, context)
+@pytest.fixture
+def query_budget():
+    from database import get_engine
+
+    install(get_engine())
+    return profile_queries
+
+
+# Схема в БД из настроек (.env) создаётся один раз. Если БД недоступна,
+# тесты, которым она нужна, пропускаются.
+@pytest.fixture(scope="session")
+def database():
+    from database import migrate
+
+    try:
+        migrate()
+    except OperationalError as error:
+        pytest.skip(f"БД недоступна: {error}")
+    return None
+
+
+# Отдельный клуб с CLUB_USERS пользователями и их действующими подписками.
+# После теста удаляются все строки клуба и сам клуб.
+@pytest.fixture
+def club(database):
+    from database import Base, Club, Subscription, User, session_factory
+    from settings import settings
+
+    now = datetime.datetime.now()
+    with session_factory() as session:
+        club_id = session.execute(
+            insert(Club)
+            .values(
+                slug=f"test-{uuid.uuid4().hex[:8]}",
+                channel_id="-1001",
+                chat_id="-1002",
+            )
+            .returning(Club.id)
+        ).scalar_one()
+        user_ids = session.execute(
+            insert(User).returning(User.id),
+            [
+                {
+                    "club_id": club_id,
+                    "telegram_id": index + 1,
+                    "phone_number": f"+7999{club_id:03d}{index:04d}",
+                }
+                for index in range(CLUB_USERS)
+            ],
+        ).scalars()
+        session.execute(
+            insert(Subscription),
+            [
+                {
+                    "user_id": user_id,
+                    "start_datetime": now - datetime.timedelta(days=40),
+                    "end_datetime": now + datetime.timedelta(days=20),
+                }
+                for user_id in user_ids
+            ],
+        )
+        session.commit()
+    yield settings.club(club_id)
+    with session_factory() as session:
+        for table in reversed(Base.metadata.sorted_tables):
+            if "club_id" in table.c and table is not Club.__table__:
+                session.execute(delete(table).where(table.c.club_id == club_id))
+        session.execute(delete(Club).where(Club.id == club_id))
+        session.commit()
+    settings.reload()
+
+
+# Бот без сети: запросы к Bot API только считаются по методам
+class FakeBot:
+    base_url = "https://api.telegram.org/bottest"
+
+    def __init__(self) -> None:
+        self.calls = Counter()
+        self.request = SimpleNamespace(
+            _request_wrapper=self._request_wrapper, _parse=lambda result: result
+        )
+
+    def _request_wrapper(self, method, url, **kwargs) -> dict:
+        self.calls[url.rsplit("/", 1)[-1]] += 1
+        return {}
+
+    def get_chat_member(self, chat_id, user_id):
+        self.calls["getChatMember"] += 1
+        return SimpleNamespace(status="member")
+
+    def create_chat_invite_link(self, chat_id, member_limit, expire_date):
+        self.calls["createChatInviteLink"] += 1
+        link = f"https://t.me/+{chat_id}-{self.calls['createChatInviteLink']}"
+        return SimpleNamespace(invite_link=link)
+
+    def send_document(self, chat_id, document, filename):
+        self.calls["sendDocument"] += 1
+        return None
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+# Контекст и обновление команды модератора клуба club
+@pytest.fixture
+def command(club, bot):
+    replies = []
+    message = SimpleNamespace(
+        chat_id=1,
+        from_user=SimpleNamespace(id=1),
+        reply_text=replies.append,
+    )
+    update = SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=1))
+    context = SimpleNamespace(bot=bot, bot_data={"club_id": club.id}, args=[])
+    return SimpleNamespace(update=update, context=context, replies=replies)
+
+
+# Ссылки подписок клуба
+@pytest.fixture
+def club_links(club):
+    from database import Subscription, session_factory
+
+    def read() -> list:
+        with session_factory() as session:
+            return session.execute(
+                select(Subscription.subscription_link, Subscription.chat_link).where(
+                    Subscription.club_id == club.id
+                )
+            ).all()
+
+    return read
@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from query_profiler import QueryBudgetExceeded, install, profile_queries
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    install(engine)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY)"))
+        connection.execute(text("INSERT INTO users (id) VALUES (1), (2), (3)"))
+    yield engine
+    engine.dispose()
+
+
+def test_budget_is_not_exceeded(engine):
+    with engine.connect() as connection:
+        with profile_queries("users", budget=1) as profile:
+            connection.execute(text("SELECT id FROM users")).all()
+    assert profile.count == 1
+
+
+def test_budget_overrun_raises(engine):
+    with engine.connect() as connection:
+        with pytest.raises(QueryBudgetExceeded, match=r"\(2 > 1\)"):
+            with profile_queries("users", budget=1):
+                connection.execute(text("SELECT id FROM users")).all()
+                connection.execute(text("SELECT count(*) FROM users")).scalar()
+
+
+# Запрос в цикле по пользователям (N+1) определяется как одна форма
+def test_repeated_shapes_are_detected(engine):
+    with engine.connect() as connection:
+        with profile_queries("users") as profile:
+            for user_id in range(1, 6):
+                connection.execute(text(f"SELECT id FROM users WHERE id = {user_id}"))
+            connection.execute(text("SELECT count(*) FROM users")).scalar()
+    assert profile.repeated_shapes(threshold=5) == [
+        ("SELECT id FROM users WHERE id = ?", 5)
+    ]
+
+
+# Вложенный профиль добавляет свои запросы во внешний
+def test_nested_profile_is_merged(engine):
+    with engine.connect() as connection:
+        with profile_queries("outer") as outer:
+            connection.execute(text("SELECT 1")).scalar()
+            with profile_queries("inner") as inner:
+                connection.execute(text("SELECT 2")).scalar()
+    assert inner.count == 1
+    assert outer.count == 2
@@ -0,0 +1,56 @@
+import inspect
+
+import pytest
+
+import invite_links
+import postponed_tasks
+from conftest import CLUB_USERS
+from manager_commands import get_all_users
+
+
+# Подписки всех пользователей читаются одним запросом, а не по одному
+# на пользователя
+def test_get_all_users(command, bot, query_budget):
+    with query_budget("get_all_users", budget=2):
+        inspect.unwrap(get_all_users)(command.update, command.context)
+    assert bot.calls["sendDocument"] == 1
+    assert bot.calls["getChatMember"] == 2 * CLUB_USERS
+
+
+# Получатели напоминаний читаются одним запросом к когортам или
+# пользователям клуба независимо от их количества
+@pytest.mark.parametrize(
+    "job, budget, messages",
+    [
+        ("_request_feedback_from_all_users", 1, CLUB_USERS),
+        ("_get_first_reminder_to_renew_the_subscription", 1, 0),
+        ("_get_second_reminder_to_renew_the_subscription", 2, 0),
+        ("_remind_lapsed_users", 1, 0),
+        ("_get_first_reminder_to_join_the_club", 1, CLUB_USERS),
+        ("_get_second_reminder_to_join_the_club", 1, CLUB_USERS),
+    ],
+)
+def test_reminder_jobs(club, bot, query_budget, job, budget, messages):
+    with query_budget(job, budget=budget):
+        getattr(postponed_tasks, job)(bot, club)
+    assert bot.calls["sendMessage"] == messages
+
+
+# Недостающие ссылки пачки захватываются и записываются одним запросом
+# на пачку: выборка новых и продлённых подписок, чтение, захват и запись
+def test_send_invite_link(club, bot, query_budget, club_links, monkeypatch):
+    monkeypatch.setattr(invite_links, "LINK_PACE_DELAY", 0)
+    with query_budget("send_invite_link", budget=5):
+        postponed_tasks._send_invite_link(bot, club)
+    assert bot.calls["createChatInviteLink"] == CLUB_USERS
+    assert bot.calls["sendMessage"] == CLUB_USERS
+    assert all(chat_link for _, chat_link in club_links())
+
+
+def test_notify_about_new_chat(club, bot, query_budget, club_links, monkeypatch):
+    monkeypatch.setattr(invite_links, "LINK_PACE_DELAY", 0)
+    with query_budget("notify_about_new_chat", budget=4):
+        postponed_tasks._notify_about_new_chat(bot, club)
+    assert bot.calls["createChatInviteLink"] == CLUB_USERS
+    assert bot.calls["sendMessage"] == CLUB_USERS
+    assert all(chat_link for _, chat_link in club_links())
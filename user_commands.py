@@ -5,18 +5,21 @@ from sqlalchemy import asc
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from constants import (
-    CHANNEL_ID,
-    CHAT_ID,
-    LINK_COMING_SOON,
-    TEXT_INVITATION,
-    THESE_ARE_YOUR_LINKS,
-)
+from clubs import context_club
+from constants import LINK_COMING_SOON, USER_ACTION_BURST, USER_ACTION_RATE
 from database import Session, Subscription, User
-from utils import create_invite_link, create_session, logger
+from invite_links import LINK_CHANNEL, LINK_CHAT, ensure_subscription_links
+from message_templates import INVITATION, YOUR_LINKS
+from query_profiler import profiled
+from rate_limiter import coalesce_per_user, per_user_rate_limit
+from utils import create_session, logger
 
 
-# Обработчик сообщения 'Получить ссылку 🏁'
+# Обработчик сообщения 'Получить ссылку 🏁'. Одновременные нажатия
+# одного пользователя объединяются, слишком частые отбрасываются.
+@profiled
+@coalesce_per_user
+@per_user_rate_limit(USER_ACTION_RATE, USER_ACTION_BURST)
 def get_subscription_link(
     update: Update, context: CallbackContext, phone_number: Optional[str] = None
 ) -> None:
@@ -39,6 +42,7 @@ def get_subscription_link(
         "К твоему телеграм id уже привязан другой номер, обратись в поддержку."
     )
     check_payment_text = "Проверяем наличие оплат..."
+    club_id = context_club(context).id
     with create_session() as session:
         try:
             # Если передан номер телефона
@@ -46,7 +50,7 @@ def get_subscription_link(
                 update.message.reply_text(check_payment_text)
                 user = (
                     session.query(User)
-                    .filter(User.phone_number == phone_number)
+                    .filter(User.club_id == club_id, User.phone_number == phone_number)
                     .first()
                 )
                 if not user:
@@ -57,7 +61,10 @@ def get_subscription_link(
                 if not user.telegram_id:
                     user_from_id = (
                         session.query(User)
-                        .filter(User.telegram_id == update.message.chat_id)
+                        .filter(
+                            User.club_id == club_id,
+                            User.telegram_id == update.message.chat_id,
+                        )
                         .first()
                     )
                     if user_from_id:
@@ -80,16 +87,11 @@ def get_subscription_link(
                     return None
                 # Смотрим, началась ли подписка
                 if nearest_subscription.subscription_link:
-                    chat_link = (
-                        nearest_subscription.chat_link
-                        if nearest_subscription.chat_link
-                        else LINK_COMING_SOON
-                    )
-                    update.message.reply_text(
-                        THESE_ARE_YOUR_LINKS.format(
-                            invite_link=nearest_subscription.subscription_link,
-                            chat_link=chat_link,
-                        )
+                    YOUR_LINKS.send(
+                        context.bot,
+                        update.message.chat_id,
+                        invite_link=nearest_subscription.subscription_link,
+                        chat_link=nearest_subscription.chat_link or LINK_COMING_SOON,
                     )
                     return None
                 now = datetime.datetime.now()
@@ -98,22 +100,18 @@ def get_subscription_link(
                     and 12 <= now.hour < 18
                     and nearest_subscription.start_datetime <= now
                 ):
-                    invite_link = create_invite_link(
-                        context.bot, nearest_subscription.end_datetime, CHANNEL_ID
-                    )
-                    chat_link = create_invite_link(
-                        context.bot, nearest_subscription.end_datetime, CHAT_ID
+                    links = ensure_subscription_links(
+                        context.bot, nearest_subscription.id
                     )
-                    # Присваиваем инвайт конкретному пользователю
+                    invite_link = links.get(LINK_CHANNEL)
+                    chat_link = links.get(LINK_CHAT)
                     if invite_link:
-                        nearest_subscription.subscription_link = invite_link
-                        session.commit()
                         # Отправляем текст с инвайтом
-                        context.bot.send_message(
-                            chat_id=user.telegram_id,
-                            text=TEXT_INVITATION.format(
-                                invite_link=invite_link, chat_link=chat_link
-                            ),
+                        INVITATION.send(
+                            context.bot,
+                            user.telegram_id,
+                            invite_link=invite_link,
+                            chat_link=chat_link or LINK_COMING_SOON,
                         )
                         return None
                 # Подписка активирована
@@ -121,7 +119,11 @@ def get_subscription_link(
                 return None
             # Если номер телефона не передан
             telegram_id = update.message.from_user.id
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
+            user = (
+                session.query(User)
+                .filter(User.club_id == club_id, User.telegram_id == telegram_id)
+                .first()
+            )
             if not user:
                 update.message.reply_text(
                     "Напишите номер телефона, который вы ввели при оплате👇🏼, "
@@ -140,16 +142,11 @@ def get_subscription_link(
                 update.message.reply_text(not_found_text)
                 return None
             if nearest_subscription.subscription_link:
-                chat_link = (
-                    nearest_subscription.chat_link
-                    if nearest_subscription.chat_link
-                    else LINK_COMING_SOON
-                )
-                update.message.reply_text(
-                    THESE_ARE_YOUR_LINKS.format(
-                        invite_link=nearest_subscription.subscription_link,
-                        chat_link=chat_link,
-                    )
+                YOUR_LINKS.send(
+                    context.bot,
+                    update.message.chat_id,
+                    invite_link=nearest_subscription.subscription_link,
+                    chat_link=nearest_subscription.chat_link or LINK_COMING_SOON,
                 )
                 return None
             now = datetime.datetime.now()
@@ -158,22 +155,16 @@ def get_subscription_link(
                 and 12 <= now.hour < 18
                 and nearest_subscription.start_datetime <= now
             ):
-                invite_link = create_invite_link(
-                    context.bot, nearest_subscription.end_datetime, CHANNEL_ID
-                )
-                chat_link = create_invite_link(
-                    context.bot, nearest_subscription.end_datetime, CHAT_ID
-                )
-                # Присваиваем инвайт конкретному пользователю
+                links = ensure_subscription_links(context.bot, nearest_subscription.id)
+                invite_link = links.get(LINK_CHANNEL)
+                chat_link = links.get(LINK_CHAT)
                 if invite_link:
-                    nearest_subscription.subscription_link = invite_link
-                    session.commit()
                     # Отправляем текст с инвайтом
-                    context.bot.send_message(
-                        chat_id=telegram_id,
-                        text=TEXT_INVITATION.format(
-                            invite_link=invite_link, chat_link=chat_link
-                        ),
+                    INVITATION.send(
+                        context.bot,
+                        telegram_id,
+                        invite_link=invite_link,
+                        chat_link=chat_link or LINK_COMING_SOON,
                     )
                     return None
             # Подписка активирована
@@ -181,7 +172,7 @@ def get_subscription_link(
             session.commit()
         except Exception as error:
             session.rollback()
-            logger.error(f"Ошибка при отправки ссылки: {str(error)}")
+            logger.error("Ошибка при отправки ссылки: %s", error)
             raise
         finally:
             Session.remove()  # Удаляем сессию из контекста
@@ -189,10 +180,16 @@ def get_subscription_link(
 
 
 # Обработчик сообщения 'Срок действия подписки 🕑'
+@profiled
 def get_subscription_period(update: Update, context: CallbackContext) -> None:
     telegram_id = update.message.from_user.id
+    club_id = context_club(context).id
     with create_session() as session:
-        user_id = session.query(User.id).filter(User.telegram_id == telegram_id).first()
+        user_id = (
+            session.query(User.id)
+            .filter(User.club_id == club_id, User.telegram_id == telegram_id)
+            .first()
+        )
         if not user_id:
             update.message.reply_text("У тебя нет действующей подписки.")
             return None
@@ -217,10 +214,16 @@ def get_subscription_period(update: Update, context: CallbackContext) -> None:
 
 
 # Обработчик сообщения 'Показать привязанный номер 📲'
+@profiled
 def show_linked_phone_number(update: Update, context: CallbackContext) -> None:
     telegram_id = update.message.from_user.id
+    club_id = context_club(context).id
     with create_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        user = (
+            session.query(User)
+            .filter(User.club_id == club_id, User.telegram_id == telegram_id)
+            .first()
+        )
         if not user:
             update.message.reply_text("У тебя нет привязанного номера.")
             return None
@@ -232,6 +235,7 @@ def show_linked_phone_number(update: Update, context: CallbackContext) -> None:
 
 
 # Обработчик сообщения 'Техническая поддержка ⚙️'
+@profiled
 def get_technical_support(update: Update, context: CallbackContext) -> None:
     update.message.reply_text(
         "Пожалуйста, обращайся в техническую поддержку:\n"
@@ -242,10 +246,16 @@ def get_technical_support(update: Update, context: CallbackContext) -> None:
 
 
 # Обработчик сообщения 'Оставить отзыв ✍🏼'
+@profiled
 def write_review(update: Update, context: CallbackContext) -> None:
     telegram_id = update.message.from_user.id
+    club_id = context_club(context).id
     with create_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        user = (
+            session.query(User)
+            .filter(User.club_id == club_id, User.telegram_id == telegram_id)
+            .first()
+        )
         if not user:
             update.message.reply_text(
                 "К сожалению, ты не можешь оставить отзыв, так как не являешься членом сленг клуба.\n\n"
@@ -263,12 +273,14 @@ def write_review(update: Update, context: CallbackContext) -> None:
 
 
 # Функция для команды /get_invitation
+@profiled
 def get_invitation(update: Update, context: CallbackContext) -> None:
     get_subscription_link(update, context)
     return None
 
 
 # Обработчик сообщения 'Демо-версия сленг-клуба 🖼️'
+@profiled
 def get_demo_version_of_club(update: Update, context: CallbackContext) -> None:
     update.message.reply_text(
         "Ма френд, привет!: Ссылка для вступления в демо-версию "
@@ -1,38 +1,22 @@
 import datetime
 import logging
 import time
+from collections import Counter, defaultdict
 
-from dateutil.relativedelta import relativedelta
+from sqlalchemy import insert, select
 from telegram import Bot
 from telegram.ext import CallbackContext
 
-from constants import MONTHS
-from database import Session, Subscription, User
+from constants import DEFAULT_CLUB_ID, JOB_BATCH_SIZE, MONTHS
+from database import AppliedPayment, Session, Subscription, User
+from logging_config import setup_logging
+from phone_numbers import canonical_phone_number
 
-# Включаем логгирование
-logging.basicConfig(
-    filename="bot.log",  # Имя файла для записи логов
-    filemode="a",  # Режим открытия файла, 'a' означает добавление
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+# Включаем асинхронное логгирование
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
-# Функция для удаления пользователя из канала
-def kick_user_from_channel(bot, user_id: int, chat_id: str) -> None:
-    try:
-        bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
-        logger.info(
-            f"Пользователь с телеграм id: {user_id} был удалён из канала: {chat_id}"
-        )
-        time.sleep(1)
-        bot.unban_chat_member(chat_id=chat_id, user_id=user_id, only_if_banned=True)
-    except Exception as error:
-        logger.error(f"Ошибка при удалении пользователя: {str(error)}")
-    return None
-
-
 # Создаем ссылку на вступление в канал с ограничением действия
 def create_invite_link(
     bot: Bot,
@@ -51,7 +35,7 @@ def create_invite_link(
             if invite_link:
                 return invite_link
         except Exception as error:
-            logger.error(f"Попытка создать ссылку {attempt + 1} failed: {error}")
+            logger.error("Попытка создать ссылку %s failed: %s", attempt + 1, error)
             if "Flood control exceeded" in str(error):
                 time.sleep(flood_delay)
             else:
@@ -61,10 +45,11 @@ def create_invite_link(
     return invite_link
 
 
-# Логика обновления подписки
-def update_subscription(
-    paid_months: int, phone_number: str, start_month: int, start_year: int, tg: str
-) -> None:
+# Период оплаченной подписки: с 12:00 первого числа стартового месяца
+# до 23:59 последнего дня последнего оплаченного месяца
+def subscription_period(paid_months: int, start_month: int, start_year: int) -> tuple:
+    from dateutil.relativedelta import relativedelta
+
     start_datetime = datetime.datetime(
         day=1, month=start_month, year=start_year, hour=12, minute=0
     )
@@ -72,20 +57,41 @@ def update_subscription(
     end_datetime = end_datetime.replace(
         day=MONTHS[end_datetime.month][1], hour=23, minute=59
     )
+    return start_datetime, end_datetime
+
+
+# Логика обновления подписки пользователя клуба
+def update_subscription(
+    paid_months: int,
+    phone_number: str,
+    start_month: int,
+    start_year: int,
+    tg: str,
+    club_id: int = DEFAULT_CLUB_ID,
+) -> None:
+    start_datetime, end_datetime = subscription_period(
+        paid_months, start_month, start_year
+    )
+    # Номер хранится и ищется только в виде E.164
+    phone_number = canonical_phone_number(phone_number)
+    if not phone_number:
+        raise ValueError("Некорректный номер телефона")
     with create_session() as session:
         try:
             # Получаем пользователя по номеру телефона
             # с блокировкой записи в БД
             user = (
                 session.query(User)
-                .filter(User.phone_number == phone_number)
+                .filter(User.club_id == club_id, User.phone_number == phone_number)
                 .with_for_update()
                 .first()
             )
             # Если новый пользователь
             if not user:
                 user_link = f"https://t.me/{tg}"
-                new_user = User(phone_number=phone_number, user_link=user_link)
+                new_user = User(
+                    club_id=club_id, phone_number=phone_number, user_link=user_link
+                )
                 session.add(new_user)
                 session.commit()
                 new_subscription = Subscription(
@@ -94,7 +100,6 @@ def update_subscription(
                     user_id=new_user.id,
                 )
                 session.add(new_subscription)
-                session.commit()
             else:
                 # Если пользователь уже существует
                 new_subscription = Subscription(
@@ -103,17 +108,142 @@ def update_subscription(
                     user_id=user.id,
                 )
                 session.add(new_subscription)
-                session.commit()
+            record_applied_payments(
+                session, club_id, [(phone_number, (start_datetime, end_datetime))]
+            )
+            session.commit()
         except Exception as error:
             logger.error(
-                f"Ошибка при обновлении подписки в update_subscription: {str(error)}"
+                "Ошибка при обновлении подписки в update_subscription: %s", error
             )
             session.rollback()
+            raise
         finally:
             Session.remove()  # Удаляем сессию из контекста
     return None
 
 
+# Записываем оплаты клуба в журнал применённых. periods - пары
+# (номер телефона, (начало, конец)), уже записанные пропускаются.
+def record_applied_payments(session, club_id: int, periods: list) -> None:
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    if not periods:
+        return None
+    session.execute(
+        pg_insert(AppliedPayment)
+        .values(
+            [
+                {
+                    "club_id": club_id,
+                    "phone_number": phone_number,
+                    "start_datetime": start_datetime,
+                    "end_datetime": end_datetime,
+                }
+                for phone_number, (start_datetime, end_datetime) in set(periods)
+            ]
+        )
+        .on_conflict_do_nothing()
+    )
+    return None
+
+
+# Объединяем периоды, которые пересекаются или идут подряд (с разрывом
+# меньше суток), по тому же правилу, что и handle_overlapping_subscriptions
+def merge_periods(periods: list) -> list:
+    merged = []
+    for start_datetime, end_datetime in sorted(periods):
+        if merged and start_datetime <= merged[-1][1] + datetime.timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], end_datetime)
+        else:
+            merged.append([start_datetime, end_datetime])
+    return [tuple(period) for period in merged]
+
+
+# Пакетная версия update_subscription для повторного импорта оплат
+# и массовых начислений. payments - кортежи (paid_months, phone_number,
+# start_month, start_year, tg) оплат клуба club_id. Новые пользователи
+# создаются одним INSERT ... ON CONFLICT (club_id, phone_number) DO NOTHING
+# на пачку, подписки одного пользователя из пачки объединяются
+# и вставляются одним многострочным INSERT. Всё выполняется в одной
+# транзакции: при ошибке не применяется ни одна оплата. Возвращает
+# счётчики изменений.
+def update_subscriptions(payments: list, club_id: int = DEFAULT_CLUB_ID) -> Counter:
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    stats = Counter()
+    periods = defaultdict(list)
+    user_links = {}
+    for paid_months, phone_number, start_month, start_year, tg in payments:
+        canonical = canonical_phone_number(phone_number)
+        if not canonical:
+            logger.error("Оплата с некорректным номером телефона: %s", phone_number)
+            stats["invalid"] += 1
+            continue
+        periods[canonical].append(
+            subscription_period(paid_months, start_month, start_year)
+        )
+        user_links.setdefault(canonical, f"https://t.me/{tg}")
+    phone_numbers = sorted(periods)
+    with create_session() as session:
+        try:
+            for batch_start in range(0, len(phone_numbers), JOB_BATCH_SIZE):
+                batch = phone_numbers[batch_start : batch_start + JOB_BATCH_SIZE]
+                created = session.execute(
+                    pg_insert(User)
+                    .values(
+                        [
+                            {
+                                "club_id": club_id,
+                                "phone_number": phone,
+                                "user_link": user_links[phone],
+                            }
+                            for phone in batch
+                        ]
+                    )
+                    .on_conflict_do_nothing(
+                        index_elements=[User.club_id, User.phone_number]
+                    )
+                    .returning(User.id)
+                ).all()
+                stats["users_created"] += len(created)
+                # Блокируем пользователей пачки в порядке id, как и
+                # update_subscription блокирует своего пользователя
+                user_ids = dict(
+                    session.execute(
+                        select(User.phone_number, User.id)
+                        .where(User.club_id == club_id, User.phone_number.in_(batch))
+                        .order_by(User.id)
+                        .with_for_update()
+                    ).all()
+                )
+                subscriptions = [
+                    {
+                        "user_id": user_ids[phone],
+                        "start_datetime": start_datetime,
+                        "end_datetime": end_datetime,
+                    }
+                    for phone in batch
+                    for start_datetime, end_datetime in merge_periods(periods[phone])
+                ]
+                session.execute(insert(Subscription), subscriptions)
+                stats["subscriptions_created"] += len(subscriptions)
+                record_applied_payments(
+                    session,
+                    club_id,
+                    [(phone, period) for phone in batch for period in periods[phone]],
+                )
+            session.commit()
+        except Exception as error:
+            logger.error("Ошибка при пакетном обновлении подписок: %s", error)
+            session.rollback()
+            raise
+        finally:
+            Session.remove()
+    stats["payments"] = len(payments) - stats["invalid"]
+    return stats
+
+
 # Проверяем присутствие пользователя в канале
 def check_user_in_channel(context: CallbackContext, user_id: int, chat_id: str) -> bool:
     try:
@@ -121,7 +251,7 @@ def check_user_in_channel(context: CallbackContext, user_id: int, chat_id: str)
         if member.status in {"member", "administrator", "creator"}:
             return True
     except Exception as error:
-        logger.warning(f"Пользователь не является участником канала: {error}")
+        logger.warning("Пользователь не является участником канала: %s", error)
         return False
 
 
@@ -133,7 +263,7 @@ def create_session():
             session = Session()
             return session
         except Exception as error:
-            logger.error(f"Ошибка при создании сессии: {str(error)}")
+            logger.error("Ошибка при создании сессии: %s", error)
             # Экспоненциальная задержка перед повторной попыткой
             time.sleep(2**i)
     raise Exception("Не удалось создать сессию после нескольких попыток")